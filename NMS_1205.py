@@ -1,18 +1,24 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
-import mido  # type: ignore
 import queue
 import threading
 import time
 
 class NMS_1205(threading.Thread):
-    def __init__(self, cpu, debug):
+    def __init__(self, cpu, debug, midi: bool = True):
+        # midi: connect to the MIDI in and out of the host; without it the
+        # ports are there but nothing comes in and what's sent is dropped
         self.cpu = cpu
         self.debug = debug
 
-        self.mpo = mido.open_output()
-        self.mpi = mido.open_input()
+        self.mpo = self.mpi = None
+
+        if midi:
+            import mido  # type: ignore
+
+            self.mpo = mido.open_output()
+            self.mpi = mido.open_input()
 
         self.outbuf = [ 0 ] * 3
         self.outbufin = 0
@@ -32,7 +38,9 @@ class NMS_1205(threading.Thread):
 
     def stop(self):
         self.stop_flag = True
-        self.mpo.close()
+
+        if self.mpo:
+            self.mpo.close()
 
     def run(self):
         while not self.stop_flag:
@@ -65,6 +73,9 @@ class NMS_1205(threading.Thread):
         return 0
 
     def push_byte(self, v: int) -> None:
+        if not self.mpo:
+            return
+
         if v & 128:
             if self.outbufin > 0:
                 self.mpo.write_short(self.outbuf)
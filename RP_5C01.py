@@ -3,19 +3,37 @@
 
 import time
 from typing import List
+from z80 import FREQ_CLOCK
 
 class RP_5C01:
-    def __init__(self, debug):
+    def __init__(self, debug, sched=None):
         self.ri: int = 0
         self.blocks = [ [ 0 for k in range(4)] for j in range(16)]
         self.debug = debug
 
+        # the clock runs on emulated time, starting at the wall-clock time
+        # of power-on
+        self.scheduler = sched
+        self.epoch: int = int(time.time())
+        self.second = None
+        self.tm = None
+
     def get_ios(self):
         return [ [ 0xb5 ] , [ 0xb4, 0xb5 ] ]
 
     def get_name(self):
         return 'RP-5C01 (RTC)'
 
+    def get_state(self) -> dict:
+        return { 'ri': self.ri, 'blocks': [ list(b) for b in self.blocks ], 'epoch': self.epoch }
+
+    def set_state(self, state: dict) -> None:
+        # the clock continues from where it was when the snapshot was made
+        self.ri = state['ri']
+        self.blocks = [ list(b) for b in state['blocks'] ]
+        self.epoch = state['epoch']
+        self.second = None
+
     def read_io(self, a: int) -> int:
         block = self.blocks[0x0d][0] & 3
 
@@ -25,7 +43,7 @@ class RP_5C01:
             rc = (self.blocks[self.ri][block] & 15)
 
         else:
-            now = time.localtime()
+            now = self.get_time()
 
             if self.ri == 0:
                 rc = now.tm_sec % 10
@@ -58,6 +76,18 @@ class RP_5C01:
 
         return rc | 0xf0
 
+    def get_time(self):
+        if not self.scheduler:
+            return time.localtime()
+
+        second = self.epoch + self.scheduler.now // FREQ_CLOCK
+
+        if second != self.second:
+            self.second = second
+            self.tm = time.localtime(second)
+
+        return self.tm
+
     def write_io(self, a: int, v: int) -> None:
         if a == 0xb4:
             self.ri = v
@@ -0,0 +1,42 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from typing import List
+
+# MSX-Music: a YM2413 (OPLL) on I/O ports 0x7c (register) and 0x7d (data).
+# The writes go to the sound process, see opll.py for the synthesis.
+
+class YM2413:
+    def __init__(self, snd, debug):
+        self.snd = snd
+        self.debug = debug
+
+        self.ri: int = 0
+        self.regs: List[int] = [ 0 ] * 64
+
+    def get_ios(self):
+        return [ [ ] , [ 0x7c, 0x7d ] ]
+
+    def get_name(self):
+        return 'YM2413 (MSX-Music)'
+
+    def get_state(self) -> dict:
+        return { 'ri': self.ri, 'regs': list(self.regs) }
+
+    def set_state(self, state: dict) -> None:
+        # the sound process only knows what it is sent: send everything
+        for a, v in enumerate(state['regs']):
+            self.regs[a] = v
+            self.snd.set_opll(a, v)
+
+        self.ri = state['ri']
+
+    def write_io(self, a: int, v: int) -> None:
+        if a == 0x7c:
+            self.ri = v & 0x3f
+
+        else:
+            self.regs[self.ri] = v
+            # self.debug('YM2413 %02x: %02x' % (self.ri, v))
+
+            self.snd.set_opll(self.ri, v)
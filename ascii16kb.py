@@ -3,14 +3,14 @@
 
 import sys
 from typing import List, Tuple
+from romimage import load_rom_image, get_banks
 
 class ascii16kb:
     def __init__(self, ascii16kb_rom_file, debug):
         print('Loading ASCII-16kB rom %s...' % ascii16kb_rom_file, file=sys.stderr)
 
-        fh = open(ascii16kb_rom_file, 'rb')
-        self.ascii16kb_rom = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.ascii16kb_rom = load_rom_image(ascii16kb_rom_file)
+        self.banks = get_banks(self.ascii16kb_rom, 0x4000)
 
         self.n_pages: int = (len(self.ascii16kb_rom) + 0x3fff) // 0x4000
 
@@ -35,6 +35,15 @@ class ascii16kb:
 
         return bank, offset
 
+    def get_page_mem(self, page: int):
+        return (self.banks[self.ascii16kb_pages[page - 1] % len(self.banks)], 0, 0x4000, False)
+
+    def get_state(self) -> dict:
+        return { 'pages': list(self.ascii16kb_pages) }
+
+    def set_state(self, state: dict) -> None:
+        self.ascii16kb_pages = list(state['pages'])
+
     def write_mem(self, a: int, v: int) -> None:
         if a >= 0x6000 and a < 0x6800:
             self.debug('ASCII 16kB: set bank 0 to %d' % v)
@@ -0,0 +1,435 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# Runs fixed workloads (zexdoc/zexall, the FUSE tests, instruction mix
+# loops and a BIOS boot to the BASIC prompt) and reports host time,
+# emulated T-states, effective MHz and instructions per second. Results can
+# be written to a JSON file and compared against an earlier one.
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+from blockcache import layout_config
+from bus import bus
+from memmapper import memmap
+from rom import rom
+from scheduler import scheduler
+from z80 import z80, FREQ_CLOCK, FREQ_VDP_REFRESH
+
+# instruction mix loops, all loaded at 0x0100
+MICRO = {
+    # ld b,0 / add a,b / sub c / and d / or e / xor h / inc a / dec c / cp l / rla / daa / djnz / jp 0100
+    'micro-alu': [ 0x06, 0x00, 0x80, 0x91, 0xa2, 0xb3, 0xac, 0x3c, 0x0d, 0xbd, 0x17, 0x27, 0x10, 0xf4, 0xc3, 0x00, 0x01 ],
+
+    # ld hl,8000 / ld de,c000 / ld b,0 / ld a,(hl) / ld (de),a / inc hl / inc de / ld (hl),a / push hl / pop hl /
+    # ld a,(9000) / ld (9001),a / djnz / jp 0100
+    'micro-memory': [ 0x21, 0x00, 0x80, 0x11, 0x00, 0xc0, 0x06, 0x00, 0x7e, 0x12, 0x23, 0x13, 0x77, 0xe5, 0xe1,
+                      0x3a, 0x00, 0x90, 0x32, 0x01, 0x90, 0x10, 0xf1, 0xc3, 0x00, 0x01 ],
+
+    # ld ix,8000 / ld iy,a000 / ld b,0 / ld a,(ix+1) / add a,(iy+2) / ld (ix+3),a / inc (iy+4) / bit 0,(ix+5) /
+    # set 1,(iy+6) / inc ix / dec iy / djnz / jp 0100
+    'micro-ixiy': [ 0xdd, 0x21, 0x00, 0x80, 0xfd, 0x21, 0x00, 0xa0, 0x06, 0x00, 0xdd, 0x7e, 0x01, 0xfd, 0x86, 0x02,
+                    0xdd, 0x77, 0x03, 0xfd, 0x34, 0x04, 0xdd, 0xcb, 0x05, 0x46, 0xfd, 0xcb, 0x06, 0xce, 0xdd, 0x23,
+                    0xfd, 0x2b, 0x10, 0xe6, 0xc3, 0x00, 0x01 ],
+
+    # ld hl,8000 / ld de,c000 / ld bc,1000 / ldir / dec hl / dec de / ld bc,1000 / lddr / ld hl,8000 /
+    # ld bc,1000 / ld a,55 / cpir / jp 0100
+    'micro-block': [ 0x21, 0x00, 0x80, 0x11, 0x00, 0xc0, 0x01, 0x00, 0x10, 0xed, 0xb0, 0x2b, 0x1b, 0x01, 0x00, 0x10,
+                     0xed, 0xb8, 0x21, 0x00, 0x80, 0x01, 0x00, 0x10, 0x3e, 0x55, 0xed, 0xb1, 0xc3, 0x00, 0x01 ],
+}
+
+# T-states per workload (before --scale), passes over tests.in for 'fuse';
+# the block instructions run in bulk so they need a lot more to take a
+# measurable amount of time
+BUDGET = { 'zexdoc': 10000000, 'zexall': 10000000, 'micro': 5000000, 'micro-block': 250000000, 'fuse': 50, 'boot': 20 * FREQ_CLOCK }
+
+# workloads whose MHz is a T-state throughput of the bulk LDIR/LDDR/CPIR
+# paths: not comparable to the others
+BULK = { 'micro-block' }
+
+# the test programs and ROMs are looked for next to this script
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+class dummy_screen:
+    def interrupt(self):
+        pass
+
+    def IE0(self) -> bool:
+        return False
+
+def debug(x):
+    pass
+
+def ram_machine(program, block_cache: bool):
+    # 64kB of RAM via the bus, like in msx.py
+    mb = bus(debug)
+    mm = memmap(4, debug)
+
+    for p in range(0, 4):
+        mb.put_page(0, 0, p, mm)
+
+    for i, b in enumerate(program):
+        mb.write_mem(0x0100 + i, b)
+
+    mb.write_mem(0x0005, 0xc9)  # CP/M BDOS: just return
+
+    # top of the transient program area (zexdoc/zexall put their stack
+    # there), well away from the sub-slot register at 0xffff
+    mb.write_mem(0x0006, 0x00)
+    mb.write_mem(0x0007, 0xf0)
+
+    cpu = z80(mb.read_mem, mb.write_mem, lambda a: 0xff, lambda a, v: None, debug, dummy_screen())
+    cpu.enable_bulk_access(mb.get_span, None, None)
+
+    if block_cache:
+        cpu.enable_block_cache()
+
+    cpu.sp = 0xf000
+    cpu.pc = 0x0100
+
+    return cpu
+
+def run_budget(cpu, budget: int, size: int) -> None:
+    # 'size' bytes of program at 0x0100: measuring something that ran off
+    # into empty memory is pointless
+    frame = FREQ_CLOCK // FREQ_VDP_REFRESH
+    end = cpu.scheduler.now + budget
+
+    while cpu.scheduler.now < end:
+        cpu.run(min(frame, end - cpu.scheduler.now))
+
+        if (cpu.pc < 0x0100 or cpu.pc >= 0x0100 + size) and cpu.pc != 0x0005:
+            raise RuntimeError('program left at %04x' % cpu.pc)
+
+def boot_machine(bios_file: str, block_cache: bool):
+    from vdp import vdp
+
+    sched = scheduler()
+
+    mb = bus(debug)
+
+    bb = rom(bios_file, debug, 0x0000)
+    mb.put_page(0, 0, 0, bb)
+    mb.put_page(0, 0, 1, bb)
+
+    mm = memmap(4, debug)
+    for p in range(0, 4):
+        mb.put_page(3, 0, p, mm)
+
+    v = vdp(1, 1, 0, display=False)
+    v.scheduler = sched
+    v.kb = bytearray(b'\xff' * 16)  # nothing pressed
+
+    io_read = [ None ] * 256
+    io_write = [ None ] * 256
+
+    for port in (0x98, 0x99, 0xa9, 0xaa):
+        io_read[port] = v.read_io
+
+    for port in (0x98, 0x99, 0x9a, 0x9b, 0xaa):
+        io_write[port] = v.write_io
+
+    for port in range(0xfc, 0x100):
+        io_read[port] = mm.read_io
+        io_write[port] = lambda a, val: (mm.write_io(a, val), mb.rebuild())
+
+    io_read[0xa8] = mb.read_page_layout
+    io_write[0xa8] = mb.write_page_layout
+
+    def read_io(a: int) -> int:
+        return io_read[a](a) if io_read[a] else 0xff
+
+    def write_io(a: int, val: int) -> None:
+        if io_write[a]:
+            io_write[a](a, val)
+
+    cpu = z80(mb.read_mem, mb.write_mem, read_io, write_io, debug, v, sched)
+    cpu.enable_bulk_access(mb.get_span, None, None)
+
+    if block_cache:
+        cpu.enable_block_cache()
+        mb.layout_changed = lambda: cpu.blocks.set_config(layout_config(mb, mm))
+        mb.page_switched = lambda p: cpu.blocks.invalidate_range(p * 0x4000, p * 0x4000 + 0x3fff)
+        mb.layout_changed()
+
+    return cpu, v
+
+def basic_prompt(v) -> bool:
+    # 'Ok' in the name table of screen 0/1
+    name_table = (v.registers[2] & 0x0f) << 10
+
+    return b'Ok' in bytes(v.ram[name_table:name_table + 960])
+
+def run_boot(cpu, v, budget: int) -> None:
+    frame = FREQ_CLOCK // FREQ_VDP_REFRESH
+    end = cpu.scheduler.now + budget
+
+    while cpu.scheduler.now < end and not basic_prompt(v):
+        cpu.run(frame)
+
+def load_fuse_tests(file_name: str) -> list:
+    # see fuse-test.py for the format of tests.in
+    tests = [ ]
+
+    with open(file_name, 'r') as fh:
+        lines = [ l.split() for l in fh.read().splitlines() ]
+
+    i = 0
+
+    while i < len(lines):
+        if not lines[i]:
+            i += 1
+            continue
+
+        regs = [ int(x, 16) for x in lines[i + 1] ]
+        t_states = int(lines[i + 2][6])
+
+        mem = [ ]
+
+        i += 3
+
+        while lines[i] and lines[i][0] != '-1':
+            a = int(lines[i][0], 16)
+
+            for b in lines[i][1:-1]:
+                mem.append((a, int(b, 16)))
+                a = (a + 1) & 0xffff
+
+            i += 1
+
+        i += 1
+
+        tests.append((regs, t_states, mem))
+
+    return tests
+
+def run_fuse(cpu, tests: list, passes: int) -> None:
+    for regs, t_states, mem in tests * passes:
+        cpu.reset()
+
+        (cpu.a, cpu.f) = cpu.u16(regs[0])
+        (cpu.b, cpu.c) = cpu.u16(regs[1])
+        (cpu.d, cpu.e) = cpu.u16(regs[2])
+        (cpu.h, cpu.l) = cpu.u16(regs[3])
+        (cpu.a_, cpu.f_) = cpu.u16(regs[4])
+        (cpu.b_, cpu.c_) = cpu.u16(regs[5])
+        (cpu.d_, cpu.e_) = cpu.u16(regs[6])
+        (cpu.h_, cpu.l_) = cpu.u16(regs[7])
+        cpu.ix = regs[8]
+        cpu.iy = regs[9]
+        cpu.sp = regs[10]
+        cpu.pc = regs[11]
+        cpu.memptr = regs[12]
+
+        for a, b in mem:
+            cpu.write_mem(a, b)
+
+        t = 0
+
+        try:
+            while t < t_states:
+                t += cpu.step()
+
+        except AssertionError:  # not implemented (yet)
+            pass
+
+def count_instructions(make, run) -> int:
+    # a separate, untimed pass with a counting dispatch table: the
+    # workloads are deterministic
+    cpu = make()
+
+    n = [ 0 ]
+
+    def counted(handler):
+        def count(instr: int) -> int:
+            n[0] += 1
+            return handler(instr)
+
+        return count
+
+    cpu.instrument(counted)
+
+    run(cpu)
+
+    return n[0]
+
+def workloads(options):
+    scale = float(options.scale)
+    bc = options.block_cache
+
+    out = [ ]
+
+    for name in ('zexdoc', 'zexall'):
+        file_name = os.path.join(DIR, name + '.com')
+
+        if not os.path.exists(file_name):
+            print('%s: %s not found, skipped' % (name, file_name))
+            continue
+
+        with open(file_name, 'rb') as fh:
+            program = fh.read()
+
+        budget = int(BUDGET[name] * scale)
+
+        out.append((name, lambda program=program: ram_machine(program, bc), lambda cpu, budget=budget, size=len(program): run_budget(cpu, budget, size)))
+
+    file_name = os.path.join(DIR, 'tests.in')
+
+    if os.path.exists(file_name):
+        # single stepped like fuse-test.py does
+        tests = load_fuse_tests(file_name)
+        passes = max(1, int(BUDGET['fuse'] * scale))
+
+        out.append(('fuse', lambda: ram_machine([ ], bc), lambda cpu: run_fuse(cpu, tests, passes)))
+
+    else:
+        print('fuse: %s not found, skipped' % file_name)
+
+    for name, program in MICRO.items():
+        budget = int(BUDGET.get(name, BUDGET['micro']) * scale)
+
+        out.append((name, lambda program=program: ram_machine(program, bc), lambda cpu, budget=budget, size=len(program): run_budget(cpu, budget, size)))
+
+    bios = options.bios
+
+    if bios and not os.path.exists(bios) and not os.path.isabs(bios):
+        bios = os.path.join(DIR, bios)
+
+    if not bios or not os.path.exists(bios):
+        print('boot: %s not found, skipped' % options.bios)
+
+    else:
+        budget = int(BUDGET['boot'] * scale)
+
+        # a BIOS boot is not scaled down below the point where it reaches
+        # the prompt: the budget is only an upper limit
+        boot = [ None ]
+
+        def make_boot():
+            cpu, v = boot_machine(bios, bc)
+            boot[0] = v
+            return cpu
+
+        out.append(('boot', make_boot, lambda cpu, budget=budget: run_boot(cpu, boot[0], budget)))
+
+    return out
+
+def machine_info():
+    info = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+    try:
+        info['revision'] = subprocess.check_output([ 'git', 'rev-parse', 'HEAD' ], stderr=subprocess.DEVNULL).decode().strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return info
+
+def bench(options):
+    results = dict()
+
+    selected = options.workload.split(',') if options.workload else None
+
+    for name, make, run in workloads(options):
+        if selected and not any([ name.startswith(s) for s in selected ]):
+            continue
+
+        best = None
+
+        for i in range(0, int(options.repeat)):
+            cpu = make()
+
+            start_t = cpu.scheduler.now
+            start = time.perf_counter()
+
+            run(cpu)
+
+            took = time.perf_counter() - start
+            t_states = cpu.scheduler.now - start_t
+
+            if best is None or took < best[0]:
+                best = (took, t_states)
+
+        took, t_states = best
+
+        instructions = count_instructions(make, run)
+
+        results[name] = {
+            'host_seconds': took,
+            't_states': t_states,
+            'instructions': instructions,
+            'mhz': t_states / took / 1000000,
+            'instructions_per_second': instructions / took,
+            'real_time_factor': t_states / FREQ_CLOCK / took,
+            'bulk': name in BULK,
+        }
+
+        print('%-14s %8.3fs %11d T-states %6.3f MHz %10.0f instr/s %6.1f%% of real time%s' % (name, took, t_states, results[name]['mhz'], results[name]['instructions_per_second'], results[name]['real_time_factor'] * 100, ' (bulk T-state throughput)' if name in BULK else ''), flush=True)
+
+    return results
+
+def compare(results, baseline_file: str, tolerance: float, selected) -> bool:
+    with open(baseline_file, 'r') as fh:
+        baseline = json.load(fh)['results']
+
+    ok = True
+
+    print()
+    print('%-14s %10s %10s %8s' % ('workload', 'baseline', 'now', 'change'))
+
+    for name in baseline:
+        if name not in results and (not selected or any([ name.startswith(s) for s in selected ])):
+            print('%-14s %10.3f %10s   MISSING' % (name, baseline[name]['mhz'], '-'))
+            ok = False
+
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+
+        old = baseline[name]['mhz']
+        new = r['mhz']
+
+        change = (new - old) * 100 / old
+
+        regression = change < -tolerance
+
+        ok &= not regression
+
+        print('%-14s %10.3f %10.3f %+7.1f%%%s' % (name, old, new, change, '  REGRESSION' if regression else ''))
+
+        if r['t_states'] != baseline[name]['t_states'] and name != 'boot':
+            print('%-14s T-states differ: %d -> %d' % ('', baseline[name]['t_states'], r['t_states']))
+
+    return ok
+
+parser = OptionParser()
+parser.add_option('-w', '--workload', dest='workload', help='only run workloads starting with these names (comma separated), e.g. zexdoc,micro')
+parser.add_option('-s', '--scale', dest='scale', default='1', help='scale the T-state budgets (e.g. 0.1 for a quick run)')
+parser.add_option('-r', '--repeat', dest='repeat', default='1', help='run each workload this many times, the fastest counts')
+parser.add_option('-b', '--bios', dest='bios', default='msxbiosbasic.rom', help='BIOS/BASIC ROM for the boot workload')
+parser.add_option('-X', '--block-cache', action='store_true', dest='block_cache', help='use the block cache')
+parser.add_option('-o', '--output', dest='output', help='write the results to this JSON file')
+parser.add_option('-c', '--compare', dest='compare', help='compare against this JSON file (from -o)')
+parser.add_option('-t', '--tolerance', dest='tolerance', default='5', help='percentage the speed may drop before it is a regression')
+(options, args) = parser.parse_args()
+
+results = bench(options)
+
+if options.output:
+    with open(options.output, 'w') as fh:
+        json.dump({ 'machine': machine_info(), 'options': { 'scale': float(options.scale), 'repeat': int(options.repeat), 'block_cache': bool(options.block_cache) }, 'results': results }, fh, indent=4)
+
+if options.compare and not compare(results, options.compare, float(options.tolerance), options.workload.split(',') if options.workload else None):
+    sys.exit(1)
@@ -0,0 +1,442 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# Translates runs of Z80 instructions (up to and including the next branch)
+# into a single generated Python function that calls the instruction
+# handlers directly, skipping the fetch/decode/dispatch of z80.step().
+#
+# Blocks are looked up by PC per slot layout, but which bytes they were
+# translated from is kept per piece of memory (a RAM page, a ROM image;
+# see bus.get_span): a write drops every block that was translated from
+# the written byte, whichever address and slot layout it went through.
+# Code that is not in plain memory (memory mapped devices, or no bus) is
+# tracked by CPU address.
+
+from typing import Callable, Dict, List, Set, Tuple
+
+# unprefixed opcodes with a one byte operand
+LEN2 = { 0x06, 0x0e, 0x10, 0x16, 0x18, 0x1e, 0x20, 0x26, 0x28, 0x2e, 0x30, 0x36, 0x38, 0x3e,
+         0xc6, 0xce, 0xd3, 0xd6, 0xdb, 0xde, 0xe6, 0xee, 0xf6, 0xfe }
+
+# unprefixed opcodes with a two byte operand
+LEN3 = { 0x01, 0x11, 0x21, 0x22, 0x2a, 0x31, 0x32, 0x3a,
+         0xc2, 0xc3, 0xc4, 0xca, 0xcc, 0xcd, 0xd2, 0xd4, 0xda, 0xdc,
+         0xe2, 0xe4, 0xea, 0xec, 0xf2, 0xf4, 0xfa, 0xfc }
+
+# unprefixed opcodes that (may) change the program counter or the interrupt state
+BRANCH = { 0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0x76, 0xc3, 0xc9, 0xcd, 0xe9, 0xf3, 0xfb } | \
+         { 0xc0 + i * 8 for i in range(8) } | \
+         { 0xc2 + i * 8 for i in range(8) } | \
+         { 0xc4 + i * 8 for i in range(8) } | \
+         { 0xc7 + i * 8 for i in range(8) }
+
+# unprefixed opcodes that cannot write to memory or do I/O
+PURE = (set(range(0x40, 0x70)) | { 0x78, 0x79, 0x7a, 0x7b, 0x7c, 0x7d, 0x7e, 0x7f } | set(range(0x80, 0xc0)) |
+        { 0x00, 0x01, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e, 0x0f,
+          0x11, 0x13, 0x14, 0x15, 0x16, 0x17, 0x19, 0x1a, 0x1b, 0x1c, 0x1d, 0x1e, 0x1f,
+          0x21, 0x23, 0x24, 0x25, 0x26, 0x27, 0x29, 0x2a, 0x2b, 0x2c, 0x2d, 0x2e, 0x2f,
+          0x31, 0x33, 0x37, 0x39, 0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f,
+          0xc1, 0xd1, 0xe1, 0xf1, 0xc6, 0xce, 0xd6, 0xde, 0xe6, 0xee, 0xf6, 0xfe,
+          0xd9, 0xeb, 0xf9 }) - { 0x70, 0x71, 0x72, 0x73, 0x74, 0x75, 0x77 }
+
+# opcodes in PURE that read memory: through HL, BC, DE or SP, or at the
+# address in their operand
+READ_POINTER = { 0x0a, 0x1a, 0x46, 0x4e, 0x56, 0x5e, 0x66, 0x6e, 0x7e, 0xc1, 0xd1, 0xe1, 0xf1 } | \
+               { 0x86 + i * 8 for i in range(8) }
+READ_OPERAND = { 0x2a, 0x3a }
+
+# register pairs as numbered in opcodes (BC, DE, HL, SP)
+PAIRS = ( 'bc', 'de', 'hl', 'sp' )
+
+# ED opcodes with a two byte operand
+ED_LEN4 = { 0x43, 0x4b, 0x53, 0x5b, 0x63, 0x6b, 0x73, 0x7b }
+
+# ED opcodes that change the program counter (RETN/RETI, repeating block instructions)
+ED_BRANCH = { 0x45, 0x4d, 0x55, 0x5d, 0x65, 0x6d, 0x75, 0x7d, 0xb0, 0xb1, 0xb2, 0xb3, 0xb8, 0xb9 }
+
+# DD/FD opcodes that have an (IX+d) displacement byte
+IXY_DISP = { 0x34, 0x35, 0x36, 0x46, 0x4e, 0x56, 0x5e, 0x66, 0x6e, 0x70, 0x71, 0x72, 0x73, 0x74, 0x75, 0x77, 0x7e,
+             0x86, 0x8e, 0x96, 0x9e, 0xa6, 0xae, 0xb6, 0xbe }
+
+def layout_config(mb, mm) -> int:
+    # what is visible in the address space, as far as translated code goes:
+    # primary slots, sub-slots and the memory mapper pages (for set_config)
+    config = mb.read_page_layout(0)
+
+    for i in range(0, 4):
+        config |= mb.subslot[i] << (8 + i * 8)
+        config |= mm.mapper[i] << (40 + i * 8)
+
+    return config
+
+class blockcache:
+    MAX_INSTRUCTIONS = 32
+    MAX_CODE = 4096
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        # one dictionary of pc -> translated block per slot layout
+        self.configs: Dict[int, Dict[int, Callable[[], int]]] = dict()
+        self.config: int = 0
+        self.blocks: Dict[int, Callable[[], int]] = self.configs.setdefault(self.config, dict())
+
+        # which (config, first address, last address) blocks were
+        # translated from each 256 byte region of the address space (for
+        # bank switches)
+        self.regions: List[Set[Tuple[int, int, int]]] = [ set() for i in range(256) ]
+
+        # per piece of memory: [ memory, which bytes are code, per 256 byte
+        # region the (config, pc, first index, last index) of the blocks
+        # translated from it ]
+        self.memories: Dict[int, list] = dict()
+        self.unmapped: list = [ None, bytearray(65536), dict() ]
+
+        # per CPU page: (memory as above, index of the page start in it,
+        # last address that is in it)
+        self.pages: List[tuple] = [ None ] * 4
+        # the above per slot layout, so that switching back and forth (as
+        # the BIOS does all the time) needs no remap()
+        self.maps: Dict[int, List[tuple]] = dict()
+        self.remap()
+
+        # bumped when the block that is running (current) is dropped or the
+        # slot layout changes, so that it can bail out: only then, to keep
+        # where blocks start (and so where interrupts are taken)
+        # independent of what happens to be in the cache
+        self.generation: int = 0
+        self.current: Callable[[], int] = None
+
+        # compiled blocks by their source: the handlers read the operands
+        # from memory, so code that only modifies those (a common trick)
+        # gets the same source again and needs no new compile()
+        self.code: Dict[str, object] = dict()
+
+        self.org_write_mem = cpu.write_mem
+
+    def remap(self) -> None:
+        # to be invoked when what is visible in the address space changed
+        self.maps = dict()
+        self.map_pages()
+
+    def map_pages(self) -> None:
+        # fill in self.pages for the current slot layout
+        get_span = self.cpu.get_span
+
+        self.pages = [ None ] * 4
+        self.maps[self.config] = self.pages
+
+        for page in range(0, 4):
+            start = page * 0x4000
+
+            s = get_span(start, False) if get_span else None
+
+            if s is None:
+                self.pages[page] = (self.unmapped, 0, start + 0x3fff)
+
+            else:
+                mem, i, first, last = s
+
+                memory = self.memories.get(id(mem))
+
+                if memory is None or memory[0] is not mem:
+                    memory = [ mem, bytearray(len(mem)), dict() ]
+                    self.memories[id(mem)] = memory
+
+                self.pages[page] = (memory, i - start, last)
+
+    def write_mem(self, a: int, v: int) -> None:
+        memory, offset, last = self.pages[a >> 14]
+
+        if a > last:
+            memory = self.unmapped
+            offset = 0
+
+        if memory[1][a + offset]:
+            self.drop(memory, a + offset, a + offset)
+
+        self.org_write_mem(a, v)
+
+    def drop(self, memory: list, low: int, high: int) -> None:
+        # drop the blocks translated from index low...high of 'memory'
+        regions = memory[2]
+
+        for r in range(low >> 8, (high >> 8) + 1):
+            blocks = regions.get(r)
+
+            if not blocks:
+                continue
+
+            keep = [ ]
+
+            for block in blocks:
+                config, pc, first, last = block
+
+                if first <= high and last >= low:
+                    self.drop_block(config, pc)
+
+                else:
+                    keep.append(block)
+
+            regions[r] = keep
+
+    def drop_block(self, config: int, pc: int) -> None:
+        # a block that is running stops after its next instruction that
+        # is not pure (see translate)
+        if self.configs[config].pop(pc, None) is self.current:
+            self.generation += 1
+
+    def invalidate_range(self, start: int, end: int) -> None:
+        # drop all blocks (of all slot layouts) that touch start...end of
+        # the address space, e.g. after a bank switch
+        for r in range(start >> 8, (end >> 8) + 1):
+            for config, first, last in self.regions[r]:
+                self.drop_block(config, first)
+
+            self.regions[r] = set()
+
+        self.remap()
+
+    def written(self, start: int, end: int) -> None:
+        # memory start...end was written without going through write_mem
+        # (bulk copies)
+        a = start
+
+        while a <= end:
+            memory, offset, last = self.pages[a >> 14]
+
+            if a > last:
+                memory = self.unmapped
+                offset = 0
+                last = a | 0x3fff
+
+            high = min(end, last)
+
+            if any(memory[1][a + offset:high + offset + 1]):
+                self.drop(memory, a + offset, high + offset)
+
+            a = high + 1
+
+    def flush(self) -> None:
+        self.configs = dict()
+        self.blocks = self.configs.setdefault(self.config, dict())
+
+        self.regions = [ set() for i in range(256) ]
+
+        self.memories = dict()
+        self.unmapped = [ None, bytearray(65536), dict() ]
+        self.remap()
+
+        self.generation += 1
+
+    def set_config(self, config: int) -> None:
+        if config != self.config:
+            self.config = config
+            self.blocks = self.configs.setdefault(config, dict())
+
+            self.generation += 1
+
+            pages = self.maps.get(config)
+
+            if pages is None:
+                self.map_pages()
+
+            else:
+                self.pages = pages
+
+    def lookup(self, pc: int) -> Callable[[], int]:
+        block = self.blocks.get(pc)
+
+        if block is None:
+            block = self.translate(pc)
+
+        self.current = block
+
+        return block
+
+    def decode(self, a: int) -> Tuple[str, str, int, bool, bool]:
+        # returns (handler name, call arguments, instruction length, is branch, is pure)
+        # or None when the instruction is not translated
+        read_mem = self.cpu.read_mem
+
+        op = read_mem(a)
+
+        if op == 0xcb:
+            op2 = read_mem((a + 1) & 0xffff)
+            pure = op2 >= 0x40 and op2 < 0x80 or (op2 & 7) != 6
+
+            return ('b%02x' % op2, '0x%02x' % op2, 2, False, pure)
+
+        if op == 0xed:
+            op2 = read_mem((a + 1) & 0xffff)
+
+            if self.cpu.ed_jumps[op2] is None:
+                return None
+
+            length = 4 if op2 in ED_LEN4 else 2
+
+            return ('e%02x' % op2, '0x%02x' % op2, length, op2 in ED_BRANCH, False)
+
+        if op == 0xdd or op == 0xfd:
+            op2 = read_mem((a + 1) & 0xffff)
+            is_ix = 'True' if op == 0xdd else 'False'
+
+            if op2 in (0xdd, 0xed, 0xfd) or self.cpu.ixy_jumps[op2] is None:
+                return None
+
+            if op2 == 0xcb:
+                return ('ixy_bit', '0xcb, %s' % is_ix, 4, False, False)
+
+            length = 2
+            if op2 in LEN2:
+                length += 1
+            elif op2 in LEN3:
+                length += 2
+            if op2 in IXY_DISP:
+                length += 1
+
+            return ('x%02x' % op2, '0x%02x, %s' % (op2, is_ix), length, op2 in BRANCH, op2 in PURE and op2 not in IXY_DISP)
+
+        length = 1
+        if op in LEN2:
+            length = 2
+        elif op in LEN3:
+            length = 3
+
+        return ('m%02x' % op, '0x%02x' % op, length, op in BRANCH, op in PURE)
+
+    def translate(self, pc: int) -> Callable[[], int]:
+        cpu = self.cpu
+
+        namespace = { 'cpu': cpu, 'cache': self, 'ixy_bit': cpu.ixy_bit }
+
+        src = [ 'def block():', '    cycles = 0', '    generation = cache.generation' ]
+
+        a = pc
+        n = 0
+
+        # what cpu.pc is at this point of the block (None: don't know).
+        # the handlers of one byte opcodes and of CB opcodes neither read
+        # nor change it, so it only needs to be set for the others and
+        # where the block can be left
+        known = None
+
+        while n < blockcache.MAX_INSTRUCTIONS:
+            d = self.decode(a)
+            if d is None:
+                break
+
+            name, args, length, branch, pure = d
+
+            if name[0] == 'm':
+                namespace[name] = cpu.main_jumps[int(name[1:], 16)]
+                skip = length == 1 and not branch
+                after_prefix = (a + 1) & 0xffff
+
+            else:
+                if name[0] == 'b':
+                    namespace[name] = cpu.bits_jumps[int(name[1:], 16)]
+                elif name[0] == 'e':
+                    namespace[name] = cpu.ed_jumps[int(name[1:], 16)]
+                elif name[0] == 'x':
+                    namespace[name] = cpu.ixy_jumps[int(name[1:], 16)]
+
+                skip = name[0] == 'b'
+                after_prefix = (a + 2) & 0xffff
+
+            if not skip and known != after_prefix:
+                src.append('    cpu.pc = 0x%04x' % after_prefix)
+
+            src.append('    cycles += %s(%s)' % (name, args))
+
+            a = (a + length) & 0xffff
+            n += 1
+
+            if branch:
+                break
+
+            if not skip:
+                known = a
+
+            if not pure:
+                src.append('    if cache.generation != generation:')
+
+                if known != a:
+                    src.append('        cpu.pc = 0x%04x' % a)
+
+                src.append('        return cycles')
+
+        if n == 0:
+            # not translatable, let the interpreter do it
+            block = self.interpret
+            a = (pc + 1) & 0xffff
+
+        else:
+            if not branch and known != a:
+                src.append('    cpu.pc = 0x%04x' % a)
+
+            src.append('    return cycles')
+
+            text = '\n'.join(src)
+            code = self.code.get(text)
+
+            if code is None:
+                if len(self.code) >= blockcache.MAX_CODE:
+                    self.code.clear()
+
+                code = compile(text, '<block %04x>' % pc, 'exec')
+                self.code[text] = code
+
+            exec(code, namespace)
+
+            block = namespace['block']
+
+        self.blocks[pc] = block
+
+        last = (a - 1) & 0xffff
+        entry = (self.config, pc, last)
+
+        r = pc >> 8
+        while True:
+            self.regions[r].add(entry)
+
+            if r == last >> 8:
+                break
+
+            r = (r + 1) & 0xff
+
+        # mark the bytes the block was read from as code, per piece of
+        # memory (a block can span pages or wrap around)
+        b = pc
+        left = ((last - pc) & 0xffff) + 1
+
+        while left:
+            memory, offset, page_last = self.pages[b >> 14]
+
+            if b > page_last:
+                memory = self.unmapped
+                offset = 0
+                page_last = b | 0x3fff
+
+            count = min(left, page_last - b + 1)
+            first = b + offset
+            high = first + count - 1
+
+            memory[1][first:high + 1] = b'\x01' * count
+
+            entry = (self.config, pc, first, high)
+
+            for r in range(first >> 8, (high >> 8) + 1):
+                memory[2].setdefault(r, [ ]).append(entry)
+
+            b = (b + count) & 0xffff
+            left -= count
+
+        return block
+
+    def interpret(self) -> int:
+        cpu = self.cpu
+
+        instr = cpu.read_pc_inc()
+
+        return cpu.main_jumps[instr](instr)
@@ -0,0 +1,217 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from typing import Callable, List
+
+# The MSX memory bus: primary slots (port 0xa8), sub-slots (0xffff) and
+# the devices plugged into them.
+#
+# For each of the 4 pages of 16kB a table entry is kept with the memory
+# that is visible in it. Reads and writes below 'rd_io'/'wr_io' of a page
+# index that memory directly, anything from there on (memory mapped I/O,
+# ROM bank switching registers, devices that do not expose their memory)
+# goes to the device its read_mem/write_mem.
+#
+# Devices can expose memory via get_page_mem(page) which returns a tuple:
+# (memory, index in memory of the first byte of the page, offset in the
+# page where memory mapped I/O starts (0x4000 if none), writable). When it
+# returns None or is not implemented, all accesses go through the device.
+#
+# The table is rebuilt when the slot layout changes and after every write
+# that went to a device (which may have switched a bank).
+
+class bus:
+    def __init__(self, debug):
+        self.debug = debug
+
+        self.slots = [[[None for k in range(4)] for j in range(4)] for i in range(4)]
+
+        self.subslot: List[int] = [ 0x00, 0x00, 0x00, 0x00 ]
+        self.has_subslots: List[bool] = [ False, False, False, False ]
+
+        self.slot_for_page: List[int] = [ 0, 0, 0, 0 ]
+
+        self.dev = [ None ] * 4
+        self.rd_mem = [ None ] * 4
+        self.rd_off: List[int] = [ 0 ] * 4
+        self.rd_io: List[int] = [ 0 ] * 4
+        self.wr_io: List[int] = [ 0 ] * 4
+
+        # invoked after the layout changed (slots, sub-slots, mapper)
+        self.layout_changed: Callable[[], None] = None
+
+        # invoked with the page number when a write to a device changed
+        # what is visible in that page (e.g. a ROM bank switch)
+        self.page_switched: Callable[[int], None] = None
+
+        self.rebuild()
+
+    def put_page(self, slot: int, subslot: int, page: int, obj) -> None:
+        self.has_subslots[slot] |= subslot > 0
+
+        self.slots[slot][subslot][page] = obj
+
+        self.rebuild()
+
+    def get_page(self, slot: int, subslot: int, page: int):
+        return self.slots[slot][subslot][page]
+
+    def get_subslot_for_page(self, slot: int, page: int) -> int:
+        if self.has_subslots[slot]:
+            return (self.subslot[slot] >> (page * 2)) & 3
+
+        return 0
+
+    def get_device(self, page: int):
+        slot = self.slot_for_page[page]
+
+        return self.slots[slot][self.get_subslot_for_page(slot, page)][page]
+
+    def get_window(self, page: int):
+        dev = self.dev[page]
+
+        if dev is None or not hasattr(dev, 'get_page_mem'):
+            return None
+
+        return dev.get_page_mem(page)
+
+    def rebuild_page(self, page: int) -> None:
+        self.dev[page] = self.get_device(page)
+
+        start = page * 0x4000
+
+        w = self.get_window(page)
+
+        if w is None:
+            self.rd_mem[page] = None
+            self.rd_off[page] = 0
+            self.rd_io[page] = start
+            self.wr_io[page] = start
+
+        else:
+            mem, index, mmio, writable = w
+
+            self.rd_mem[page] = mem
+            self.rd_off[page] = index - start
+            self.rd_io[page] = start + mmio
+            self.wr_io[page] = start + mmio if writable else start
+
+        if page == 3:
+            # the sub-slot register
+            self.rd_io[3] = min(self.rd_io[3], 0xffff)
+            self.wr_io[3] = min(self.wr_io[3], 0xffff)
+
+    def rebuild(self) -> None:
+        for page in range(0, 4):
+            self.rebuild_page(page)
+
+        if self.layout_changed:
+            self.layout_changed()
+
+    def get_state(self) -> dict:
+        return { 'slot_for_page': list(self.slot_for_page), 'subslot': list(self.subslot) }
+
+    def set_state(self, state: dict) -> None:
+        # after the devices: their memory windows may have changed
+        self.slot_for_page = list(state['slot_for_page'])
+        self.subslot = list(state['subslot'])
+
+        self.rebuild()
+
+    def read_mem(self, a: int) -> int:
+        page = a >> 14
+
+        if a >= self.rd_io[page]:
+            return self.mmio_read(a)
+
+        return self.rd_mem[page][a + self.rd_off[page]]
+
+    def write_mem(self, a: int, v: int) -> None:
+        page = a >> 14
+
+        if a >= self.wr_io[page]:
+            self.mmio_write(a, v)
+
+        else:
+            self.rd_mem[page][a + self.rd_off[page]] = v
+
+    def peek(self, a: int) -> int:
+        # read without side effects (tracing): memory mapped I/O reads as 0xff
+        page = a >> 14
+
+        if a >= self.rd_io[page]:
+            return 0xff
+
+        return self.rd_mem[page][a + self.rd_off[page]]
+
+    def get_span(self, a: int, write: bool):
+        # for bulk transfers (LDIR etc): the plain memory 'a' is in as
+        # (memory, index of 'a' in it, first address, last address), or
+        # None when 'a' goes to a device
+        page = a >> 14
+
+        end = self.wr_io[page] if write else self.rd_io[page]
+
+        if a >= end:
+            return None
+
+        return (self.rd_mem[page], a + self.rd_off[page], page * 0x4000, end - 1)
+
+    def mmio_read(self, a: int) -> int:
+        page = a >> 14
+
+        dev = self.dev[page]
+
+        if a == 0xffff:
+            if self.has_subslots[self.slot_for_page[3]]:
+                return self.subslot[self.slot_for_page[3]] ^ 0xff
+
+            if dev:
+                return 0 ^ 0xff
+
+        if dev == None:
+            return 0xee
+
+        return dev.read_mem(a)
+
+    def mmio_write(self, a: int, v: int) -> None:
+        if a == 0xffff:
+            if self.has_subslots[self.slot_for_page[3]]:
+                self.debug('Setting sub-page layout to %02x' % v)
+                self.subslot[self.slot_for_page[3]] = v
+                self.rebuild()
+                return
+
+        page = a >> 14
+
+        dev = self.dev[page]
+
+        if dev == None:
+            self.debug('Writing %02x to %04x which is not backed by anything (slot: %02x, subslot: %02x)' % (v, a, self.read_page_layout(0), self.subslot[self.slot_for_page[3]]))
+            return
+
+        dev.write_mem(a, v)
+
+        # the write may have switched a bank: re-fetch the window of all
+        # pages where this device is visible
+        for p in range(0, 4):
+            if self.dev[p] is dev:
+                old_mem = self.rd_mem[p]
+                old = (self.rd_off[p], self.rd_io[p], self.wr_io[p])
+
+                self.rebuild_page(p)
+
+                # no window: can't tell, assume it switched
+                changed = old_mem is None or old_mem is not self.rd_mem[p] or old != (self.rd_off[p], self.rd_io[p], self.wr_io[p])
+
+                if changed and self.page_switched:
+                    self.page_switched(p)
+
+    def read_page_layout(self, a: int) -> int:
+        return (self.slot_for_page[3] << 6) | (self.slot_for_page[2] << 4) | (self.slot_for_page[1] << 2) | self.slot_for_page[0]
+
+    def write_page_layout(self, a: int, v: int) -> None:
+        for i in range(0, 4):
+            self.slot_for_page[i] = (v >> (i * 2)) & 3
+
+        self.rebuild()
@@ -5,6 +5,7 @@ import struct
 import sys
 from enum import Enum, IntFlag, IntEnum
 from typing import List
+from romimage import load_rom_image
 
 class disk:
     class T1(IntFlag):
@@ -55,9 +56,7 @@ class disk:
     def __init__(self, disk_rom_file: str, debug, disk_image_file: str):
         print('Loading disk rom %s...' % disk_rom_file, file=sys.stderr)
 
-        fh = open(disk_rom_file, 'rb')
-        self.rom = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.rom = load_rom_image(disk_rom_file)
 
         self.fh = open(disk_image_file, 'ab+')
 
@@ -89,6 +88,27 @@ class disk:
         self.debug('file offset side %d track %d sector %d: %d' % (side, track, sector, o))
         return o
 
+    def get_page_mem(self, page: int):
+        # 0x7ff0...0x7fff are the FDC registers
+        return (self.rom, 0, 0x3ff0, False)
+
+    def get_state(self) -> dict:
+        # the disk image itself is not part of it: it is written through
+        return { 'regs': list(self.regs), 'buffer': bytes(self.buffer), 'bufp': self.bufp, 'bmode': self.bmode.value,
+                 'need_flush': self.need_flush, 'tc': self.tc, 'flags': int(self.flags), 'step_dir': self.step_dir,
+                 'track': self.track }
+
+    def set_state(self, state: dict) -> None:
+        self.regs = list(state['regs'])
+        self.buffer = list(state['buffer'])
+        self.bufp = state['bufp']
+        self.bmode = disk.BufMode(state['bmode'])
+        self.need_flush = state['need_flush']
+        self.tc = state['tc']
+        self.flags = state['flags']
+        self.step_dir = state['step_dir']
+        self.track = state['track']
+
     def write_mem(self, a: int, v: int) -> None:
         assert a >= 0x4000
         assert v >= 0 and v < 256
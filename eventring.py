@@ -0,0 +1,91 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import struct
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+# Register writes of the sound chips, timestamped in T-states, on their
+# way from the emulator to the audio process. The emulator collects them
+# with put() and copies them in one go to a ring buffer in shared memory
+# with flush() (once per frame). The audio process takes them out with
+# get(). There's one writer and one reader: each only moves its own
+# position.
+
+# T-state, type, register, value
+RECORD = struct.Struct('<QBBHxxxx')
+
+# header: write position, read position (in records, never wrap)
+HEADER_SIZE = 16
+
+class eventring:
+    def __init__(self, n_records: int = 65536):
+        # to be created before forking the reader
+        self.n_records = n_records
+
+        size = HEADER_SIZE + n_records * RECORD.size
+
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+        self.positions = self.shm.buf[0:HEADER_SIZE].cast('Q')
+        self.data = self.shm.buf[HEADER_SIZE:size]
+
+        self.batch = bytearray()
+        self.dropped: int = 0
+
+    def put(self, t: int, type_: int, a: int, v: int) -> None:
+        self.batch += RECORD.pack(t, type_, a, v)
+
+    def flush(self) -> None:
+        n = len(self.batch) // RECORD.size
+
+        if n == 0:
+            return
+
+        w = self.positions[0]
+
+        if w + n - self.positions[1] > self.n_records:
+            # the reader is not keeping up (or gone)
+            self.dropped += n
+            self.batch = bytearray()
+            return
+
+        o = (w % self.n_records) * RECORD.size
+        first = min(len(self.batch), len(self.data) - o)
+
+        self.data[o:o + first] = self.batch[0:first]
+        self.data[0:len(self.batch) - first] = self.batch[first:]
+
+        # only now the records become visible to the reader
+        self.positions[0] = w + n
+
+        self.batch = bytearray()
+
+    def get(self) -> List[Tuple[int, int, int, int]]:
+        r = self.positions[1]
+        w = self.positions[0]
+
+        if r == w:
+            return [ ]
+
+        o = (r % self.n_records) * RECORD.size
+        end = o + (w - r) * RECORD.size
+
+        if end <= len(self.data):
+            data = bytes(self.data[o:end])
+
+        else:
+            data = bytes(self.data[o:]) + bytes(self.data[0:end - len(self.data)])
+
+        self.positions[1] = w
+
+        return list(RECORD.iter_unpack(data))
+
+    def close(self, unlink: bool) -> None:
+        self.positions.release()
+        self.data.release()
+
+        self.shm.close()
+
+        if unlink:
+            self.shm.unlink()
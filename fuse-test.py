@@ -3,117 +3,17 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import hashlib
+import multiprocessing
+import os
+import pickle
 import sys
+import time
 import traceback
-from inspect import getframeinfo, stack
+from optparse import OptionParser
 from z80 import z80
 from screen_kb_dummy import screen_kb_dummy
 
-io = [ 0 ] * 256
-
-ram0 = [ 0 ] * 16384
-ram1 = [ 0 ] * 16384
-ram2 = [ 0 ] * 16384
-ram3 = [ 0 ] * 16384
-
-slots = [ ] # slots
-slots.append(( ram0, None, None, None ))
-slots.append(( ram1, None, None, None ))
-slots.append(( ram2, None, None, None ))
-slots.append(( ram3, None, None, None ))
-
-pages = [ 0, 0, 0, 0]
-
-final = { }
-
-def reset_mem():
-    ram0 = [ 0 ] * 16384
-    ram1 = [ 0 ] * 16384
-    ram2 = [ 0 ] * 16384
-    ram3 = [ 0 ] * 16384
-
-def read_mem(a):
-    page = a >> 14
-
-    if slots[page][pages[page]] == None:
-        return 0xee
-
-    return slots[page][pages[page]][a & 0x3fff]
-
-def write_mem(a, v):
-    global subpage
-
-    page = a >> 14
-
-    if slots[page][pages[page]] == None:
-        return
-
-    slots[page][pages[page]][a & 0x3fff] = v
-
-def read_io(a):
-    return io[a]
- 
-def write_io(a, v):
-    io[a] = v
-
-debug_msgs = []
-
-def debug(x):
-    debug_msgs.append(x)
-
-def flag_str(f):
-    flags = ''
-
-    flags += 's1 ' if f & 128 else 's0 '
-    flags += 'z1 ' if f & 64 else 'z0 '
-    flags += '51 ' if f & 32 else '50 '
-    flags += 'h1 ' if f & 16 else 'h0 '
-    flags += '31 ' if f & 8 else '30 '
-    flags += 'P1 ' if f & 4 else 'P0 '
-    flags += 'n1 ' if f & 2 else 'n0 '
-    flags += 'c1 ' if f & 1 else 'c0 '
-
-    return flags
-
-def my_assert(f, r, what):
-    if not r:
-        print(' *** FAIL FOR %s (%s) ***' % (f['id'], what))
-        print('==========================')
-        print('CURRENT')
-        print('-------')
-        print(cpu.reg_str())
-        caller = getframeinfo(stack()[1][0])
-        print('Flags: %s' % flag_str(cpu.f))
-        print('%s:%d' % (caller.filename, caller.lineno))
-        print('t-states: %d' % cpu.interrupt_cycles)
-        print('')
-        print('EXPECTED')
-        print('--------')
-        print('Flags: %s' % flag_str(f['r1'][0]))
-        print('AF %04x' % f['r1'][0])
-        print('BC %04x' % f['r1'][1])
-        print('DE %04x' % f['r1'][2])
-        print('HL %04x' % f['r1'][3])
-        print('AF_ %04x' % f['r1'][4])
-        print('BC_ %04x' % f['r1'][5])
-        print('DE_ %04x' % f['r1'][6])
-        print('HL_ %04x' % f['r1'][7])
-        print('IX %04x' % f['r1'][8])
-        print('IY %04x' % f['r1'][9])
-        print('SP %04x' % f['r1'][10])
-        print('PC %04x' % f['r1'][11])
-        print('memptr %04x' % f['r1'][12])
-        print('t-states %d' % f['r2'][6])
-        for d in debug_msgs:
-            print(d)
-        print('')
-        # sys.exit(1)
-
-dk = screen_kb_dummy(io, None)
-dk.start()
-
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
-
 # tests.in
 # --------
 
@@ -141,52 +41,32 @@ cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
 
 # Finally, -1 to end the test. Blank lines may follow before the next test.
 
-### load tests.expected and put it in a dictionary for later comparing ###
-
-fh = open('tests.expected', 'r')
-while True:
-    while True:
-        descr = fh.readline()
-        if not descr:
-            break
-
-        descr = descr.rstrip('\n').rstrip(' ')
-        if descr != '':
-            break
-    if not descr:
-        break
-
-    while True:
-        event = fh.readline()
-        if not event:
-            break
-
-        event = event.rstrip('\n').rstrip(' ')
-        if event[0] != ' ' and event[0] != '\t':
-            break
+# tests.expected has the same layout, with the events that happened
+# (indented lines) between the description and the registers.
 
-    next_line = event
+# Parsing both files takes longer than running the tests, so the result
+# is pickled to CACHE_FILE together with a hash of the two files.
 
-    test_id = descr
-    final[test_id] = { }
-    final[test_id]['id'] = test_id  # hack
+CACHE_FILE = 'tests.cache'
+CACHE_VERSION = 1
 
-    registers1 = next_line
-    parts = registers1.split()
-    regs1 = [int(x, 16) for x in parts]
-    final[test_id]['r1'] = regs1
+def parse_registers(fh):
+    registers1 = fh.readline().rstrip('\n').rstrip(' ')
+    regs1 = [int(x, 16) for x in registers1.split()]
 
     registers2 = fh.readline().rstrip('\n').rstrip(' ')
     parts = registers2.split()
     regs2 = [int(x, 16) for x in parts]
     regs2[6] = int(parts[6])
-    final[test_id]['r2'] = regs2
 
+    return regs1, regs2
+
+def parse_memory(fh):
+    # -> [ (start address, bytes), ... ]
     mem = []
 
     while True:
-        setup = fh.readline()
-        setup = setup.rstrip('\n')
+        setup = fh.readline().rstrip('\n')
         if setup == '-1':
             break
 
@@ -194,48 +74,187 @@ while True:
         if len(parts) == 0:
             break
 
-        a = int(parts[0], 16)
-        first = a
+        data = bytearray()
 
         for b in parts[1:]:
-            if b == '':
-                continue
-
             if b == '-1':
                 break
 
-            mem.append((a, int(b, 16)))
-            a += 1
-            a &= 0xffff
+            data.append(int(b, 16))
 
-    final[test_id]['mem'] = mem
+        mem.append((int(parts[0], 16), bytes(data)))
 
-### process tests.in & execute tests in it ###
-
-fh = open('tests.in', 'r')
-
-while True:
-    debug_msgs = []
+    return mem
 
+def read_description(fh):
     while True:
         descr = fh.readline()
         if not descr:
-            break
+            return None
 
         descr = descr.rstrip('\n').rstrip(' ')
         if descr != '':
-            break
-    if not descr:
-        break
+            return descr
+
+def parse_expected(file_name):
+    final = { }
+
+    with open(file_name, 'r') as fh:
+        while True:
+            descr = read_description(fh)
+            if not descr:
+                break
+
+            # skip the events
+            while True:
+                pos = fh.tell()
+                event = fh.readline()
+
+                if not event or (event[0] != ' ' and event[0] != '\t'):
+                    fh.seek(pos)
+                    break
+
+            regs1, regs2 = parse_registers(fh)
+
+            final[descr] = (regs1, regs2, parse_memory(fh))
+
+    return final
+
+def parse_tests(in_file, expected_file):
+    # -> [ (test id, registers, registers, memory, expected), ... ]
+    final = parse_expected(expected_file)
+
+    cases = []
+
+    with open(in_file, 'r') as fh:
+        while True:
+            descr = read_description(fh)
+            if not descr:
+                break
+
+            regs1, regs2 = parse_registers(fh)
+
+            cases.append((descr, regs1, regs2, parse_memory(fh), final[descr]))
+
+    return cases
+
+def load_tests(in_file, expected_file, use_cache):
+    h = hashlib.sha256()
+
+    for file_name in (in_file, expected_file):
+        with open(file_name, 'rb') as fh:
+            h.update(fh.read())
+
+    digest = h.hexdigest()
+
+    if use_cache:
+        try:
+            with open(CACHE_FILE, 'rb') as fh:
+                cache = pickle.load(fh)
+
+            if cache['version'] == CACHE_VERSION and cache['hash'] == digest:
+                return cache['cases']
+
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+
+    cases = parse_tests(in_file, expected_file)
+
+    if use_cache:
+        try:
+            with open(CACHE_FILE, 'wb') as fh:
+                pickle.dump({ 'version': CACHE_VERSION, 'hash': digest, 'cases': cases }, fh, pickle.HIGHEST_PROTOCOL)
+
+        except OSError as e:
+            print('Cannot write %s: %s' % (CACHE_FILE, e))
+
+    return cases
+
+### one machine per process ###
 
-    # print(descr)
+cases = []
+cpu = None
+
+ram = bytearray(65536)
+io = [ 0 ] * 256
+
+debug_msgs = []
+
+def read_mem(a):
+    return ram[a]
+
+def write_mem(a, v):
+    ram[a] = v
+
+def read_io(a):
+    return io[a]
+
+def write_io(a, v):
+    io[a] = v
+
+def debug(x):
+    debug_msgs.append(x)
+
+def init_worker(tests):
+    global cases, cpu
+
+    cases = tests
+
+    dk = screen_kb_dummy(io, None)
+    dk.start()
+
+    cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+
+def flag_str(f):
+    flags = ''
+
+    flags += 's1 ' if f & 128 else 's0 '
+    flags += 'z1 ' if f & 64 else 'z0 '
+    flags += '51 ' if f & 32 else '50 '
+    flags += 'h1 ' if f & 16 else 'h0 '
+    flags += '31 ' if f & 8 else '30 '
+    flags += 'P1 ' if f & 4 else 'P0 '
+    flags += 'n1 ' if f & 2 else 'n0 '
+    flags += 'c1 ' if f & 1 else 'c0 '
+
+    return flags
+
+def fail_str(test_id, expected, what, t_states):
+    r1, r2, mem = expected
+
+    out = []
+    out.append(' *** FAIL FOR %s (%s) ***' % (test_id, what))
+    out.append('==========================')
+    out.append('CURRENT')
+    out.append('-------')
+    out.append(cpu.reg_str())
+    out.append('Flags: %s' % flag_str(cpu.f))
+    out.append('t-states: %d' % t_states)
+    out.append('')
+    out.append('EXPECTED')
+    out.append('--------')
+    out.append('Flags: %s' % flag_str(r1[0]))
+
+    for i, name in enumerate(('AF', 'BC', 'DE', 'HL', 'AF_', 'BC_', 'DE_', 'HL_', 'IX', 'IY', 'SP', 'PC', 'memptr')):
+        out.append('%s %04x' % (name, r1[i]))
+
+    out.append('t-states %d' % r2[6])
+    out += debug_msgs
+    out.append('')
+
+    return '\n'.join(out)
+
+def run_test(case):
+    # -> list of failure reports
+    test_id, regs1, regs2, mem, expected = case
+
+    del debug_msgs[:]
 
     cpu.reset()
-    reset_mem()
+    ram[:] = bytes(65536)
+    io[:] = [ 0 ] * 256
+    t_start = cpu.scheduler.now
 
-    registers1 = fh.readline().rstrip('\n').rstrip(' ')
-    parts = registers1.split()
-    regs1 = [int(x, 16) for x in parts]
     (cpu.a, cpu.f) = cpu.u16(regs1[0])
     initial_f = cpu.f
     (cpu.b, cpu.c) = cpu.u16(regs1[1])
@@ -251,71 +270,127 @@ while True:
     cpu.pc = regs1[11]
     cpu.memptr = regs1[12]
 
-    f = final[descr]
+    for a, data in mem:
+        for b in data:
+            cpu.write_mem(a, b)
+            a = (a + 1) & 0xffff
 
-    registers2 = fh.readline().rstrip('\n').rstrip(' ')
-    parts = registers2.split()
-    # print(parts)
-    regs2 = [int(x, 16) for x in parts]
-    regs2[6] = int(parts[6])
+    failures = []
 
-    while True:
-        setup = fh.readline()
-        setup = setup.rstrip('\n')
-        if setup == '-1':
-            break
+    try:
+        ccnt = 0
 
-        parts = setup.split()
-        if len(parts) == 0:
-            break
+        while ccnt < regs2[6]:
+            ccnt += cpu.step()
 
-        a = int(parts[0], 16)
-        first = a
+    except:
+        debug_msgs.append(traceback.format_exc())
+        return [ fail_str(test_id, expected, 'exec', cpu.scheduler.now - t_start) ]
 
-        for b in parts[1:]:
-            if b == '':
-                continue
+    def check(r, what):
+        if not r:
+            failures.append(fail_str(test_id, expected, what, cpu.scheduler.now - t_start))
 
-            if b == '-1':
-                break
+    # verify registers
+    r1 = expected[0]
+    (expa, expf) = cpu.u16(r1[0])
+    check(cpu.a == expa, 'a')
+    check((cpu.b, cpu.c) == cpu.u16(r1[1]), 'bc')
+    check((cpu.d, cpu.e) == cpu.u16(r1[2]), 'de')
+    check((cpu.h, cpu.l) == cpu.u16(r1[3]), 'hl')
+    check((cpu.a_, cpu.f_) == cpu.u16(r1[4]), 'af_')
+    check((cpu.b_, cpu.c_) == cpu.u16(r1[5]), 'bc_')
+    check((cpu.d_, cpu.e_) == cpu.u16(r1[6]), 'de_')
+    check((cpu.h_, cpu.l_) == cpu.u16(r1[7]), 'hl_')
+    check(cpu.ix == r1[8], 'ix')
+    check(cpu.iy == r1[9], 'iy')
+    check(cpu.sp == r1[10], 'sp')
+    check(cpu.pc == r1[11], 'pc')
+    check(cpu.f == expf, 'f (%02x -> %02x and is %02x)' % (initial_f, expf, cpu.f))
+    check(cpu.memptr == r1[12], 'memptr')
 
-            cpu.write_mem(a, int(b, 16)) 
-            a += 1
-            a &= 0xffff
+    # verify memory
+    for a, data in expected[2]:
+        for b in data:
+            check(cpu.read_mem(a) == b, 'mem: %04x = %02x (is: %02x)' % (a, b, cpu.read_mem(a)))
+            a = (a + 1) & 0xffff
 
-    ok = False
+    return failures
 
-    try:
-        ccnt = 0
+def run_shard(indexes):
+    # -> [ (index, failure reports, seconds), ... ]
+    results = []
 
-        while ccnt < regs2[6]:
-            ccnt += cpu.step()
+    for i in indexes:
+        start = time.perf_counter()
+        failures = run_test(cases[i])
+        results.append((i, failures, time.perf_counter() - start))
 
-        ok = True
-    except:
-        traceback.print_exc(file=sys.stdout)
-        my_assert(f, False, 'exec')
-
-    if ok:
-        # verify registers
-        (expa, expf) = cpu.u16(f['r1'][0])
-        my_assert(f, cpu.a == expa, 'a')
-        my_assert(f, (cpu.b, cpu.c) == cpu.u16(f['r1'][1]), 'bc')
-        my_assert(f, (cpu.d, cpu.e) == cpu.u16(f['r1'][2]), 'de')
-        my_assert(f, (cpu.h, cpu.l) == cpu.u16(f['r1'][3]), 'hl')
-        my_assert(f, (cpu.a_, cpu.f_) == cpu.u16(f['r1'][4]), 'af_')
-        my_assert(f, (cpu.b_, cpu.c_) == cpu.u16(f['r1'][5]), 'bc_')
-        my_assert(f, (cpu.d_, cpu.e_) == cpu.u16(f['r1'][6]), 'de_')
-        my_assert(f, (cpu.h_, cpu.l_) == cpu.u16(f['r1'][7]), 'hl_')
-        my_assert(f, cpu.ix == f['r1'][8], 'ix')
-        my_assert(f, cpu.iy == f['r1'][9], 'iy')
-        my_assert(f, cpu.sp == f['r1'][10], 'sp')
-        my_assert(f, cpu.pc == f['r1'][11], 'pc')
-        my_assert(f, cpu.f == expf, 'f (%02x -> %02x and is %02x)' % (initial_f, expf, cpu.f))
-        my_assert(f, cpu.memptr == f['r1'][12], 'memptr')
-
-        # verify memory
-        m = f['mem']
-
-        for c in m:
-            my_assert(f, cpu.read_mem(c[0]) == c[1], 'mem: %04x = %02x (is: %02x)' % (c[0], c[1], cpu.read_mem(c[0]))) 
+    return results
+
+def opcode_of(test_id):
+    # e.g. 'ddcb06_1' -> 'ddcb06'
+    return test_id.split('_')[0]
+
+parser = OptionParser()
+parser.add_option('-j', '--jobs', dest='jobs', default=str(os.cpu_count() or 1), help='number of worker processes')
+parser.add_option('-f', '--filter', dest='filter', help='only run tests whose id starts with this (e.g. edb)')
+parser.add_option('-n', '--no-cache', action='store_true', dest='no_cache', help='always parse tests.in/tests.expected')
+parser.add_option('-s', '--summary', action='store_true', dest='summary', help='print pass/fail and time per opcode')
+(options, args) = parser.parse_args()
+
+start = time.perf_counter()
+
+tests = load_tests('tests.in', 'tests.expected', not options.no_cache)
+
+if options.filter:
+    tests = [ t for t in tests if t[0].startswith(options.filter) ]
+
+jobs = max(1, int(options.jobs))
+
+# interleaved so that the slow (repeating) instructions are spread over
+# the workers
+n_shards = min(len(tests), jobs * 8) or 1
+shards = [ list(range(i, len(tests), n_shards)) for i in range(n_shards) ]
+
+results = []
+
+if jobs == 1:
+    init_worker(tests)
+
+    for s in shards:
+        results += run_shard(s)
+
+else:
+    with multiprocessing.Pool(jobs, init_worker, (tests, )) as pool:
+        for r in pool.imap_unordered(run_shard, shards):
+            results += r
+
+results.sort()
+
+per_opcode = dict()
+n_failed = 0
+
+for i, failures, took in results:
+    for f in failures:
+        print(f)
+
+    if failures:
+        n_failed += 1
+
+    e = per_opcode.setdefault(opcode_of(tests[i][0]), [ 0, 0, 0.0 ])
+    e[0] += 1
+    e[1] += 1 if failures else 0
+    e[2] += took
+
+if options.summary:
+    print('opcode      tests failed      ms')
+
+    for opcode, (n, failed, took) in per_opcode.items():
+        print('%-10s %6d %6d %7.2f%s' % (opcode, n, failed, took * 1000, '  FAIL' if failed else ''))
+
+    print('')
+
+print('%d tests, %d failed (%d opcodes), %.2fs with %d process(es)' % (len(results), n_failed, len([ o for o in per_opcode.values() if o[1] ]), time.perf_counter() - start, jobs))
+
+sys.exit(1 if n_failed else 0)
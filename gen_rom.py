@@ -2,7 +2,7 @@
 # released under AGPL v3.0
 
 import sys
-from typing import List
+from romimage import load_rom_image
 
 class gen_rom:
     def __init__(self, gen_rom_file, debug, offset=0x4000):
@@ -10,9 +10,7 @@ class gen_rom:
 
         self.offset: int = offset
 
-        fh = open(gen_rom_file, 'rb')
-        self.rom: List[int] = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.rom = load_rom_image(gen_rom_file)
 
         self.debug = debug
 
@@ -25,6 +23,9 @@ class gen_rom:
     def get_n_pages(self):
         return (len(self.rom) + 16383) // 16384
 
+    def get_page_mem(self, page: int):
+        return (self.rom, page * 0x4000 - self.offset, 0x4000, False)
+
     def write_mem(self, a: int, v: int) -> None:
         pass
 
@@ -1,10 +1,12 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
-import sys
-from typing import List, Tuple
+from typing import List
 
 class memmap:
+    # shared by all mappers: what pages that were never written read as
+    zero_page = memoryview(bytes(16384))
+
     def __init__(self, n_pages:int, debug):
         assert n_pages > 0 and n_pages <= 256
 
@@ -13,7 +15,11 @@ class memmap:
 
         self.mapper: List[int] = [ 3, 2, 1, 0 ]
 
-        self.ram = [ [ 0 for k in range(16384)] for j in range(self.n_pages)]
+        # RAM pages are only allocated on first write
+        self.ram: List[memoryview] = [ None ] * self.n_pages
+
+        # what is visible in each of the 4 CPU pages
+        self.views: List[memoryview] = [ self.get_ram_page(nr) for nr in self.mapper ]
 
     def get_ios(self):
         return [ [ 0xfc, 0xfd, 0xfe, 0xff ], [ 0xfc, 0xfd, 0xfe, 0xff ] ]
@@ -24,28 +30,62 @@ class memmap:
     def get_n_pages(self):
         return 4
 
-    def split_addr(self, a: int) -> Tuple[int, int]:
-        page = self.mapper[a >> 14]
-        offset = a & 0x3fff
+    def get_ram_page(self, nr: int) -> memoryview:
+        p = self.ram[nr % self.n_pages]
+
+        return memmap.zero_page if p is None else p
+
+    def get_page_mem(self, page: int):
+        view = self.views[page]
 
-        return page, offset
+        # not writable until allocated: the write then goes via write_mem
+        return (view, 0, 0x4000, view is not memmap.zero_page)
 
     def write_mem(self, a:int, v:int) -> None:
-        page, offset = self.split_addr(a)
+        page = a >> 14
+
+        if self.views[page] is memmap.zero_page:
+            nr = self.mapper[page] % self.n_pages
+
+            self.ram[nr] = memoryview(bytearray(16384))
+
+            for i in range(0, 4):
+                self.views[i] = self.get_ram_page(self.mapper[i])
 
-        self.ram[page][offset] = v
+        self.views[page][a & 0x3fff] = v
 
     def read_mem(self, a: int) -> int:
-        page, offset = self.split_addr(a)
+        return self.views[a >> 14][a & 0x3fff]
 
-        return self.ram[page][offset]
+    def get_state(self) -> dict:
+        # pages that were never written are stored as None
+        return { 'mapper': list(self.mapper), 'ram': [ None if p is None else bytes(p) for p in self.ram ] }
+
+    def set_state(self, state: dict) -> None:
+        assert len(state['ram']) == self.n_pages
+
+        for nr, data in enumerate(state['ram']):
+            if data is None:
+                self.ram[nr] = None
+
+            elif self.ram[nr] is None:
+                self.ram[nr] = memoryview(bytearray(data))
+
+            else:
+                self.ram[nr][:] = data
+
+        self.mapper = list(state['mapper'])
+
+        self.views = [ self.get_ram_page(nr) for nr in self.mapper ]
 
     def write_io(self, a: int, v: int) -> None:
-        self.debug('memmap write %02x: %d' % (a, v))
+        # self.debug('memmap write %02x: %d' % (a, v))
 
         self.mapper[a - 0xfc] = v
 
+        self.views[a - 0xfc] = self.get_ram_page(v)
+
     def read_io(self, a: int) -> int:
-        self.debug('memmap read %02x' % a)
+        # self.debug('memmap read %02x' % a)
 
         return self.mapper[a - 0xfc]
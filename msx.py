@@ -3,55 +3,59 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import savestate
+import signal
 import sys
 import threading
 import time
 from disk import disk
 from gen_rom import gen_rom
 from scc import scc
-from z80 import z80
+from z80 import z80, FREQ_CLOCK, FREQ_VDP_REFRESH
 from screen_kb import screen_kb
 from sound import sound
 from memmapper import memmap
 from rom import rom
 from optparse import OptionParser
 from RP_5C01 import RP_5C01
-from NMS_1205 import NMS_1205
+from YM2413 import YM2413
 from typing import Callable, List
 from sunriseide import sunriseide
 from cas import load_cas_file
 from ascii16kb import ascii16kb
 from msxdos2 import msxdos2
+from blockcache import layout_config
+from bus import bus
+from scheduler import scheduler
+from rewind import rewind
+from NMS_1205 import NMS_1205
 
 abort_time = None # 60
 
 debug_log = None
+debug_fh = None
 
 io_values: List[int] = [ 0 ] * 256
 io_read: List[Callable[[int], int]] = [ None ] * 256
 io_write: List[Callable[[int, int], None]] = [ None ] * 256
-
-subslot: List[int] = [ 0x00, 0x00, 0x00, 0x00 ]
-has_subslots: List[bool] = [ False, False, False, False ]
+io_read_block: List[Callable[[int, int], bytes]] = [ None ] * 256
+io_write_block: List[Callable[[int, bytes], None]] = [ None ] * 256
 
 def debug(x):
     #dk.debug('%s' % x)
 
-    if debug_log:
-        fh = open(debug_log, 'a+')
-        fh.write('%s\t%02x %02x\n' % (x, read_page_layout(0), read_mem(0xffff) ^ 0xff))
-        # fh.write('%s\n' % x)
-        fh.close()
+    if debug_fh:
+        debug_fh.write('%s\t%02x %02x\n' % (x, mb.read_page_layout(0), mb.subslot[mb.slot_for_page[3]]))
+        # debug_fh.write('%s\n' % x)
 
-slots = [[[None for k in range(4)] for j in range(4)] for i in range(4)]
+cpu = None
 
-def put_page(slot: int, subslot: int, page: int, obj):
-    has_subslots[slot] |= subslot > 0
+# emulated time, shared by the CPU and the devices
+sched = scheduler()
 
-    slots[slot][subslot][page] = obj
+mb = bus(debug)
 
-def get_page(slot: int, subslot: int, page: int):
-    return slots[slot][subslot][page]
+put_page = mb.put_page
 
 mm = memmap(256, debug)
 for p in range(0, 4):
@@ -69,24 +73,43 @@ parser.add_option('-I', '--ide-rom', action='append', dest='ide_rom', help='sele
 parser.add_option('-C', '--cas-file', dest='cas_file', help='select a .cas file to load')
 parser.add_option('-A', '--ascii-16kb', action='append', dest='a16_rom', help='select an ASCII-16kB ROM to use, format: slot:subslot:rom-filename')
 parser.add_option('-M', '--msx-dos2', action='append', dest='msxdos2_rom', help='select an MSX-DOS2 ROM to use, format: slot:subslot:rom-filename')
+parser.add_option('-O', '--msx-music', action='store_true', dest='msx_music', help='add an MSX-Music (YM2413) FM sound chip')
 parser.add_option('-T', '--time', action='store_true', dest='time', help='enable RTC')
 parser.add_option('-W', '--wrescale', dest='wrescale', help='Width rescale factor, integer')
 parser.add_option('-H', '--hrescale', dest='hrescale', help='Height rescale factor, integer')
 parser.add_option('-L', '--scanline', dest='scanline', help='Scanline percentage, 0-100%')
+parser.add_option('-V', '--vdp-thread', action='store_true', dest='vdp_thread', help='run the VDP in the emulator process instead of in a forked child (no pipe I/O per VDP access)')
+parser.add_option('-U', '--unthrottled', action='store_true', dest='unthrottled', help='do not keep emulated time in step with the wall clock (run as fast as possible)')
+parser.add_option('-P', '--profile', dest='profile', help='count instructions/T-states per PC, opcode, slot and routine; the report is written to this file at exit and on SIGUSR1')
+parser.add_option('-t', '--trace', dest='trace', help='write a binary trace of all executed instructions to this file (see trace-dump.py)')
+parser.add_option('-s', '--save-state', dest='save_state', help='write a snapshot of the machine to this file at exit and on SIGUSR2')
+parser.add_option('-r', '--restore-state', dest='restore_state', help='continue from a snapshot (written by -s with the same ROM/slot options)')
+parser.add_option('-z', '--state-compression', dest='state_compression', default='zlib', help='compression of snapshots: none, zlib (default) or lzma')
+parser.add_option('-F', '--rewind', dest='rewind', help='take a snapshot every this many frames to rewind to (keep F12 pressed)')
+parser.add_option('-m', '--rewind-memory', dest='rewind_memory', default='64', help='MB of memory the rewind snapshots may use (default 64)')
+parser.add_option('-a', '--audio', dest='audio', default='device', help='where the sound goes: device (default: the audio device and MIDI out), null (nowhere) or a file name to render it to, as fast as the emulation runs (.wav or else raw signed 16 bit mono at 48kHz)')
+parser.add_option('-X', '--block-cache', action='store_true', dest='block_cache', help='translate basic blocks of Z80 code to Python (up to 1.5x faster for loops, about the same when booting to BASIC, slower for code that runs only once or keeps modifying itself)')
 (options, args) = parser.parse_args()
 
 debug_log = options.debug_log
 
+if debug_log:
+    debug_fh = open(debug_log, 'a+')
+
 if not options.bb_file:
     print('No BIOS/BASIC ROM selected (e.g. msxbiosbasic.rom)')
     sys.exit(1)
 
+if options.state_compression not in savestate.COMPRESSION:
+    print('Snapshot compression must be one of %s' % ', '.join(savestate.COMPRESSION))
+    sys.exit(1)
+
 # bb == bios/basic
 bb = rom(options.bb_file, debug, 0x0000)
 put_page(0, 0, 0, bb)
 put_page(0, 0, 1, bb)
 
-snd = sound(debug)
+snd = sound(debug, sched, options.audio)
 
 if options.scc_rom:
     for o in options.scc_rom:
@@ -143,63 +166,31 @@ if options.msxdos2_rom:
         md2_subslot = int(parts[1])
         put_page(md2_slot, md2_subslot, 1, md2_obj)
 
-slot_for_page: List[int] = [ 0, 0, 0, 0 ]
-
 clockchip = None
 if options.time:
-    clockchip = RP_5C01(debug)
-
-def get_subslot_for_page(slot: int, page: int):
-    if has_subslots[slot]:
-        return (subslot[slot] >> (page * 2)) & 3
-
-    return 0
+    clockchip = RP_5C01(debug, sched)
 
-def read_mem(a: int) -> int:
-    assert a >= 0
-    assert a < 0x10000
+fm = None
+if options.msx_music:
+    fm = YM2413(snd, debug)
 
-    page = a >> 14
+def set_block_config() -> None:
+    # translated code depends on what is visible in the address space
+    if cpu and cpu.blocks:
+        cpu.blocks.set_config(layout_config(mb, mm))
 
-    slot = get_page(slot_for_page[page], get_subslot_for_page(slot_for_page[page], page), page)
+def page_switched(page: int) -> None:
+    # a ROM cartridge switched banks, code translated from that page is stale
+    if cpu and cpu.blocks:
+        cpu.blocks.invalidate_range(page * 0x4000, page * 0x4000 + 0x3fff)
 
-    if a == 0xffff:
-        if has_subslots[slot_for_page[3]]:
-            return subslot[slot_for_page[3]] ^ 0xff
+mb.layout_changed = set_block_config
+mb.page_switched = page_switched
 
-        if slot:
-            return 0 ^ 0xff
+def write_mapper(a: int, v: int) -> None:
+    mm.write_io(a, v)
 
-    if slot == None:
-        return 0xee
-
-    return slot.read_mem(a)
-
-def write_mem(a: int, v: int) -> None:
-    assert a >= 0
-    assert a < 0x10000
-
-    if a == 0xffff:
-        if has_subslots[slot_for_page[3]]:
-            debug('Setting sub-page layout to %02x' % v)
-            subslot[slot_for_page[3]] = v
-            return
-
-    page = a >> 14
-
-    slot = get_page(slot_for_page[page], get_subslot_for_page(slot_for_page[page], page), page)
-    if slot == None:
-        debug('Writing %02x to %04x which is not backed by anything (slot: %02x, subslot: %02x)' % (v, a, read_page_layout(0), subslot[slot_for_page[3]]))
-        return
-    
-    slot.write_mem(a, v)
-
-def read_page_layout(a: int) -> int:
-    return (slot_for_page[3] << 6) | (slot_for_page[2] << 4) | (slot_for_page[1] << 2) | slot_for_page[0]
-
-def write_page_layout(a: int, v: int) -> None:
-    for i in range(0, 4):
-        slot_for_page[i] = (v >> (i * 2)) & 3
+    mb.rebuild()
 
 def printer_out(a: int, v: int) -> None:
     # FIXME handle strobe
@@ -221,7 +212,10 @@ def invoke_load_cas(a: int) -> int:
     if options.cas_file:
         global cpu
 
-        cpu.pc = load_cas_file(write_mem, options.cas_file)
+        cpu.pc = load_cas_file(mb.write_mem, options.cas_file)
+
+        if cpu.blocks:
+            cpu.blocks.flush()
 
     return 123
 
@@ -236,12 +230,23 @@ def add_dev(d) -> None:
     for r in dev_io_rw[1]:
         io_write[r] = d.write_io
 
+    # ports that can take a whole INIR/OTIR at once
+    if hasattr(d, 'get_block_ios'):
+        dev_io_block = d.get_block_ios()
+
+        for r in dev_io_block[0]:
+            io_read_block[r] = d.read_io_block
+
+        for r in dev_io_block[1]:
+            io_write_block[r] = d.write_io_block
+
 def init_io():
     global dk
     global mm
     global musicmodule
     global snd
     global clockchip
+    global fm
 
     io_write[0x80] = terminator
     io_read[0x81] = invoke_load_cas
@@ -261,6 +266,9 @@ def init_io():
     if clockchip:
         add_dev(clockchip)
 
+    if fm:
+        add_dev(fm)
+
     if dk:
         add_dev(dk)
 
@@ -269,9 +277,12 @@ def init_io():
 
     add_dev(mm)
 
+    for r in range(0xfc, 0x100):
+        io_write[r] = write_mapper
+
     print('set "mmu"')
-    io_read[0xa8] = read_page_layout
-    io_write[0xa8] = write_page_layout
+    io_read[0xa8] = mb.read_page_layout
+    io_write[0xa8] = mb.write_page_layout
 
     print('set printer')
     io_write[0x91] = printer_out
@@ -279,7 +290,8 @@ def init_io():
 def read_io(a: int) -> int:
     global io_read
 
-    debug('read port %02x' % a)
+    if debug_fh:
+        debug('read port %02x' % a)
 
     if io_read[a]:
         return io_read[a](a)
@@ -291,7 +303,8 @@ def read_io(a: int) -> int:
 def write_io(a: int, v: int) -> None:
     global io_write
 
-    debug('write port %02x: %02x' % (a, v))
+    if debug_fh:
+        debug('write port %02x: %02x' % (a, v))
 
     io_values[a] = v
 
@@ -300,23 +313,178 @@ def write_io(a: int, v: int) -> None:
     else:
         print('Unmapped I/O write %02x: %02x' % (a, v))
 
+def read_io_block(a: int, n: int) -> bytes:
+    if io_read_block[a]:
+        if debug_fh:
+            debug('read port %02x: %d bytes' % (a, n))
+
+        return io_read_block[a](a, n)
+
+    return bytes([ read_io(a) for i in range(n) ])
+
+def write_io_block(a: int, data) -> None:
+    if io_write_block[a]:
+        if debug_fh:
+            debug('write port %02x: %d bytes' % (a, len(data)))
+
+        io_values[a] = data[-1]
+        io_write_block[a](a, data)
+
+    else:
+        for v in data:
+            write_io(a, v)
+
+def machine_layout():
+    # what is in which slot: a snapshot only fits the same machine
+    layout = dict()
+
+    for slot in range(0, 4):
+        for subslot in range(0, 4):
+            for page in range(0, 4):
+                obj = mb.get_page(slot, subslot, page)
+
+                if obj:
+                    layout['%d:%d:%d' % (slot, subslot, page)] = obj.get_name()
+
+    return layout
+
+def state_objects():
+    # in the order they're restored in
+    objects = { 'scheduler': sched, 'mapper': mm }
+
+    for key in machine_layout():
+        obj = mb.get_page(*[ int(x) for x in key.split(':') ])
+
+        if obj not in objects.values():
+            objects['slot ' + key] = obj
+
+    objects['screen'] = dk
+    objects['psg'] = snd
+    objects['rtc'] = clockchip
+    objects['msx-music'] = fm
+    objects['bus'] = mb
+    objects['cpu'] = cpu
+
+    return objects
+
+def save_state(file_name: str) -> None:
+    states = savestate.capture(state_objects())
+    states['machine'] = machine_layout()
+
+    savestate.save(file_name, states, options.state_compression)
+
+    print('Snapshot written to %s' % file_name)
+
+def restore_state(file_name: str) -> None:
+    try:
+        states = savestate.load(file_name)
+
+    except (OSError, ValueError) as e:
+        print('Cannot load snapshot %s: %s' % (file_name, e))
+        sys.exit(1)
+
+    if states.get('machine') != machine_layout():
+        print('Snapshot %s is of a machine with different ROMs/slots' % file_name)
+        sys.exit(1)
+
+    savestate.restore(state_objects(), states)
+
 stop_flag = False
 
+# set from a signal handler, done between two runs of the CPU
+save_state_pending = False
+
+def request_save_state(signum, frame) -> None:
+    global save_state_pending
+
+    save_state_pending = True
+
 def cpu_thread():
     #t = time.time()
     #while time.time() - t < 5:
+    start_wall = time.time()
+    start_t = sched.now
+
+    global save_state_pending
+
     while not stop_flag:
-        cpu.step()
+        cpu.run(FREQ_CLOCK // FREQ_VDP_REFRESH)
+
+        if save_state_pending:
+            save_state_pending = False
+            save_state(options.save_state)
+
+        if rewinder:
+            # one snapshot back per frame while F12 is held
+            if dk.host_keys() & 1:
+                rewinder.step_back()
+
+            else:
+                rewinder.frame()
+
+        if options.unthrottled:
+            continue
+
+        # HALT and idle loops are skipped, so the CPU can get ahead of the
+        # wall clock: wait for it. When behind, don't try to catch up.
+        ahead = (sched.now - start_t) / FREQ_CLOCK - (time.time() - start_wall)
 
-dk = screen_kb(io_values, options)
+        if ahead > 0:
+            time.sleep(ahead)
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+        elif ahead < -0.1:
+            start_wall = time.time()
+            start_t = sched.now
 
-musicmodule = NMS_1205(cpu, debug)
-musicmodule.start()
+dk = screen_kb(io_values, options, sched)
+
+cpu = z80(mb.read_mem, mb.write_mem, read_io, write_io, debug, dk, sched)
+
+cpu.enable_bulk_access(mb.get_span, read_io_block, write_io_block)
+
+if options.block_cache:
+    cpu.enable_block_cache()
+    set_block_config()
+
+trc = None
+if options.trace:
+    from tracer import tracer
+
+    trc = tracer(options.trace, mb.peek, lambda: mb.read_page_layout(0) | (mb.subslot[mb.slot_for_page[3]] << 8))
+    cpu.enable_trace(trc)
+
+prof = None
+if options.profile:
+    from profiler import profiler
+
+    def code_region(a: int):
+        page = a >> 14
+        slot = mb.slot_for_page[page]
+
+        return (slot, mb.get_subslot_for_page(slot, page), page)
+
+    prof = profiler(cpu, mb.peek, code_region)
+    cpu.enable_profile(prof)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: prof.write_report(options.profile))
+
+# the ports are always there, MIDI in and out of the host only with the audio device
+musicmodule = NMS_1205(cpu, debug, options.audio == 'device')
+if options.audio == 'device':
+    musicmodule.start()
 
 init_io()
 
+if options.restore_state:
+    restore_state(options.restore_state)
+
+rewinder = None
+if options.rewind:
+    rewinder = rewind(state_objects(), int(options.rewind), int(options.rewind_memory) * 1024 * 1024)
+
+if options.save_state:
+    signal.signal(signal.SIGUSR2, request_save_state)
+
 t = threading.Thread(target=cpu_thread)
 t.start()
 
@@ -331,8 +499,18 @@ except KeyboardInterrupt:
     stop_flag = True
     t.join()
 
+if options.save_state:
+    save_state(options.save_state)
+
 dk.stop()
 
-#for i in range(0, 256):
-#    if cpu.counts[i]:
-#        print('instr %02x: %d' % (i, cpu.counts[i]), file=sys.stderr)
+snd.stop()
+
+if trc:
+    trc.close()
+
+if prof:
+    prof.write_report(options.profile)
+
+if debug_fh:
+    debug_fh.close()
@@ -3,17 +3,18 @@
 
 import sys
 from typing import List, Tuple
+from romimage import load_rom_image, get_banks
 
 class msxdos2:
     def __init__(self, msxdos2_rom_file, debug):
         print('Loading MSX-DOS2 rom %s...' % msxdos2_rom_file, file=sys.stderr)
 
-        fh = open(msxdos2_rom_file, 'rb')
-        self.msxdos2_rom = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.msxdos2_rom = load_rom_image(msxdos2_rom_file)
 
         assert len(self.msxdos2_rom) == 65536
 
+        self.banks = get_banks(self.msxdos2_rom, 0x4000)
+
         self.msxdos2_page: int = 0
 
         self.debug = debug
@@ -35,6 +36,15 @@ class msxdos2:
 
         return bank, offset
 
+    def get_page_mem(self, page: int):
+        return (self.banks[self.msxdos2_page], 0, 0x4000, False)
+
+    def get_state(self) -> dict:
+        return { 'page': self.msxdos2_page }
+
+    def set_state(self, state: dict) -> None:
+        self.msxdos2_page = state['page']
+
     def write_mem(self, a: int, v: int) -> None:
         self.debug('MSX-DOS2: set bank to %d (%d) via %04x' % (v, v & 3, a))
         self.msxdos2_page = v & 3
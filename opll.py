@@ -0,0 +1,485 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import math
+import numpy  # type: ignore
+from typing import List
+from psg import NOISE_LENGTH, noise_sequence
+from resampler import resampler
+
+# YM2413 (OPLL, MSX-Music) synthesis at clock / 72. Like the chip, an
+# operator looks its phase up in a log-sin table, adds its attenuation
+# (envelope, total level/volume, key scaling, tremolo) in the same log
+# units and converts back with an exp table. Everything is computed for
+# a whole buffer at once, per channel: phases from the increments,
+# envelopes piecewise (exponential attack, linear decay/release) per
+# stage.
+#
+# Feedback of a modulator needs its own previous outputs, so it can't be
+# done in one vectorized pass. For low feedback levels the buffer is
+# computed again a few times (FEEDBACK_PASSES) with the outputs of the
+# previous pass as feedback, which converges quickly. From level 4 on it
+# doesn't (fast enough), those modulators are computed sample by sample.
+#
+# Register writes are applied at the start of the block of QUANTUM ticks
+# they fall in.
+
+# instruments 1...15, then bass drum, hi-hat/snare drum and tom/cymbal
+PATCHES = [
+    [ 0x71, 0x61, 0x1e, 0x17, 0xd0, 0x78, 0x00, 0x17 ],  # violin
+    [ 0x13, 0x41, 0x1a, 0x0d, 0xd8, 0xf7, 0x23, 0x13 ],  # guitar
+    [ 0x13, 0x01, 0x99, 0x00, 0xf2, 0xc4, 0x21, 0x23 ],  # piano
+    [ 0x11, 0x61, 0x0e, 0x07, 0x8d, 0x64, 0x70, 0x27 ],  # flute
+    [ 0x32, 0x21, 0x1e, 0x06, 0xe1, 0x76, 0x01, 0x28 ],  # clarinet
+    [ 0x31, 0x22, 0x16, 0x05, 0xe0, 0x71, 0x00, 0x18 ],  # oboe
+    [ 0x21, 0x61, 0x1d, 0x07, 0x82, 0x81, 0x11, 0x07 ],  # trumpet
+    [ 0x33, 0x21, 0x2d, 0x13, 0xb0, 0x70, 0x00, 0x07 ],  # organ
+    [ 0x61, 0x61, 0x1b, 0x06, 0x64, 0x65, 0x10, 0x17 ],  # horn
+    [ 0x41, 0x61, 0x0b, 0x18, 0x85, 0xf0, 0x81, 0x07 ],  # synthesizer
+    [ 0x33, 0x01, 0x83, 0x11, 0xea, 0xef, 0x10, 0x04 ],  # harpsichord
+    [ 0x17, 0xc1, 0x24, 0x07, 0xf8, 0xf8, 0x22, 0x12 ],  # vibraphone
+    [ 0x61, 0x50, 0x0c, 0x05, 0xd2, 0xf5, 0x40, 0x42 ],  # synthesizer bass
+    [ 0x01, 0x01, 0x55, 0x03, 0xe9, 0x90, 0x03, 0x02 ],  # acoustic bass
+    [ 0x41, 0x41, 0x89, 0x03, 0xf1, 0xe4, 0xc0, 0x13 ],  # electric guitar
+    [ 0x01, 0x01, 0x18, 0x0f, 0xdf, 0xf8, 0x6a, 0x6d ],  # bass drum
+    [ 0x01, 0x01, 0x00, 0x00, 0xc8, 0xd8, 0xa7, 0x68 ],  # hi-hat (modulator), snare drum (carrier)
+    [ 0x05, 0x01, 0x00, 0x00, 0xf8, 0xaa, 0x59, 0x55 ],  # tom (modulator), top cymbal (carrier)
+]
+
+# frequency multiplier, times 2
+MULTIPLY = [ 1, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 20, 24, 24, 30, 30 ]
+
+# key scale level attenuation [dB] per upper 4 bits of the F-number, at
+# block 7 (3 dB less per block below that)
+KSL_TABLE = [ 0.0, 9.0, 12.0, 13.875, 15.0, 16.125, 16.875, 17.625, 18.0, 18.75, 19.125, 19.5, 19.875, 20.25, 20.625, 21.0 ]
+KSL_SCALE = [ 0.0, 0.5, 1.0, 2.0 ]
+
+# attenuation is in units of 1/256 of a halving (the log-sin/exp tables)
+DB = 256 / (20 * math.log10(2))
+EG_STEP = 16  # 0.375 dB, the envelope has 128 steps
+TL_STEP = 32  # 0.75 dB
+VOLUME_STEP = 128  # 3 dB
+# beyond this the exp table is 0
+SILENT = 13 * 256
+ATTENUATION_MAX = 1 << 13
+
+# envelope stages
+ATTACK = 0
+DECAY = 1
+SUSTAIN = 2
+RELEASE = 3
+OFF = 4
+
+# per slot (0...17): the bit in register 0x0e that keys it in rhythm mode
+RHYTHM_KEYS = [ 0x10, 0x10, 0x01, 0x08, 0x04, 0x02 ]
+
+AM_DEPTH = round(4.875 * DB)
+AM_RATE = 3.7  # [Hz]
+PM_DEPTH = 2 ** (14 / 1200) - 1  # 14 cents
+PM_RATE = 6.4  # [Hz]
+
+PHASE_CYCLE = 1 << 19
+FEEDBACK_PASSES = 8
+FEEDBACK_ITERATED = 3
+QUANTUM = 64
+
+def log_sin_table():
+    # -> -log2(sin) of a whole wave of 1024 steps (the quarter wave
+    # mirrored) and its sign, also for the half rectified wave
+    i = numpy.arange(256)
+    quarter = numpy.round(-numpy.log2(numpy.sin((i + 0.5) * math.pi / 512)) * 256).astype(numpy.int64)
+
+    half = numpy.concatenate((quarter, quarter[::-1]))
+
+    full_sign = numpy.concatenate((numpy.ones(512, dtype=numpy.int64), -numpy.ones(512, dtype=numpy.int64)))
+    half_sign = numpy.concatenate((numpy.ones(512, dtype=numpy.int64), numpy.zeros(512, dtype=numpy.int64)))
+
+    return numpy.concatenate((half, half)), full_sign, half_sign
+
+def exp_table():
+    # -> 2^-(i / 256) for all attenuations, 12 bits
+    mantissa = numpy.round(4096 * 2.0 ** (-numpy.arange(256) / 256)).astype(numpy.int64)
+
+    i = numpy.arange(ATTENUATION_MAX)
+
+    return numpy.where(i < SILENT, mantissa[i & 255] >> numpy.minimum(i >> 8, 13), 0)
+
+def rate_index(rate: int, rks: int) -> int:
+    return 0 if rate == 0 else min(63, rate * 4 + rks)
+
+def decay_step(rate: int, rks: int) -> float:
+    # -> envelope steps per sample
+    r = rate_index(rate, rks)
+
+    if r < 4:
+        return 0.0
+
+    return (((r & 3) + 4) << ((r >> 2) - 1)) / 32768
+
+def attack_factor(rate: int, rks: int):
+    # -> exponent per sample of the attack, None when it is immediate
+    r = rate_index(rate, rks)
+
+    if r >= 60:
+        return None
+
+    if r < 4:
+        return 0.0
+
+    samples = (1 << 22) / (((r & 3) + 4) << ((r >> 2) + 1))
+
+    return math.log(135 / 8) / samples
+
+class opll:
+    def __init__(self, clock: float, sample_rate: int):
+        self.regs: List[int] = [ 0 ] * 64
+
+        self.logsin, self.full_sign, self.half_sign = log_sin_table()
+        self.exp = exp_table()
+
+        self.logsin_list = self.logsin.tolist()
+        self.exp_list = self.exp.tolist()
+        self.noise = noise_sequence()
+
+        self.rate = clock / 72
+
+        # per slot: modulator of channel n is 2n, the carrier 2n + 1
+        self.key: List[bool] = [ False ] * 18
+        self.stage: List[int] = [ OFF ] * 18
+        self.eg: List[float] = [ 127.0 ] * 18
+        self.phase: List[float] = [ 0.0 ] * 18
+
+        # per channel: the last two outputs of the modulator
+        self.feedback: List[List[int]] = [ [ 0, 0 ] for c in range(9) ]
+
+        self.noise_index: int = 0
+        self.lfo: int = 0
+
+        self.resampler = resampler(self.rate, sample_rate)
+
+        self.ramp = numpy.zeros(0)
+        self.ticks = numpy.zeros(0, dtype=numpy.int64)
+
+    def write(self, a: int, v: int) -> None:
+        a &= 0x3f
+        self.regs[a] = v
+
+        if a == 0x0e or (a >= 0x20 and a <= 0x28):
+            self.update_keys()
+
+    def update_keys(self) -> None:
+        rhythm = self.regs[0x0e] & 0x20
+
+        for s in range(18):
+            on = self.regs[0x20 + s // 2] & 0x10
+
+            if rhythm and s >= 12:
+                on |= self.regs[0x0e] & RHYTHM_KEYS[s - 12]
+
+            on = bool(on)
+
+            if on and not self.key[s]:
+                self.stage[s] = ATTACK
+                self.phase[s] = 0.0
+
+            elif not on and self.key[s] and self.stage[s] != OFF:
+                self.stage[s] = RELEASE
+
+            self.key[s] = on
+
+    def render(self, n: int, events: List[tuple] = ()):
+        # -> n samples at the output rate; each melody channel is
+        # -0.5...0.5, in rhythm mode the bass drum and the other drums are
+        # twice that (up to -8...8 in total)
+        # 'events' are (output sample position, register, value), in order
+        m = self.resampler.needed(n)
+
+        parts = [ ]
+        start = 0
+
+        for pos, a, v in events:
+            tick = min(m, self.resampler.input_offset(pos))
+            tick = max(start, tick - tick % QUANTUM)
+
+            if tick > start:
+                parts.append(self.generate(tick - start))
+                start = tick
+
+            self.write(a, v)
+
+        parts.append(self.generate(m - start))
+
+        return self.resampler.resample(numpy.concatenate(parts), n)
+
+    def envelope(self, s: int, m: int, ar: int, dr: int, sl: int, rr: int, sustained: bool, sus: bool, rks: int):
+        # -> envelope (steps of attenuation, 0...127) of slot 's'
+        out = numpy.empty(m)
+
+        ramp = self.ramp
+        eg = self.eg[s]
+        stage = self.stage[s]
+
+        i = 0
+
+        while i < m:
+            if stage == ATTACK:
+                factor = attack_factor(ar, rks)
+
+                if factor is None:
+                    eg = 0.0
+                    stage = DECAY
+                    continue
+
+                if factor == 0.0:
+                    out[i:] = eg
+                    break
+
+                # (eg + 8) * e^(-factor * t) - 8, until it reaches 0
+                k = max(1, math.ceil(math.log((eg + 8) / 8) / factor))
+                todo = min(k, m - i)
+
+                out[i:i + todo] = (eg + 8) * numpy.exp(-factor * ramp[:todo]) - 8
+
+                eg = (eg + 8) * math.exp(-factor * todo) - 8
+                i += todo
+
+                if todo == k:
+                    eg = 0.0
+                    stage = DECAY
+
+                continue
+
+            if stage == DECAY:
+                step = decay_step(dr, rks)
+                target = sl * 8
+
+            elif stage == SUSTAIN:
+                # a sustained tone holds, a percussive one dies away
+                step = 0.0 if sustained else decay_step(rr, rks)
+                target = 128
+
+            elif stage == RELEASE:
+                step = decay_step(5 if sus else (rr if sustained else 7), rks)
+                target = 128
+
+            else:
+                eg = 127.0
+                out[i:] = eg
+                break
+
+            if step == 0.0:
+                out[i:] = eg
+                break
+
+            k = max(1, math.ceil((target - eg) / step))
+            todo = min(k, m - i)
+
+            out[i:i + todo] = eg + step * ramp[:todo]
+
+            eg += step * todo
+            i += todo
+
+            if todo == k:
+                if stage == DECAY:
+                    eg = float(target)
+                    stage = SUSTAIN
+
+                else:
+                    eg = 127.0
+                    stage = OFF
+
+        self.eg[s] = min(eg, 127.0)
+        self.stage[s] = stage
+
+        return numpy.minimum(out, 127.0)
+
+    def slot(self, s: int, p: List[int], op: int, fnum: int, block: int, sus: bool, level: int, m: int):
+        # -> phase (10 bits) and attenuation per sample of operator 'op' (0
+        # modulator, 1 carrier) of patch 'p' in slot 's'
+        b = p[op]
+
+        rks = (block << 1) | (fnum >> 8)
+
+        if not b & 0x10:
+            rks >>= 2
+
+        eg = self.envelope(s, m, p[4 + op] >> 4, p[4 + op] & 15, p[6 + op] >> 4, p[6 + op] & 15, bool(b & 0x20), sus, rks)
+
+        ksl = KSL_SCALE[p[2 + op] >> 6] * max(0.0, KSL_TABLE[fnum >> 5] - 3.0 * (7 - block))
+
+        att = (eg * EG_STEP).astype(numpy.int64) + (level + int(ksl * DB))
+
+        if b & 0x80:
+            att += self.tremolo
+
+        increment = fnum * (1 << block) * MULTIPLY[b & 15] / 2
+
+        if b & 0x40:
+            steps = increment * self.vibrato
+            phase = self.phase[s] + numpy.cumsum(steps) - steps
+            total = float(steps.sum())
+
+        else:
+            phase = self.phase[s] + increment * self.ramp[:m]
+            total = increment * m
+
+        self.phase[s] = (self.phase[s] + total) % PHASE_CYCLE
+
+        return phase.astype(numpy.int64) >> 9, att
+
+    def operator(self, phase, att, sign):
+        phase = phase & 1023
+
+        return self.exp[numpy.minimum(self.logsin[phase] + att, ATTENUATION_MAX - 1)] * sign[phase]
+
+    def feedback_loop(self, phase, att, half: bool, fb: int, history: List[int]):
+        # the modulator with feedback, one sample at a time
+        logsin = self.logsin_list
+        exp = self.exp_list
+
+        shift = 9 - fb
+        limit = ATTENUATION_MAX - 1
+        negative = 0 if half else -1
+
+        y1, y2 = history
+
+        out = [ 0 ] * len(phase)
+
+        for i, (p, a) in enumerate(zip(phase.tolist(), att.tolist())):
+            p = (p + ((y1 + y2) >> shift)) & 1023
+
+            y = exp[min(logsin[p] + a, limit)]
+
+            if p & 512:
+                y *= negative
+
+            out[i] = y
+
+            y2 = y1
+            y1 = y
+
+        return numpy.array(out, dtype=numpy.int64)
+
+    def patch(self, c: int) -> List[int]:
+        if self.regs[0x0e] & 0x20 and c >= 6:
+            return PATCHES[15 + c - 6]
+
+        instrument = self.regs[0x30 + c] >> 4
+
+        return self.regs[0:8] if instrument == 0 else PATCHES[instrument - 1]
+
+    def channel(self, c: int, m: int):
+        regs = self.regs
+
+        p = self.patch(c)
+
+        fnum = regs[0x10 + c] | ((regs[0x20 + c] & 1) << 8)
+        block = (regs[0x20 + c] >> 1) & 7
+        sus = bool(regs[0x20 + c] & 0x20)
+
+        mod_phase, mod_att = self.slot(c * 2, p, 0, fnum, block, sus, (p[2] & 63) * TL_STEP, m)
+        car_phase, car_att = self.slot(c * 2 + 1, p, 1, fnum, block, sus, (regs[0x30 + c] & 15) * VOLUME_STEP, m)
+
+        mod_sign = self.half_sign if p[3] & 0x08 else self.full_sign
+        car_sign = self.half_sign if p[3] & 0x10 else self.full_sign
+
+        fb = p[3] & 7
+        history = self.feedback[c]
+
+        if fb > FEEDBACK_ITERATED:
+            mod = self.feedback_loop(mod_phase, mod_att, bool(p[3] & 0x08), fb, history)
+
+        else:
+            mod = self.operator(mod_phase, mod_att, mod_sign)
+
+        if fb and fb <= FEEDBACK_ITERATED and m:
+            for i in range(FEEDBACK_PASSES):
+                previous = numpy.concatenate(([ history[0] ], mod[:-1]))
+                before = numpy.concatenate(([ history[1], history[0] ], mod[:-2]))[:m]
+
+                mod = self.operator(mod_phase + ((previous + before) >> (9 - fb)), mod_att, mod_sign)
+
+        if m >= 2:
+            self.feedback[c] = [ int(mod[-1]), int(mod[-2]) ]
+
+        elif m == 1:
+            self.feedback[c] = [ int(mod[0]), history[0] ]
+
+        return self.operator(car_phase + mod, car_att, car_sign)
+
+    def rhythm(self, m: int):
+        # hi-hat, snare drum, tom and top cymbal (the bass drum is a normal
+        # channel); the noisy ones are made of phase bits of the hi-hat
+        # and cymbal operators and the noise generator
+        regs = self.regs
+
+        fnum7 = regs[0x17] | ((regs[0x27] & 1) << 8)
+        block7 = (regs[0x27] >> 1) & 7
+        sus7 = bool(regs[0x27] & 0x20)
+
+        fnum8 = regs[0x18] | ((regs[0x28] & 1) << 8)
+        block8 = (regs[0x28] >> 1) & 7
+        sus8 = bool(regs[0x28] & 0x20)
+
+        hh, hh_att = self.slot(14, PATCHES[16], 0, fnum7, block7, sus7, (regs[0x37] >> 4) * VOLUME_STEP, m)
+        sd, sd_att = self.slot(15, PATCHES[16], 1, fnum7, block7, sus7, (regs[0x37] & 15) * VOLUME_STEP, m)
+        tom, tom_att = self.slot(16, PATCHES[17], 0, fnum8, block8, sus8, (regs[0x38] >> 4) * VOLUME_STEP, m)
+        cym, cym_att = self.slot(17, PATCHES[17], 1, fnum8, block8, sus8, (regs[0x38] & 15) * VOLUME_STEP, m)
+
+        noise = self.noise[(self.noise_index + self.ticks[:m]) % NOISE_LENGTH].astype(numpy.int64)
+
+        res1 = (((hh >> 2) ^ (hh >> 7)) | (hh >> 3)) & 1
+        res2 = ((cym >> 3) ^ (cym >> 5)) & 1
+        res = res1 | res2
+
+        hh_phase = numpy.where(noise, numpy.where(res, 0x2d0, 0x34), numpy.where(res, 0x234, 0xd0))
+        sd_phase = numpy.where((hh >> 8) & 1, 0x200, 0x100) ^ (noise << 8)
+        cym_phase = numpy.where(res, 0x300, 0x100)
+
+        out = self.operator(hh_phase, hh_att, self.full_sign)
+        out += self.operator(sd_phase, sd_att, self.full_sign)
+        out += self.operator(tom, tom_att, self.full_sign)
+        out += self.operator(cym_phase, cym_att, self.full_sign)
+
+        return out
+
+    def generate(self, m: int):
+        if len(self.ramp) < m:
+            self.ramp = numpy.arange(m, dtype=numpy.float64)
+            self.ticks = numpy.arange(m, dtype=numpy.int64)
+
+        out = numpy.zeros(m)
+
+        rhythm = self.regs[0x0e] & 0x20
+
+        if all([ stage == OFF for stage in self.stage ]):
+            self.lfo += m
+            return out
+
+        t = (self.lfo + self.ramp[:m]) / self.rate
+
+        # triangle
+        self.tremolo = (AM_DEPTH * numpy.abs(((t * AM_RATE) % 1.0) * 2 - 1)).astype(numpy.int64)
+        self.vibrato = 1 + PM_DEPTH * numpy.sin(2 * math.pi * PM_RATE * t)
+
+        for c in range(9):
+            if rhythm and c >= 7:
+                break
+
+            # a channel is heard through its carrier
+            if self.stage[c * 2 + 1] == OFF:
+                continue
+
+            if rhythm and c == 6:
+                out += 2 * self.channel(c, m)
+
+            else:
+                out += self.channel(c, m)
+
+        if rhythm and any([ stage != OFF for stage in self.stage[14:18] ]):
+            out += 2 * self.rhythm(m)
+
+        self.noise_index = (self.noise_index + m) % NOISE_LENGTH
+        self.lfo += m
+
+        return out / 8192
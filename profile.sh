@@ -11,7 +11,6 @@ DIR=`mktemp -d`
 cp *py zex*.com $DIR/
 
 pushd $DIR
-sed -i 's/self.debug.*/pass/g' z80.py
 python3 -m cProfile ./zex.py $DURATION | tee $ORGD/profile.txt
 
 rm -rf $DIR
@@ -0,0 +1,220 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import time
+from typing import Callable, Dict, List, Tuple
+from z80 import FREQ_CLOCK
+
+# Counts executed instructions and T-states per PC, per opcode (with its
+# CB/ED/DD/FD/DDCB/FDCB prefix) and per slot/page, and keeps a call graph
+# by following CALL/RST/RET and interrupts. Enabled by z80.enable_profile()
+# which puts wrap() around every entry of the main dispatch table.
+
+CALLS = { 0xcd } | { 0xc4 + i * 8 for i in range(8) } | { 0xc7 + i * 8 for i in range(8) }
+RETS = { 0xc9 } | { 0xc0 + i * 8 for i in range(8) }
+ED_RETS = { 0x45, 0x4d, 0x55, 0x5d, 0x65, 0x6d, 0x75, 0x7d }
+
+# IN/OUT, INI/OUTI etc
+ED_IO = { 0x40 + i * 8 for i in range(8) } | { 0x41 + i * 8 for i in range(8) } | \
+        { 0xa2, 0xa3, 0xaa, 0xab, 0xb2, 0xb3, 0xba, 0xbb }
+
+MAX_DEPTH = 4096
+
+class profiler:
+    def __init__(self, cpu, peek: Callable[[int], int], region: Callable[[int], Tuple[int, int, int]] = None):
+        self.cpu = cpu
+        self.peek = peek
+
+        # pc -> (slot, sub-slot, page) of where that code lives
+        self.region = region
+
+        # -> [ count, T-states ]
+        self.pcs: Dict[int, List[int]] = dict()
+        self.opcodes: Dict[Tuple[int, ...], List[int]] = dict()
+        self.regions: Dict[Tuple[int, int, int], List[int]] = dict()
+
+        # call graph: stack of [ routine, address of the return address,
+        # T-state at entry ]; routine -> [ calls, self T-states, inclusive
+        # T-states ], (caller, routine) -> [ calls, inclusive T-states ]
+        self.stack: List[list] = [ ]
+        self.routines: Dict[int, List[int]] = dict()
+        self.edges: Dict[Tuple[int, int], List[int]] = dict()
+
+        # where the next instruction is expected; if it is somewhere else
+        # with a return address pushed, an interrupt was taken
+        self.next_pc: int = -1
+        self.next_sp: int = -1
+
+        self.instructions: int = 0
+        self.cycles: int = 0
+        self.io_cycles: int = 0
+        self.halt_cycles: int = 0
+
+        self.start_t: int = cpu.scheduler.now
+        self.start_wall: float = time.time()
+
+    def wrap(self, handler):
+        cpu = self.cpu
+        peek = self.peek
+
+        def profiled(instr: int) -> int:
+            pc = (cpu.pc - 1) & 0xffff
+            sp = cpu.sp
+
+            if pc != self.next_pc and sp == ((self.next_sp - 2) & 0xffff):
+                self.enter(pc, sp, cpu.scheduler.now)
+
+            if instr == 0xcb or instr == 0xed:
+                key = (instr, peek((pc + 1) & 0xffff))
+
+            elif instr == 0xdd or instr == 0xfd:
+                op2 = peek((pc + 1) & 0xffff)
+
+                if op2 == 0xcb:
+                    key = (instr, op2, peek((pc + 3) & 0xffff))
+
+                else:
+                    key = (instr, op2)
+
+            else:
+                key = (instr, )
+
+            cycles = handler(instr)
+
+            self.account(key, pc, sp, cycles)
+
+            return cycles
+
+        return profiled
+
+    def add(self, d: dict, key, cycles: int) -> None:
+        e = d.get(key)
+
+        if e:
+            e[0] += 1
+            e[1] += cycles
+
+        else:
+            d[key] = [ 1, cycles ]
+
+    def account(self, key: Tuple[int, ...], pc: int, sp: int, cycles: int) -> None:
+        cpu = self.cpu
+
+        self.instructions += 1
+        self.cycles += cycles
+
+        self.add(self.pcs, pc, cycles)
+        self.add(self.opcodes, key, cycles)
+
+        if self.region:
+            self.add(self.regions, self.region(pc), cycles)
+
+        instr = key[0]
+
+        if instr == 0x76:
+            self.halt_cycles += cycles
+
+        elif instr == 0xd3 or instr == 0xdb or (instr == 0xed and key[1] in ED_IO):
+            self.io_cycles += cycles
+
+        # self time goes to the routine that is running
+        routine = self.stack[-1][0] if self.stack else -1
+
+        r = self.routines.get(routine)
+        if r is None:
+            r = self.routines[routine] = [ 0, 0, 0 ]
+
+        r[1] += cycles
+
+        t = cpu.scheduler.now + cycles
+
+        if len(key) == 1 and instr in CALLS and cpu.sp == ((sp - 2) & 0xffff):
+            self.enter(cpu.pc, cpu.sp, t)
+
+        elif ((len(key) == 1 and instr in RETS) or (instr == 0xed and key[1] in ED_RETS)) and cpu.sp == ((sp + 2) & 0xffff):
+            self.leave(sp, t)
+
+        self.next_pc = cpu.pc
+        self.next_sp = cpu.sp
+
+    def enter(self, routine: int, sp: int, t: int) -> None:
+        caller = self.stack[-1][0] if self.stack else -1
+
+        self.stack.append([ routine, sp, t ])
+
+        if len(self.stack) > MAX_DEPTH:  # never returned
+            del self.stack[0]
+
+        r = self.routines.get(routine)
+        if r is None:
+            r = self.routines[routine] = [ 0, 0, 0 ]
+
+        r[0] += 1
+
+        e = self.edges.get((caller, routine))
+        if e is None:
+            e = self.edges[(caller, routine)] = [ 0, 0 ]
+
+        e[0] += 1
+
+    def leave(self, sp: int, t: int) -> None:
+        # also drops frames that were abandoned (stack pointer reloaded,
+        # return address popped)
+        while self.stack and self.stack[-1][1] <= sp:
+            routine, frame_sp, start = self.stack.pop()
+            caller = self.stack[-1][0] if self.stack else -1
+
+            self.routines[routine][2] += t - start
+            self.edges[(caller, routine)][1] += t - start
+
+            if frame_sp == sp:
+                break
+
+    def name(self, a: int) -> str:
+        return 'top' if a == -1 else '%04x' % a
+
+    def report(self, fh, top: int = 40) -> None:
+        # the CPU may still be running: take copies first
+        pcs = list(self.pcs.items())
+        opcodes = list(self.opcodes.items())
+        regions = list(self.regions.items())
+        routines = list(self.routines.items())
+        edges = list(self.edges.items())
+
+        total = max(1, self.cycles)
+        emulated = (self.cpu.scheduler.now - self.start_t) / FREQ_CLOCK
+        took = time.time() - self.start_wall
+
+        fh.write('instructions: %d, T-states: %d\n' % (self.instructions, self.cycles))
+        fh.write('emulated: %.2fs, host: %.2fs (%.1f%% of real time)\n' % (emulated, took, emulated * 100 / max(took, 0.001)))
+        fh.write('T-states in I/O instructions: %.1f%%, halted: %.1f%%\n' % (self.io_cycles * 100 / total, self.halt_cycles * 100 / total))
+
+        fh.write('\nper PC\n')
+        fh.write('   pc      count      T-states      %\n')
+        for pc, (count, cycles) in sorted(pcs, key=lambda x: -x[1][1])[0:top]:
+            fh.write(' %04x %10d %13d %6.2f\n' % (pc, count, cycles, cycles * 100 / total))
+
+        fh.write('\nper opcode\n')
+        fh.write(' opcode        count      T-states      %\n')
+        for key, (count, cycles) in sorted(opcodes, key=lambda x: -x[1][1])[0:top]:
+            fh.write(' %-11s %10d %13d %6.2f\n' % (' '.join([ '%02x' % b for b in key ]), count, cycles, cycles * 100 / total))
+
+        if regions:
+            fh.write('\nper slot/page\n')
+            fh.write(' slot  page        count      T-states      %\n')
+            for (slot, subslot, page), (count, cycles) in sorted(regions):
+                fh.write('  %d-%d     %d   %10d %13d %6.2f\n' % (slot, subslot, page, count, cycles, cycles * 100 / total))
+
+        fh.write('\nroutines (CALL/RST/interrupt targets)\n')
+        fh.write(' routine      calls   self T-states      %    incl. T-states\n')
+        for routine, (calls, self_cycles, incl_cycles) in sorted(routines, key=lambda x: -x[1][1])[0:top]:
+            fh.write(' %-7s %10d %15d %6.2f %17d\n' % (self.name(routine), calls, self_cycles, self_cycles * 100 / total, incl_cycles))
+
+        fh.write('\ncall graph\n')
+        fh.write(' caller  routine      calls    incl. T-states\n')
+        for (caller, routine), (calls, incl_cycles) in sorted(edges, key=lambda x: -x[1][1])[0:top * 2]:
+            fh.write(' %-7s %-7s %10d %17d\n' % (self.name(caller), self.name(routine), calls, incl_cycles))
+
+    def write_report(self, file_name: str) -> None:
+        with open(file_name, 'w') as fh:
+            self.report(fh)
@@ -0,0 +1,213 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import numpy  # type: ignore
+from typing import List
+from resampler import resampler
+
+# AY-3-8910 synthesis. The chip is emulated at clock / 8: a tone output
+# flips every 'period' ticks (so it runs at clock / 16 / period), the
+# noise shift register (17 bits, taps 0 and 3) shifts every 2 * period
+# ticks and the envelope takes a step every 32 * period ticks. A whole
+# buffer is generated at once from the counter positions and then
+# brought to the output rate by a band-limited resampler.
+#
+# Register writes can be given with the position in the buffer at which
+# they happened. Generation is then split at those positions, except for
+# writes to the volume registers (digitized sound changes them thousands
+# of times per second): those are put in an array of levels instead.
+
+# logarithmic DAC, 16 levels
+VOLUME = numpy.array([ 0.0, 0.00999, 0.01445, 0.02106, 0.03070, 0.04555, 0.06450, 0.10736,
+                       0.12659, 0.20498, 0.29221, 0.37257, 0.49253, 0.63532, 0.80558, 1.0 ])
+
+NOISE_LENGTH = (1 << 17) - 1
+
+def noise_sequence():
+    out = bytearray(NOISE_LENGTH)
+
+    rng = 1
+
+    for i in range(NOISE_LENGTH):
+        rng = (rng >> 1) | (((rng ^ (rng >> 3)) & 1) << 16)
+        out[i] = rng & 1
+
+    return numpy.frombuffer(out, dtype=numpy.uint8)
+
+def envelope_shapes():
+    # -> for each value of register 13: the levels of the first 32 steps
+    # and whether the last one is held
+    shapes = [ ]
+
+    for shape in range(16):
+        continue_ = shape & 8
+        attack = shape & 4
+        alternate = shape & 2
+        hold = shape & 1
+
+        first = list(range(16)) if attack else list(range(15, -1, -1))
+
+        if not continue_:
+            second = [ 0 ] * 16
+
+        elif hold:
+            second = [ first[0] if alternate else first[-1] ] * 16
+
+        elif alternate:
+            second = first[::-1]
+
+        else:
+            second = first
+
+        shapes.append((numpy.array(first + second, dtype=numpy.intp), not continue_ or hold))
+
+    return shapes
+
+class psg:
+    def __init__(self, clock: float, sample_rate: int):
+        self.regs: List[int] = [ 0 ] * 16
+
+        self.noise = noise_sequence()
+        self.shapes = envelope_shapes()
+
+        # counters: ticks since the last flip/shift/step
+        self.tone_pos: List[int] = [ 0, 0, 0 ]
+        self.tone_out: List[int] = [ 0, 0, 0 ]
+        self.noise_pos: int = 0
+        self.noise_index: int = 0
+        self.env_pos: int = 0
+        self.env_step: int = 0
+
+        self.resampler = resampler(clock / 8, sample_rate)
+
+        self.ticks = numpy.zeros(0, dtype=numpy.int64)
+
+    def write(self, a: int, v: int) -> None:
+        self.regs[a] = v
+
+        if a == 13:  # restarts the envelope
+            self.env_pos = 0
+            self.env_step = 0
+
+    def render(self, n: int, events: List[tuple] = ()):
+        # -> n samples at the output rate, the sum of the 3 channels (0...3)
+        # 'events' are (output sample position, register, value), in order
+        m = self.resampler.needed(n)
+
+        if not events:
+            return self.resampler.resample(self.generate(m), n)
+
+        parts = [ ]
+        start = 0
+        volumes: List[tuple] = [ ]
+
+        for pos, a, v in events:
+            tick = min(m, max(start, self.resampler.input_offset(pos)))
+
+            if a in (8, 9, 10):
+                volumes.append((tick - start, a - 8, v))
+                continue
+
+            if tick > start:
+                parts.append(self.generate(tick - start, volumes))
+                start = tick
+                volumes = [ ]
+
+            self.write(a, v)
+
+        parts.append(self.generate(m - start, volumes))
+
+        return self.resampler.resample(numpy.concatenate(parts), n)
+
+    def levels(self, ch: int, envelope, m: int, volumes: List[tuple]):
+        # -> level of channel 'ch' per tick while its volume register is
+        # changed at the given ticks, or None when it stays silent
+        amplitudes = [ (0, self.regs[8 + ch]) ] + [ (tick, v) for tick, c, v in volumes if c == ch ]
+
+        self.regs[8 + ch] = amplitudes[-1][1]
+
+        if len(amplitudes) == 1:
+            amplitude = amplitudes[0][1]
+
+            if amplitude & 16:
+                return envelope
+
+            if amplitude & 15:
+                return VOLUME[amplitude & 15]
+
+            return None
+
+        out = numpy.empty(m)
+
+        for i, (tick, amplitude) in enumerate(amplitudes):
+            end = amplitudes[i + 1][0] if i + 1 < len(amplitudes) else m
+
+            if end > tick:
+                out[tick:end] = envelope[tick:end] if amplitude & 16 else VOLUME[amplitude & 15]
+
+        return out
+
+    def generate(self, m: int, volumes: List[tuple] = ()):
+        # 'volumes': (tick, channel, value) for the volume registers
+        regs = self.regs
+
+        if len(self.ticks) < m:
+            self.ticks = numpy.arange(m, dtype=numpy.int64)
+
+        t = self.ticks[:m]
+
+        out = numpy.zeros(m)
+
+        mixer = regs[7]
+
+        noise = None
+        noise_period = 2 * max(1, regs[6] & 31)
+
+        if (mixer & 0x38) != 0x38:
+            noise = self.noise[(self.noise_index + (self.noise_pos + t) // noise_period) % NOISE_LENGTH]
+
+        total = self.noise_pos + m
+        self.noise_index = (self.noise_index + total // noise_period) % NOISE_LENGTH
+        self.noise_pos = total % noise_period
+
+        levels, held = self.shapes[regs[13] & 15]
+        env_period = 32 * max(1, regs[11] | (regs[12] << 8))
+
+        envelope = None
+
+        if (regs[8] | regs[9] | regs[10]) & 16 or any([ v & 16 for tick, ch, v in volumes ]):
+            steps = self.env_step + (self.env_pos + t) // env_period
+
+            steps = numpy.minimum(steps, 31) if held else steps & 31
+
+            envelope = VOLUME[levels[steps]]
+
+        total = self.env_pos + m
+        self.env_step += total // env_period
+        self.env_step = min(self.env_step, 32) if held else self.env_step & 31
+        self.env_pos = total % env_period
+
+        for ch in range(3):
+            period = max(1, regs[ch * 2] | ((regs[ch * 2 + 1] & 15) << 8))
+
+            # a counter beyond a (just lowered) period flips at the next tick
+            pos = min(self.tone_pos[ch], period - 1)
+
+            level = self.levels(ch, envelope, m, volumes)
+
+            if level is not None:
+                gate = 1
+
+                if not mixer & (1 << ch):
+                    gate = self.tone_out[ch] ^ (((pos + t) // period) & 1)
+
+                if noise is not None and not mixer & (8 << ch):
+                    gate = gate & noise
+
+                out += level * gate
+
+            total = pos + m
+            self.tone_out[ch] ^= (total // period) & 1
+            self.tone_pos[ch] = total % period
+
+        return out
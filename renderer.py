@@ -60,6 +60,8 @@ class Renderer:
         self.keys[6] = ( pygame.K_LSHIFT, pygame.K_LCTRL, None, pygame.K_CAPSLOCK, None, pygame.K_F1, pygame.K_F2, pygame.K_F3 )
         self.keys[7] = ( pygame.K_F4, pygame.K_F5, pygame.K_ESCAPE, pygame.K_TAB, None, pygame.K_BACKSPACE, None, pygame.K_RETURN )
         self.keys[8] = ( pygame.K_SPACE, None, None, None, pygame.K_LEFT, pygame.K_UP, pygame.K_DOWN, pygame.K_RIGHT )
+        # not on the MSX: keys of the emulator itself (F12: rewind)
+        self.keys[15] = ( pygame.K_F12, )
 
     def kb_poll(self) -> None:
         events = pygame.fastevent.get()
@@ -82,7 +84,14 @@ class Renderer:
                 print(event)
 
     def kb_read(self) -> int:
-        cur_row = self.keys[self.keyboard_row]
+        # row 15 is not on the MSX (emulator keys), see kb_init()
+        if self.keyboard_row == 15:
+            return 255
+
+        return self.kb_read_row(self.keyboard_row)
+
+    def kb_read_row(self, row: int) -> int:
+        cur_row = self.keys[row]
         if not cur_row:
             # print('kb fail', self.keyboard_row)
             return 255
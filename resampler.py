@@ -0,0 +1,66 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import numpy  # type: ignore
+
+# Band-limited sample rate conversion for the sound chips, which are
+# synthesized at (a fraction of) their own clock. A windowed-sinc low-pass
+# filter is precomputed for 'phases' fractional positions between two
+# input samples (polyphase); every output sample is the dot product of
+# 'taps' input samples with the filter of the nearest phase.
+#
+# Pull model: needed(n) tells how many new input samples are required to
+# produce n output samples, resample(x, n) then returns them. The input
+# that is still required for the next call is kept.
+
+class resampler:
+    def __init__(self, in_rate: float, out_rate: float, taps: int = 32, phases: int = 256):
+        self.step = in_rate / out_rate
+        self.taps = taps
+        self.phases = phases
+
+        # pass band up to 90% of the Nyquist frequency of the lowest rate
+        cutoff = 0.9 * min(1.0, out_rate / in_rate)
+
+        self.offsets = numpy.arange(taps) - (taps // 2 - 1)
+
+        x = self.offsets[None, :] - numpy.arange(phases + 1)[:, None] / phases
+
+        h = cutoff * numpy.sinc(cutoff * x) * (0.42 + 0.5 * numpy.cos(numpy.pi * x / (taps / 2)) + 0.08 * numpy.cos(2 * numpy.pi * x / (taps / 2)))  # Blackman
+
+        self.coefficients = h / h.sum(axis=1)[:, None]
+
+        self.history = numpy.zeros(taps)
+        self.pos: float = taps // 2 - 1
+
+        self.ramp = numpy.zeros(0)
+
+    def needed(self, n: int) -> int:
+        last = self.pos + (n - 1) * self.step
+
+        return max(0, int(last) + self.taps // 2 + 1 - len(self.history))
+
+    def input_offset(self, pos: float) -> int:
+        # -> index in the next input of the sample at output position 'pos'
+        return int(self.pos + pos * self.step) + 1 - len(self.history)
+
+    def resample(self, x, n: int):
+        if len(self.ramp) < n:
+            self.ramp = numpy.arange(n, dtype=numpy.float64)
+
+        buf = numpy.concatenate((self.history, x))
+
+        p = self.pos + self.step * self.ramp[:n]
+
+        i = p.astype(numpy.intp)
+        phase = ((p - i) * self.phases + 0.5).astype(numpy.intp)
+
+        out = numpy.einsum('ij,ij->i', buf[i[:, None] + self.offsets[None, :]], self.coefficients[phase])
+
+        following = self.pos + self.step * n
+        keep = int(following) - (self.taps // 2 - 1)
+
+        self.history = buf[keep:]
+        self.pos = following - keep
+
+        return out
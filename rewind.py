@@ -0,0 +1,154 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import collections
+import zlib
+from typing import Dict
+import savestate
+
+# Rewind: every 'interval' frames a snapshot (see savestate.py) is taken.
+# Only the newest one is kept as is; for each older one a delta is kept
+# that turns its successor back into it. Large memory blocks (mapper RAM,
+# VRAM) are compared in chunks and only the chunks that changed are
+# stored, XOR-ed with the newer contents, everything else that changed
+# is stored as its old value. The deltas are zlib compressed.
+#
+# When the newest snapshot plus the deltas take more than 'budget' bytes,
+# the oldest deltas are dropped.
+
+CHUNK = 4096
+
+SAME = [ 's' ]
+
+def xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+def has_blocks(v) -> bool:
+    return any([ isinstance(e, (bytes, dict, list)) for e in v ])
+
+def diff(new, old):
+    # -> what apply() needs to get 'old' from 'new'
+    if new == old:
+        return SAME
+
+    if isinstance(new, bytes) and isinstance(old, bytes) and len(new) == len(old) and len(new) > CHUNK:
+        chunks = [ ]
+
+        for o in range(0, len(new), CHUNK):
+            a = new[o:o + CHUNK]
+            b = old[o:o + CHUNK]
+
+            if a != b:
+                chunks.append([ o, xor(a, b) ])
+
+        return [ 'x', chunks ]
+
+    if isinstance(new, dict) and isinstance(old, dict) and new.keys() == old.keys():
+        return [ 'd', { key: diff(new[key], old[key]) for key in new } ]
+
+    if isinstance(new, list) and isinstance(old, list) and len(new) == len(old) and has_blocks(old):
+        return [ 'l', [ diff(a, b) for a, b in zip(new, old) ] ]
+
+    return [ 'v', old ]
+
+def apply(new, d):
+    t = d[0]
+
+    if t == 's':
+        return new
+
+    if t == 'v':
+        return d[1]
+
+    if t == 'd':
+        return { key: apply(new[key], e) for key, e in d[1].items() }
+
+    if t == 'l':
+        return [ apply(a, e) for a, e in zip(new, d[1]) ]
+
+    if t == 'x':
+        out = bytearray(new)
+
+        for o, x in d[1]:
+            out[o:o + len(x)] = xor(new[o:o + len(x)], x)
+
+        return bytes(out)
+
+    raise ValueError('rewind delta is corrupt (%s)' % t)
+
+def state_size(v) -> int:
+    if isinstance(v, bytes):
+        return len(v)
+
+    if isinstance(v, dict):
+        return sum([ state_size(e) for e in v.values() ]) + 8 * len(v)
+
+    if isinstance(v, list):
+        return sum([ state_size(e) for e in v ]) + 8 * len(v)
+
+    return 8
+
+class rewind:
+    def __init__(self, objects: Dict[str, object], interval: int, budget: int):
+        # 'objects' as for savestate.capture()
+        self.objects = objects
+        self.interval = interval
+        self.budget = budget
+
+        self.head = None
+        self.head_size: int = 0
+
+        self.deltas = collections.deque()
+        self.deltas_size: int = 0
+
+        # frames run since the newest snapshot
+        self.frames: int = 0
+
+    def frame(self) -> None:
+        # to be invoked after every emulated frame
+        self.frames += 1
+
+        if self.frames >= self.interval:
+            self.record()
+
+    def record(self) -> None:
+        state = savestate.capture(self.objects)
+
+        if self.head is not None:
+            out = bytearray()
+            savestate.encode(out, diff(state, self.head))
+
+            delta = zlib.compress(out, 1)
+
+            self.deltas.append(delta)
+            self.deltas_size += len(delta)
+
+        self.head = state
+        self.head_size = state_size(state)
+
+        self.frames = 0
+
+        while self.deltas and self.head_size + self.deltas_size > self.budget:
+            self.deltas_size -= len(self.deltas.popleft())
+
+    def step_back(self) -> bool:
+        # back to the newest snapshot if the machine ran since then, else
+        # to the one before it; False when there's nothing further back
+        if self.head is None:
+            return False
+
+        if self.frames == 0:
+            if not self.deltas:
+                return False
+
+            delta = self.deltas.pop()
+            self.deltas_size -= len(delta)
+
+            self.head = apply(self.head, savestate.decode(memoryview(zlib.decompress(delta)), 0)[0])
+            self.head_size = state_size(self.head)
+
+        savestate.restore(self.objects, self.head)
+
+        self.frames = 0
+
+        return True
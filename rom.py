@@ -2,15 +2,13 @@
 # released under AGPL v3.0
 
 import sys
-from typing import List
+from romimage import load_rom_image
 
 class rom:
     def __init__(self, rom_file: str, debug, base_address: int):
         print('Loading ROM %s...' % rom_file, file=sys.stderr)
 
-        fh = open(rom_file, 'rb')
-        self.rom: List[int] = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.rom = load_rom_image(rom_file)
 
         self.base_address: int = base_address
 
@@ -22,6 +20,9 @@ class rom:
     def get_name(self):
         return 'ROM'
 
+    def get_page_mem(self, page: int):
+        return (self.rom, page * 0x4000 - self.base_address, 0x4000, False)
+
     def write_mem(self, a: int, v: int) -> None:
         pass
 
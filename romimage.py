@@ -0,0 +1,32 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import mmap
+import os
+from typing import Dict, List, Tuple
+
+# ROM images are mapped read-only and shared: loading the same file twice
+# (e.g. two cartridges with the same ROM) returns the same object, and
+# forked processes share the pages with the parent.
+
+images: Dict[Tuple[str, int, int], object] = dict()
+
+def load_rom_image(rom_file: str):
+    st = os.stat(rom_file)
+
+    key = (os.path.realpath(rom_file), st.st_size, st.st_mtime_ns)
+
+    if key not in images:
+        with open(rom_file, 'rb') as fh:
+            if st.st_size == 0:
+                images[key] = b''
+
+            else:
+                images[key] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return images[key]
+
+def get_banks(image, bank_size: int) -> List[memoryview]:
+    mv = memoryview(image)
+
+    return [ mv[i:i + bank_size] for i in range(0, len(image), bank_size) ]
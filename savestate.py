@@ -0,0 +1,206 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import lzma
+import struct
+import zlib
+from typing import Dict, Tuple
+
+# Machine snapshots. Every object that has state implements get_state()
+# which returns a dict of ints, strings, bytes (RAM, VRAM), lists and
+# dicts, and set_state() which puts such a dict back. capture() collects
+# them under a name, restore() hands them back in the same order (so the
+# scheduler is restored before the devices that re-add their events and
+# the bus is rebuilt after the memory behind it was restored).
+#
+# On disk: MAGIC, version, compression and then the (compressed) states
+# in a small tagged binary encoding; bytes are written as-is.
+
+MAGIC = b'PYMSXSS1'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHB')
+
+COMPRESSION = { 'none': 0, 'zlib': 1, 'lzma': 2 }
+
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_BYTES = 6
+T_LIST = 7
+T_DICT = 8
+
+U32 = struct.Struct('<I')
+DOUBLE = struct.Struct('<d')
+
+def encode(out: bytearray, v) -> None:
+    if v is None:
+        out.append(T_NONE)
+
+    elif v is False:
+        out.append(T_FALSE)
+
+    elif v is True:
+        out.append(T_TRUE)
+
+    elif isinstance(v, int):
+        n = (v.bit_length() + 8) // 8
+
+        out.append(T_INT)
+        out.append(n)
+        out += v.to_bytes(n, 'little', signed=True)
+
+    elif isinstance(v, float):
+        out.append(T_FLOAT)
+        out += DOUBLE.pack(v)
+
+    elif isinstance(v, str):
+        data = v.encode('utf-8')
+
+        out.append(T_STR)
+        out += U32.pack(len(data))
+        out += data
+
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        out.append(T_BYTES)
+        out += U32.pack(len(v))
+        out += v
+
+    elif isinstance(v, (list, tuple)):
+        out.append(T_LIST)
+        out += U32.pack(len(v))
+
+        for e in v:
+            encode(out, e)
+
+    elif isinstance(v, dict):
+        out.append(T_DICT)
+        out += U32.pack(len(v))
+
+        for key, e in v.items():
+            encode(out, key)
+            encode(out, e)
+
+    else:
+        raise TypeError('cannot store %s in a snapshot' % type(v).__name__)
+
+def decode(data: memoryview, o: int) -> Tuple[object, int]:
+    # -> (value, offset after it)
+    t = data[o]
+    o += 1
+
+    if t == T_NONE:
+        return None, o
+
+    if t == T_FALSE:
+        return False, o
+
+    if t == T_TRUE:
+        return True, o
+
+    if t == T_INT:
+        n = data[o]
+        return int.from_bytes(data[o + 1:o + 1 + n], 'little', signed=True), o + 1 + n
+
+    if t == T_FLOAT:
+        return DOUBLE.unpack_from(data, o)[0], o + DOUBLE.size
+
+    n = U32.unpack_from(data, o)[0]
+    o += U32.size
+
+    if t == T_STR:
+        return str(data[o:o + n], 'utf-8'), o + n
+
+    if t == T_BYTES:
+        return bytes(data[o:o + n]), o + n
+
+    if t == T_LIST:
+        out = [ ]
+
+        for i in range(n):
+            v, o = decode(data, o)
+            out.append(v)
+
+        return out, o
+
+    if t == T_DICT:
+        out = dict()
+
+        for i in range(n):
+            key, o = decode(data, o)
+            out[key], o = decode(data, o)
+
+        return out, o
+
+    raise ValueError('snapshot is corrupt (tag %d)' % t)
+
+def capture(objects: Dict[str, object]) -> dict:
+    return { name: obj.get_state() for name, obj in objects.items() if obj and hasattr(obj, 'get_state') }
+
+def restore(objects: Dict[str, object], states: dict) -> None:
+    for name, obj in objects.items():
+        if name in states and obj and hasattr(obj, 'set_state'):
+            obj.set_state(states[name])
+
+def dumps(states: dict, compression: str = 'zlib') -> bytes:
+    payload = bytearray()
+    encode(payload, states)
+
+    c = COMPRESSION[compression]
+
+    if c == 1:
+        payload = zlib.compress(payload, 1)
+
+    elif c == 2:
+        payload = lzma.compress(payload, preset=1)
+
+    return HEADER.pack(MAGIC, VERSION, c) + payload
+
+def loads(data: bytes) -> dict:
+    if len(data) < HEADER.size:
+        raise ValueError('not a pymsx snapshot')
+
+    magic, version, c = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC:
+        raise ValueError('not a pymsx snapshot')
+
+    if version > VERSION:
+        raise ValueError('snapshot version %d is newer than this emulator supports (%d)' % (version, VERSION))
+
+    if c not in COMPRESSION.values():
+        raise ValueError('unknown snapshot compression %d' % c)
+
+    payload = memoryview(data)[HEADER.size:]
+
+    # a damaged file can make any of these fail in many ways: report
+    # them all as a ValueError, like the checks above
+    try:
+        if c == 1:
+            payload = memoryview(zlib.decompress(payload))
+
+        elif c == 2:
+            payload = memoryview(lzma.decompress(payload))
+
+        states, o = decode(payload, 0)
+
+    except (zlib.error, lzma.LZMAError, struct.error, IndexError, TypeError, RecursionError) as e:
+        raise ValueError('snapshot is corrupt (%s)' % e)
+
+    if o != len(payload) or not isinstance(states, dict):
+        raise ValueError('snapshot is corrupt (truncated or trailing data)')
+
+    return states
+
+def save(file_name: str, states: dict, compression: str = 'zlib') -> None:
+    data = dumps(states, compression)
+
+    with open(file_name, 'wb') as fh:
+        fh.write(data)
+
+def load(file_name: str) -> dict:
+    with open(file_name, 'rb') as fh:
+        return loads(fh.read())
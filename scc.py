@@ -3,17 +3,20 @@
 
 import sys
 from typing import List, Tuple
+from romimage import load_rom_image
 
 class scc:
     def __init__(self, scc_rom_file, snd, debug):
         print('Loading SCC rom %s...' % scc_rom_file, file=sys.stderr)
 
-        fh = open(scc_rom_file, 'rb')
-        self.scc_rom = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.scc_rom = load_rom_image(scc_rom_file)
 
         self.n_pages: int = (len(self.scc_rom) + 0x1fff) // 0x2000
 
+        # 16kB windows starting at each 8kB bank
+        mv = memoryview(self.scc_rom)
+        self.windows = [ mv[i * 0x2000:i * 0x2000 + 0x4000] for i in range(0, self.n_pages) ]
+
         self.scc_pages: List[int] = [ 0, 1, 2, 3 ]
 
         self.snd = snd
@@ -35,6 +38,22 @@ class scc:
 
         return bank, offset
 
+    def get_page_mem(self, page: int):
+        first = self.scc_pages[page * 2 - 2]
+
+        # only when both 8kB banks are consecutive in the ROM
+        if self.scc_pages[page * 2 - 1] != first + 1:
+            return None
+
+        return (self.windows[first], 0, 0x4000, False)
+
+    def get_state(self) -> dict:
+        return { 'pages': list(self.scc_pages) }
+
+    def set_state(self, state: dict) -> None:
+        # the sound registers are part of the PSG/SCC sound state
+        self.scc_pages = list(state['pages'])
+
     def write_mem(self, a: int, v: int) -> None:
         bank, offset = self.split_addr(a)
 
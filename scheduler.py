@@ -0,0 +1,65 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import heapq
+from typing import Callable, List
+
+# Devices register events at a point in emulated time (T-states since
+# power-on), the CPU runs until the first one is due and then calls
+# run_due(). Callbacks get the time they were scheduled for so that
+# periodic events can re-add themselves without drifting.
+
+class scheduler:
+    NEVER = 1 << 64
+
+    def __init__(self):
+        self.now: int = 0
+        self.next_event: int = scheduler.NEVER
+
+        self.events: List[list] = [ ]
+        self.seq: int = 0
+
+    def add(self, delay: int, callback: Callable[[int], None]) -> list:
+        return self.add_at(self.now + delay, callback)
+
+    def add_at(self, when: int, callback: Callable[[int], None]) -> list:
+        # seq keeps events that are due at the same time in order
+        event = [ when, self.seq, callback ]
+        self.seq += 1
+
+        heapq.heappush(self.events, event)
+
+        if when < self.next_event:
+            self.next_event = when
+
+        return event
+
+    def cancel(self, event: list) -> None:
+        event[2] = None
+
+        while self.events and self.events[0][2] is None:
+            heapq.heappop(self.events)
+
+        self.next_event = self.events[0][0] if self.events else scheduler.NEVER
+
+    def run_due(self) -> None:
+        events = self.events
+
+        while events and events[0][0] <= self.now:
+            when, seq, callback = heapq.heappop(events)
+
+            if callback:
+                callback(when)
+
+        self.next_event = events[0][0] if events else scheduler.NEVER
+
+    def get_state(self) -> dict:
+        return { 'now': self.now }
+
+    def set_state(self, state: dict) -> None:
+        # pending events belong to the old session: their owners add them
+        # again in their own set_state()
+        self.now = state['now']
+
+        self.events = [ ]
+        self.next_event = scheduler.NEVER
@@ -3,22 +3,16 @@
 
 import os
 import signal
-import struct
 import sys
 import threading
-from enum import IntEnum
+from multiprocessing import shared_memory
 from vdp import vdp
 
 class screen_kb:
-    class Msg(IntEnum):
-        SET_IO = 0
-        GET_IO = 1
-        INTERRUPT = 2
-        GET_REG = 3
-
-    def __init__(self, io, options):
+    def __init__(self, io, options, sched=None):
         self.stop_flag = False
         self.io = io
+        self.scheduler = sched
 
         self.keyboard_queue = []
         self.k_lock = threading.Lock()
@@ -33,106 +27,96 @@ class screen_kb:
     def get_ios(self):
         return [ [ 0x98, 0x99, 0xa9, 0xaa ] , [ 0x98, 0x99, 0x9a, 0x9b, 0xaa ] ]
 
+    def get_block_ios(self):
+        return [ [ 0x98 ], [ 0x98 ] ]
+
     def get_name(self):
         return 'screen/keyboard'
 
     def init_screen(self, options):
-        # pipes for data to the VDP
-        self.pipe_tv_in, self.pipe_tv_out = os.pipe()       
+        wrescale = int(options.wrescale) if options.wrescale else 1
+        hrescale = int(options.hrescale) if options.hrescale else 1
+        scanline = float(options.scanline) / 100.0 if options.scanline else 0
+
+        if options.vdp_thread:
+            self.init_in_process(wrescale, hrescale, scanline)
+            return
 
-        # pipes for data from the VDP
-        self.pipe_fv_in, self.pipe_fv_out = os.pipe()       
+        # VRAM, registers, palette and keyboard state are shared with the
+        # display process, only frame notifications go through the pipe
+        self.shm = shared_memory.SharedMemory(create=True, size=vdp.SHM_SIZE)
+
+        self.pipe_tv_in, self.pipe_tv_out = os.pipe()
 
         self.pid = os.fork()
 
         if self.pid == 0:
-            wrescale = int(options.wrescale) if options.wrescale else 1
-            hrescale = int(options.hrescale) if options.hrescale else 1
-            scanline = float(options.scanline) / 100.0 if options.scanline else 0
+            os.close(self.pipe_tv_out)
+
             self.vdp = vdp(wrescale, hrescale, scanline)
+            self.vdp.use_shared_memory(self.shm.buf)
             self.vdp.start()
-            
-            while True:
-                type_ = os.read(self.pipe_tv_in, 1)[0]
-
-                if type_ == screen_kb.Msg.SET_IO:
-                    data = os.read(self.pipe_tv_in, 2)
-                    a = data[0]
-                    v = data[1]
-
-                    self.vdp.write_io(a, v)
-
-                elif type_ == screen_kb.Msg.GET_IO:
-                    a = os.read(self.pipe_tv_in, 1)[0]
-                    v = self.vdp.read_io(a)
-
-                    packet = ( screen_kb.Msg.GET_IO, a, v )
-                    os.write(self.pipe_fv_out, bytearray(packet))
 
-                elif type_ == screen_kb.Msg.INTERRUPT:
-                    self.vdp.interrupt()
-
-                    # interrupt ack
-                    packet = ( screen_kb.Msg.INTERRUPT, 123 )
-                    os.write(self.pipe_fv_out, bytearray(packet))
-
-                elif type_ == screen_kb.Msg.GET_REG:
-                    a = os.read(self.pipe_tv_in, 1)[0]
+            while True:
+                data = os.read(self.pipe_tv_in, 64)
+                if not data:  # emulator went away
+                    break
 
-                    packet = ( screen_kb.Msg.GET_REG, self.vdp.registers[a] )
-                    os.write(self.pipe_fv_out, bytearray(packet))
+                self.vdp.frame_done()
 
-                else:
-                    print('Unexpected message %d' % type_)
+            self.vdp.stop()
+            self.vdp.release_shared_memory()
 
-            sys.exit(1)
+            sys.exit(0)
 
         os.close(self.pipe_tv_in)
-        os.close(self.pipe_fv_out)
-
-    def interrupt(self):
-        os.write(self.pipe_tv_out, screen_kb.Msg.INTERRUPT.to_bytes(1, 'big'))
-        data = os.read(self.pipe_fv_in, 2)
-        assert data[0] == screen_kb.Msg.INTERRUPT
-        assert data[1] == 123
 
-    def IE0(self) -> bool:
-        packet = [ screen_kb.Msg.GET_REG, 1 ]  # request VDP status register 1
-        os.write(self.pipe_tv_out, bytearray(packet))
+        # don't stall the emulator when the display can't keep up
+        os.set_blocking(self.pipe_tv_out, False)
 
-        data = os.read(self.pipe_fv_in, 2)
-        type_ = data[0]
-        assert type_ == screen_kb.Msg.GET_REG
-        v = data[1]
+        self.vdp = vdp(wrescale, hrescale, scanline, display=False)
+        self.vdp.use_shared_memory(self.shm.buf)
+        self.vdp.scheduler = self.scheduler
 
-        return (v & 32) == 32
+        self.write_io = self.vdp.write_io
+        self.read_io = self.vdp.read_io
+        self.write_io_block = self.vdp.write_io_block
+        self.read_io_block = self.vdp.read_io_block
+        self.IE0 = self.vdp.IE0
 
-    def write_io(self, a: int, v: int) -> None:
-        packet = ( screen_kb.Msg.SET_IO, a, v )
-        os.write(self.pipe_tv_out, bytearray(packet))
+    def init_in_process(self, wrescale: int, hrescale: int, scanline: float):
+        # the VDP state machine runs in the thread of the CPU, only the
+        # drawing of finished frames is done by the display thread
+        self.pid = None
 
-    def read_io(self, a: int) -> None:
-        if a in (0x98, 0x99, 0xa9):
-            packet = ( screen_kb.Msg.GET_IO, a )
-            os.write(self.pipe_tv_out, bytearray(packet))
+        self.vdp = vdp(wrescale, hrescale, scanline)
+        self.vdp.scheduler = self.scheduler
+        self.vdp.start()
 
-            data = os.read(self.pipe_fv_in, 3)
-            type_ = data[0]
-            assert type_ == screen_kb.Msg.GET_IO
+        self.write_io = self.vdp.write_io
+        self.read_io = self.vdp.read_io
+        self.write_io_block = self.vdp.write_io_block
+        self.read_io_block = self.vdp.read_io_block
+        self.interrupt = self.vdp.interrupt
+        self.IE0 = self.vdp.IE0
 
-            a_ = data[1]
-            assert a_ == a
+    def interrupt(self):
+        self.vdp.interrupt()
 
-            v = data[2]
+        try:
+            os.write(self.pipe_tv_out, b'\x00')
 
-            return v
+        except BlockingIOError:
+            pass  # display is behind, it will pick up the latest state anyway
 
-        elif a == 0xaa:
-            return 0  # FIXME
+    def host_keys(self) -> int:
+        return self.vdp.host_keys()
 
-        print('unexpected port %02x' % a)
+    def get_state(self) -> dict:
+        return self.vdp.get_state()
 
-        return 0x00
+    def set_state(self, state: dict) -> None:
+        self.vdp.set_state(state)
 
     def debug(self, str_):
         self.debug_msg_lock.acquire()
@@ -141,8 +125,16 @@ class screen_kb:
 
     def stop(self):
         self.stop_flag = True
+
+        if self.pid is None:
+            self.vdp.stop()
+            return
+
         os.kill(self.pid, signal.SIGKILL)
         os.wait()
 
         os.close(self.pipe_tv_out)
-        os.close(self.pipe_fv_in)
+
+        self.vdp.release_shared_memory()
+        self.shm.close()
+        self.shm.unlink()
@@ -1,46 +1,113 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import collections
+from eventring import eventring
 import math
-import mido  # type: ignore
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
-import pyaudio  # type: ignore
-import struct
+import numpy  # type: ignore
+from opll import opll
+import signal
 import sys
-import threading
+from psg import psg
 import time
 from typing import List
-from z80 import FREQ_CLOCK
+import wave
+from z80 import FREQ_CLOCK, FREQ_VDP_REFRESH
+
+# Register writes are timestamped with the emulated time (T-states) and
+# sent to the audio process once per frame (see eventring.py), which
+# applies each at the matching sample. The audio runs LAG T-states behind
+# the newest frame it received so that the writes it plays are in; when
+# it drifts more than RESYNC away from that, it jumps.
+FRAME = FREQ_CLOCK // FREQ_VDP_REFRESH
+LAG = 3 * FRAME
+RESYNC = 6 * FRAME
+
+# Without an audio device ('output' is a file name) the writes are applied
+# in the emulator process at the end of every frame, the samples up to
+# that point in emulated time are rendered and written to the file in
+# chunks of this many bytes.
+CHUNK = 1 << 20
+
+# The PSG (3 channels of 0...1) and the SCC (5 of -1...1) add up to at
+# most 8, the OPLL (up to 8 in rhythm mode, see opll.py) is scaled to 4
+# on top of that; FULL_SCALE is what maps to the largest sample value.
+OPLL_GAIN = 0.5
+FULL_SCALE = 12.0
 
 class sound():
     T_AY_3_8910 = 0
     SCC = 1
+    OPLL = 2
+    END_OF_FRAME = 255
 
-    def __init__(self, debug):
+    def __init__(self, debug, sched=None, output: str = 'device'):
+        # output: 'device' (audio device and MIDI out), 'null' (nothing) or
+        # the name of a file (.wav or else raw signed 16 bit mono)
         self.debug = debug
 
+        self.scheduler = sched
+        self.output = output
+
         self.ri = 0
         self.psg_regs = [ 0 ] * 16
         self.prev_reg13 = None
 
-        self.scc_regs = [ 0 ] * 256
+        self.scc_regs = bytearray(256)
+
+        # what the synthesizer plays: scc_regs as of the pending writes
+        self.scc_synth = bytearray(256)
+
+        # created at the first write to it (see YM2413.py)
+        self.opll = None
         self.td1 = self.td2 = self.td3 = self.td4 = self.td5 = 0
         self.mul_scc_1 = self.mul_scc_2 = self.mul_scc_3 = self.mul_scc_4 = self.mul_scc_5 = 0.0
         self.vol_scc_1 = self.vol_scc_2 = self.vol_scc_3 = self.vol_scc_4 = self.vol_scc_5 = 0.0
 
         self.sr = 48000
 
-        self.phase1 = self.phase2 = self.phase3 = 0.0
+        # see callback()
+        self.ramp = numpy.zeros(0)
+        self.mix = numpy.zeros(0)
+        self.out = numpy.zeros(0, dtype=numpy.int16)
+
+        # PSG approximation for MIDI out, see recalc_channels()
         self.f1 = self.f2 = self.f3 = 0
         self.l1 = self.l2 = self.l3 = 0
 
         self.channel_on = [ [ 0, 0 ] ] * 16
 
-        self.pipein, self.pipeout = os.pipe()       
-        self.lock = threading.Lock()
+        # emulated time of the next sample, of the newest frame that came
+        # in and the writes that are not played yet
+        self.t_per_sample = FREQ_CLOCK / self.sr
+        self.synth_t = None
+        self.latest = None
+        self.pending = collections.deque()
+
+        self.events = None
+        self.pid = None
+        self.mp = None
+
+        self.audio_fh = None
+        self.chunk = bytearray()
+
+        if output == 'device':
+            self.events = eventring()
+
+            # only used to notice that the emulator went away
+            self.pipein, self.pipeout = os.pipe()
+
+            self.pid = self.start_audio()
+
+        elif output != 'null':
+            self.start_file(output)
+
+        self.flush_event = None
 
-        self.pid = self.start_audio()
+        if self.scheduler and output != 'null':
+            self.flush_event = self.scheduler.add(FRAME, self.flush)
 
         super(sound, self).__init__()
 
@@ -51,42 +118,21 @@ class sound():
         return 'PSG'
 
     def start_audio(self):
+        import mido  # type: ignore
+        import pyaudio  # type: ignore
+
         pid = os.fork()
 
         if pid == 0:
+            self.psg = psg(FREQ_CLOCK / 2, self.sr)
+
             self.p = pyaudio.PyAudio()
             self.stream = self.p.open(format=self.p.get_format_from_width(2, unsigned=False), channels=1, rate=self.sr, output=True, stream_callback=self.callback)
 
-            while True:
-                type_ = os.read(self.pipein, 1)[0]
-
-                if type_ == sound.T_AY_3_8910:
-                    data = os.read(self.pipein, 2)
-                    a = data[0]
-                    if a > 15:
-                        # self.debug('PSG: index out of range %d' % a)
-                        break
-
-                    v = data[1]
-
-                    # print('PSG: set reg %d to %d' % (a, v), file=sys.stderr)
+            os.close(self.pipeout)
 
-                    with self.lock:
-                        self.psg_regs[a] = v
-
-                        self.recalc_channels(False)
-
-                elif type_ == sound.SCC:
-                    data = os.read(self.pipein, 2)
-                    a = data[0]
-                    v = data[1]
-
-                    with self.lock:
-                        self.scc_regs[a] = v
-                        self.recalc_scc_channels()
-
-                else:
-                    assert False
+            while os.read(self.pipein, 1):
+                pass
 
             self.stream.stop_stream()
             self.stream.close()
@@ -94,15 +140,127 @@ class sound():
             
             sys.exit(1)
 
+        os.close(self.pipein)
+
         self.mp = mido.open_output()
 
         return pid
 
+    def start_file(self, file_name: str) -> None:
+        self.psg = psg(FREQ_CLOCK / 2, self.sr)
+
+        if file_name.lower().endswith('.wav'):
+            self.audio_fh = wave.open(file_name, 'wb')
+            self.audio_fh.setnchannels(1)
+            self.audio_fh.setsampwidth(2)
+            self.audio_fh.setframerate(self.sr)
+
+            self.write_audio = self.audio_fh.writeframes
+
+        else:
+            self.audio_fh = open(file_name, 'wb')
+
+            self.write_audio = self.audio_fh.write
+
+        self.synth_t = self.scheduler.now if self.scheduler else 0
+
+    def queue(self, type_: int, a: int, v: int) -> None:
+        if self.output == 'null':
+            return
+
+        t = self.scheduler.now if self.scheduler else 0
+
+        if self.events:
+            self.events.put(t, type_, a, v)
+
+        else:
+            self.pending.append((t, type_, a, v))
+
+        if not self.scheduler:
+            self.flush(0)
+
+    def flush(self, when: int) -> None:
+        if self.events:
+            self.events.put(when, sound.END_OF_FRAME, 0, 0)
+            self.events.flush()
+
+        else:
+            self.render_until(when)
+
+        if self.scheduler:
+            self.flush_event = self.scheduler.add_at(when + FRAME, self.flush)
+
+    def render_until(self, when: int) -> None:
+        if when < self.synth_t:
+            # emulated time went back (a snapshot was restored)
+            self.pending = collections.deque([ (when, e[1], e[2], e[3]) for e in self.pending ])
+            self.synth_t = when
+
+        n = int((when - self.synth_t) / self.t_per_sample)
+
+        events = self.due_events(self.synth_t, n)
+
+        self.synth_t += n * self.t_per_sample
+
+        self.chunk += self.render(n, events).tobytes()
+
+        if len(self.chunk) >= CHUNK:
+            self.write_audio(self.chunk)
+            self.chunk = bytearray()
+
+    def take_events(self, n: int) -> List[tuple]:
+        # -> (sample position, type, register, value) of the writes that
+        # fall in the next n samples
+        for t, type_, a, v in self.events.get():
+            if self.latest is not None and t < self.latest:
+                # emulated time went back (a snapshot was restored): play
+                # what is left right away and start over
+                self.pending = collections.deque([ (0, e[1], e[2], e[3]) for e in self.pending ])
+                self.synth_t = None
+
+            if type_ == sound.END_OF_FRAME:
+                self.latest = t
+
+            else:
+                self.pending.append((t, type_, a, v))
+
+        if self.latest is None:
+            return [ ]
+
+        target = self.latest - LAG
+
+        if self.synth_t is None or abs(target - self.synth_t) > RESYNC:
+            self.synth_t = target
+
+        t0 = self.synth_t
+
+        self.synth_t = t0 + n * self.t_per_sample
+
+        return self.due_events(t0, n)
+
+    def due_events(self, t0: float, n: int) -> List[tuple]:
+        # -> (sample position, type, register, value) of the pending writes
+        # in the n samples from emulated time t0 on
+        t1 = t0 + n * self.t_per_sample
+
+        due = [ ]
+
+        while self.pending and self.pending[0][0] < t1:
+            t, type_, a, v = self.pending.popleft()
+
+            due.append((min(n, max(0, (t - t0) / self.t_per_sample)), type_, a, v))
+
+        return due
+
     def send_midi(self, msg_in: List[int]):
+        import mido  # type: ignore
+
         msg = mido.Message.from_bytes(msg_in)
         self.mp.send(msg)
 
     def send_midi_prepare(self, ch: int, f: float, v: float, upd_instr: bool) -> None:
+        import mido  # type: ignore
+
         now = time.time()
 
         if f == 0:
@@ -133,55 +291,84 @@ class sound():
 
             self.send_midi([ 0x90 + ch, n, v ])
 
-    def get_scc_reg_s(self, a: int) -> int:
-        v = self.scc_regs[a]
+    def callback(self, in_data, frame_count, time_info, status):
+        import pyaudio  # type: ignore
 
-        return -(256 - v) if v & 128 else v
+        return (self.render(frame_count, self.take_events(frame_count)).tobytes(), pyaudio.paContinue)
 
-    def get_scc_sample(self, o: int, a: float) -> float:
-        v1 = self.get_scc_reg_s(o + (math.floor(a) & 0x1f))
-        m1 = a - math.floor(a)
+    def render(self, n: int, events: List[tuple]):
+        # a whole buffer at once: see psg.py for the PSG, the SCC is
+        # rendered in pieces between the writes to it
+        if len(self.ramp) < n:
+            self.ramp = numpy.arange(n, dtype=numpy.float64)
+            self.mix = numpy.zeros(n, dtype=numpy.float64)
+            self.out = numpy.zeros(n, dtype=numpy.int16)
 
-        v2 = self.get_scc_reg_s(o + (math.ceil(a) & 0x1f))
-        m2 = math.ceil(a) - a
+        mix = self.mix[:n]
 
-        return v1 * m2 + v2 * m1
+        mix[:] = self.psg.render(n, [ (pos, a, v) for pos, type_, a, v in events if type_ == sound.T_AY_3_8910 ])
 
-    def callback(self, in_data, frame_count, time_info, status):
-        with self.lock:
-            self.p1a = 2.0 * math.pi * self.f1 / self.sr
+        opll_events = [ (pos, a, v) for pos, type_, a, v in events if type_ == sound.OPLL ]
 
-            self.p2a = 2.0 * math.pi * self.f2 / self.sr
+        if opll_events and not self.opll:
+            self.opll = opll(FREQ_CLOCK, self.sr)
 
-            self.p3a = 2.0 * math.pi * self.f3 / self.sr
+        if self.opll:
+            mix += self.opll.render(n, opll_events) * OPLL_GAIN
 
-        b = [ 0 ] * frame_count
+        start = 0
 
-        out = bytes()
+        for pos, type_, a, v in events:
+            if type_ == sound.SCC:
+                end = int(pos)
 
-        for i in range(0, frame_count):
-            s = math.sin(self.phase1) * self.l1 + math.sin(self.phase2) * self.l2 + math.sin(self.phase3) * self.l3
+                self.render_scc(mix[start:end])
+                start = end
 
-            s += self.get_scc_sample(0x00, self.td1) * self.vol_scc_1 / 128.0
-            s += self.get_scc_sample(0x20, self.td2) * self.vol_scc_2 / 128.0
-            s += self.get_scc_sample(0x40, self.td3) * self.vol_scc_3 / 128.0
-            s += self.get_scc_sample(0x60, self.td4) * self.vol_scc_4 / 128.0
-            s += self.get_scc_sample(0x60, self.td5) * self.vol_scc_5 / 128.0
+                self.scc_synth[a] = v
+                self.recalc_scc_channels()
 
-            self.td1 += self.mul_scc_1
-            self.td2 += self.mul_scc_2
-            self.td3 += self.mul_scc_3
-            self.td4 += self.mul_scc_4
-            self.td5 += self.mul_scc_5
+        self.render_scc(mix[start:n])
 
-            word = int(s / 8.0 * 32767)
-            out += struct.pack('<h', word)
+        mix *= 32767 / FULL_SCALE
+        numpy.clip(mix, -32768, 32767, out=mix)
 
-            self.phase1 += self.p1a
-            self.phase2 += self.p2a
-            self.phase3 += self.p3a
+        out = self.out[:n]
+        out[:] = mix
 
-        return (out, pyaudio.paContinue)
+        return out
+
+    def render_scc(self, mix) -> None:
+        # adds len(mix) samples; phase accumulator arrays, the waveforms
+        # are read as signed bytes
+        n = len(mix)
+
+        if n == 0:
+            return
+
+        ramp = self.ramp[:n]
+
+        wave = numpy.frombuffer(self.scc_synth, dtype=numpy.int8, count=0x80).astype(numpy.float64)
+
+        positions = [ ]
+
+        # channels 4 and 5 share a waveform
+        for offset, td, step, volume in ((0x00, self.td1, self.mul_scc_1, self.vol_scc_1), (0x20, self.td2, self.mul_scc_2, self.vol_scc_2),
+                                         (0x40, self.td3, self.mul_scc_3, self.vol_scc_3), (0x60, self.td4, self.mul_scc_4, self.vol_scc_4),
+                                         (0x60, self.td5, self.mul_scc_5, self.vol_scc_5)):
+            if volume:
+                pos = td + step * ramp
+
+                i0 = numpy.floor(pos)
+                frac = pos - i0
+                i0 = i0.astype(numpy.intp) & 0x1f
+
+                # linear interpolation between two waveform samples
+                mix += (wave[offset + i0] * (1.0 - frac) + wave[offset + ((i0 + 1) & 0x1f)] * frac) * (volume / 128.0)
+
+            positions.append((td + step * n) % 32.0)
+
+        self.td1, self.td2, self.td3, self.td4, self.td5 = positions
 
     def set_scc(self, a: int, v: int) -> None:
         assert v >= 0 and v <= 255
@@ -189,15 +376,17 @@ class sound():
 
         self.scc_regs[a] = v
 
-        packet = ( sound.SCC, a, v )
-        os.write(self.pipeout, bytearray(packet))
+        self.queue(sound.SCC, a, v)
+
+    def set_opll(self, a: int, v: int) -> None:
+        self.queue(sound.OPLL, a, v)
 
     def recalc_scc_channels(self):
-        nn_1 = ((self.scc_regs[0x81] & 15) << 8) + self.scc_regs[0x80]
-        nn_2 = ((self.scc_regs[0x83] & 15) << 8) + self.scc_regs[0x82]
-        nn_3 = ((self.scc_regs[0x85] & 15) << 8) + self.scc_regs[0x84]
-        nn_4 = ((self.scc_regs[0x87] & 15) << 8) + self.scc_regs[0x86]
-        nn_5 = ((self.scc_regs[0x89] & 15) << 8) + self.scc_regs[0x88]
+        nn_1 = ((self.scc_synth[0x81] & 15) << 8) + self.scc_synth[0x80]
+        nn_2 = ((self.scc_synth[0x83] & 15) << 8) + self.scc_synth[0x82]
+        nn_3 = ((self.scc_synth[0x85] & 15) << 8) + self.scc_synth[0x84]
+        nn_4 = ((self.scc_synth[0x87] & 15) << 8) + self.scc_synth[0x86]
+        nn_5 = ((self.scc_synth[0x89] & 15) << 8) + self.scc_synth[0x88]
         freq_1 = FREQ_CLOCK / 32 / (nn_1 if nn_1 > 0 else 1)
         freq_2 = FREQ_CLOCK / 32 / (nn_2 if nn_2 > 0 else 1)
         freq_3 = FREQ_CLOCK / 32 / (nn_3 if nn_3 > 0 else 1)
@@ -208,22 +397,42 @@ class sound():
         self.mul_scc_3 = (freq_3 / self.sr) * 32.0
         self.mul_scc_4 = (freq_4 / self.sr) * 32.0
         self.mul_scc_5 = (freq_5 / self.sr) * 32.0
-        self.vol_scc_1 = (self.scc_regs[0x8a] & 15) / 15.0 if self.scc_regs[0x8f] & 1 else 0
+        self.vol_scc_1 = (self.scc_synth[0x8a] & 15) / 15.0 if self.scc_synth[0x8f] & 1 else 0
         if self.vol_scc_1 == 0:
             self.td1 = 0
-        self.vol_scc_2 = (self.scc_regs[0x8b] & 15) / 15.0 if self.scc_regs[0x8f] & 2 else 0
+        self.vol_scc_2 = (self.scc_synth[0x8b] & 15) / 15.0 if self.scc_synth[0x8f] & 2 else 0
         if self.vol_scc_2 == 0:
             self.td2 = 0
-        self.vol_scc_3 = (self.scc_regs[0x8c] & 15) / 15.0 if self.scc_regs[0x8f] & 4 else 0
+        self.vol_scc_3 = (self.scc_synth[0x8c] & 15) / 15.0 if self.scc_synth[0x8f] & 4 else 0
         if self.vol_scc_3 == 0:
             self.td3 = 0
-        self.vol_scc_4 = (self.scc_regs[0x8d] & 15) / 15.0 if self.scc_regs[0x8f] & 8 else 0
+        self.vol_scc_4 = (self.scc_synth[0x8d] & 15) / 15.0 if self.scc_synth[0x8f] & 8 else 0
         if self.vol_scc_4 == 0:
             self.td4 = 0
-        self.vol_scc_5 = (self.scc_regs[0x8e] & 15) / 15.0 if self.scc_regs[0x8f] & 16 else 0
+        self.vol_scc_5 = (self.scc_synth[0x8e] & 15) / 15.0 if self.scc_synth[0x8f] & 16 else 0
         if self.vol_scc_5 == 0:
             self.td5 = 0
 
+    def get_state(self) -> dict:
+        return { 'ri': self.ri, 'psg_regs': list(self.psg_regs), 'scc_regs': bytes(self.scc_regs) }
+
+    def set_state(self, state: dict) -> None:
+        # the audio process only knows what it is sent: send everything
+        for a, v in enumerate(state['psg_regs']):
+            self.psg_regs[a] = v
+            self.queue(sound.T_AY_3_8910, a, v)
+
+        for a, v in enumerate(state['scc_regs']):
+            self.set_scc(a, v)
+
+        self.ri = state['ri']
+
+        self.recalc_channels(self.mp is not None)
+
+        # the scheduler dropped the pending flush
+        if self.scheduler and self.output != 'null':
+            self.flush_event = self.scheduler.add(FRAME, self.flush)
+
     def read_io(self, a: int) -> int:
         if self.ri == 14:
             self.psg_regs[self.ri] |= 63
@@ -238,10 +447,9 @@ class sound():
             self.psg_regs[self.ri] = v
             self.debug('Sound %02x: %02x (%d)' % (self.ri, v, v))
 
-            packet = ( sound.T_AY_3_8910, self.ri, v )
-            os.write(self.pipeout, bytearray(packet))
+            self.queue(sound.T_AY_3_8910, self.ri, v)
 
-            self.recalc_channels(True)
+            self.recalc_channels(self.mp is not None)
 
     def recalc_channels(self, midi: bool) -> None:
         # base_freq = 3579545 / 16.0
@@ -264,13 +472,6 @@ class sound():
         self.l2 = 1.0 if self.psg_regs[9] & 16 else (self.psg_regs[9] & 15) / 15.0
         self.l3 = 1.0 if self.psg_regs[10] & 16 else (self.psg_regs[10] & 15) / 15.0
 
-        if self.ri == 8 and self.l1 == 0:
-            self.phase1 = 0
-        elif self.ri == 9 and self.l2 == 0:
-            self.phase2 = 0
-        elif self.ri == 10 and self.l3 == 0:
-            self.phase3 = 0
-
         upd_instr = self.prev_reg13 != self.psg_regs[13]
         self.prev_reg13 = self.psg_regs[13]
 
@@ -280,12 +481,19 @@ class sound():
             self.send_midi_prepare(3, self.f3, self.l3, upd_instr)
 
     def stop(self):
-        del self.mp
-        pygame.midi.quite()
+        if self.pid:
+            self.mp.close()
 
-        os.close(self.pipein)
-        os.close(self.pipeout)
+            os.close(self.pipeout)
+
+            self.events.close(True)
+
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
 
-        os.kill(self.pid, signal.SIGKILL)
-        os.wait()
+        elif self.audio_fh:
+            if self.scheduler:
+                self.render_until(self.scheduler.now)
 
+            self.write_audio(self.chunk)
+            self.audio_fh.close()
@@ -5,6 +5,7 @@ import struct
 import sys
 from enum import Enum, IntFlag, IntEnum
 from typing import List
+from romimage import load_rom_image, get_banks
 
 class sunriseide:
     class bytesel(Enum):
@@ -14,10 +15,9 @@ class sunriseide:
     def __init__(self, disk_rom_file: str, debug, disk_image_file: str):
         print('Loading disk rom %s...' % disk_rom_file, file=sys.stderr)
 
-        fh = open(disk_rom_file, 'rb')
-        self.rom = [ int(b) for b in fh.read() ]
-        fh.close()
+        self.rom = load_rom_image(disk_rom_file)
         self.rom_n_pages = len(self.rom) // 0x4000
+        self.banks = get_banks(self.rom, 0x4000)
 
         self.fh = open(disk_image_file, 'ab+')
 
@@ -34,6 +34,23 @@ class sunriseide:
     def get_name(self):
         return 'SunRise IDE'
 
+    def get_page_mem(self, page: int):
+        sel_page = (self.control >> 7) | ((self.control >> 6) & 2) | ((self.control >> 5) & 4)
+
+        if sel_page >= self.rom_n_pages:
+            sel_page &= self.rom_n_pages - 1
+
+        # IDE registers at 0x7c00...0x7eff when enabled
+        return (self.banks[sel_page], 0, 0x3c00 if self.control & 1 else 0x4000, False)
+
+    def get_state(self) -> dict:
+        return { 'which_byte': self.which_byte.value, 'word': self.word, 'control': self.control }
+
+    def set_state(self, state: dict) -> None:
+        self.which_byte = sunriseide.bytesel(state['which_byte'])
+        self.word = state['word']
+        self.control = state['control']
+
     def write_mem(self, a: int, v: int) -> None:
         if a == 0x7e00 or (a >= 0x7c00 and a <= 0x7dff):  # data
             if self.which_byte == sunriseide.bytesel.lowbyte:
@@ -86,7 +103,7 @@ class sunriseide:
             return 0xff
 
         else:
-            sel_page = (self.control >> 7) | ((self.control >> 6) & 2) | ((self.control >> 5) & 4);
+            sel_page = (self.control >> 7) | ((self.control >> 6) & 2) | ((self.control >> 5) & 4)
 
             if sel_page >= self.rom_n_pages:
                 sel_page &= self.rom_n_pages - 1
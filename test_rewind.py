@@ -0,0 +1,153 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import random
+import zlib
+import savestate
+from rewind import CHUNK, SAME, apply, diff, rewind
+
+def round_trip(new, old):
+    d = diff(new, old)
+
+    # deltas are stored in the snapshot encoding
+    out = bytearray()
+    savestate.encode(out, d)
+    d = savestate.decode(memoryview(zlib.decompress(zlib.compress(out))), 0)[0]
+
+    assert apply(new, d) == old
+
+    return d
+
+def machine(seed: int) -> dict:
+    r = random.Random(seed)
+
+    return { 'cpu': { 'pc': r.randrange(65536), 'sp': 0xf000, 'halted': False },
+             'mapper': { 'mapper': [ 3, 2, 1, 0 ], 'ram': [ bytes(r.randrange(256) for i in range(CHUNK * 4)), None ] },
+             'screen': { 'ram': bytes(CHUNK * 2), 'registers': bytes(8) } }
+
+def test_same():
+    s = machine(1)
+
+    assert round_trip(s, machine(1)) == SAME
+
+def test_scalars():
+    new = machine(1)
+    old = machine(1)
+
+    old['cpu']['pc'] = 0x1234
+    old['cpu']['halted'] = True
+    old['mapper']['mapper'][2] = 7
+
+    round_trip(new, old)
+
+def test_chunks():
+    new = machine(1)
+    old = machine(1)
+
+    ram = bytearray(old['mapper']['ram'][0])
+    ram[5] ^= 0xff
+    ram[CHUNK * 3 + 17] ^= 0x01
+    old['mapper']['ram'][0] = bytes(ram)
+
+    d = round_trip(new, old)
+
+    # only the two chunks that differ are in the delta
+    chunks = d[1]['mapper'][1]['ram'][1][0][1]
+    assert [ o for o, x in chunks ] == [ 0, CHUNK * 3 ]
+
+def test_shape_changes():
+    new = machine(1)
+    old = machine(2)
+
+    # a page that was allocated later, a key that is not in both, bytes of another length
+    new['mapper']['ram'][1] = bytes(CHUNK * 4)
+    old['rtc'] = { 'regs': [ 0 ] * 13 }
+    old['screen']['ram'] = bytes(CHUNK)
+
+    round_trip(new, old)
+    round_trip(old, new)
+
+def test_corrupt():
+    try:
+        apply(machine(1), [ 'q', None ])
+        assert False
+
+    except ValueError:
+        pass
+
+class device:
+    def __init__(self):
+        self.counter = 0
+        self.ram = bytearray(CHUNK * 2)
+
+    def get_state(self) -> dict:
+        return { 'counter': self.counter, 'ram': bytes(self.ram) }
+
+    def set_state(self, state: dict) -> None:
+        self.counter = state['counter']
+        self.ram[:] = state['ram']
+
+    def run_frame(self) -> None:
+        self.counter += 1
+        self.ram[self.counter % len(self.ram)] = self.counter & 0xff
+
+def test_step_back():
+    dev = device()
+    r = rewind({ 'dev': dev }, 2, 1 << 20)
+
+    assert not r.step_back()
+
+    # the state right after each snapshot
+    taken = [ ]
+
+    for i in range(10):
+        dev.run_frame()
+        r.frame()
+
+        if r.frames == 0:
+            taken.append(dev.get_state())
+
+    assert [ state['counter'] for state in taken ] == [ 2, 4, 6, 8, 10 ]
+
+    # ran on after the newest snapshot: first back to that one, then
+    # to the older ones
+    dev.run_frame()
+    r.frame()
+
+    for state in reversed(taken):
+        assert r.step_back()
+        assert dev.get_state() == state
+
+    assert not r.step_back()
+    assert dev.counter == 2
+
+def test_budget():
+    dev = device()
+    r = rewind({ 'dev': dev }, 1, 1 << 20)
+
+    for i in range(20):
+        dev.run_frame()
+        r.frame()
+
+    n = len(r.deltas)
+
+    # only room for the newest snapshot and a few deltas
+    r.budget = r.head_size + r.deltas_size - 1
+    dev.run_frame()
+    r.frame()
+
+    assert len(r.deltas) <= n
+    assert r.head_size + r.deltas_size <= r.budget
+
+if __name__ == '__main__':
+    test_same()
+    test_scalars()
+    test_chunks()
+    test_shape_changes()
+    test_corrupt()
+    test_step_back()
+    test_budget()
+
+    print('All fine')
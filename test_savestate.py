@@ -0,0 +1,115 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import os
+import tempfile
+import savestate
+
+STATES = { 'machine': [ '0:0:msxbiosbasic.rom' ],
+           'cpu': { 'a': 0x12, 'pc': 0xffff, 'ix': -1, 'halted': False, 'int': True, 'memptr': None },
+           'scheduler': { 'now': 1 << 40 },
+           'psg': { 'volume': 0.25, 'regs': [ 0 ] * 16 },
+           'mapper': { 'mapper': [ 3, 2, 1, 0 ], 'ram': [ bytes(range(256)) * 64, None ] },
+           'nested': [ [ ], { }, '', b'', 'ünïcode' ] }
+
+def test_round_trip():
+    for compression in savestate.COMPRESSION:
+        data = savestate.dumps(STATES, compression)
+
+        assert savestate.loads(data) == STATES
+
+def test_encode_types():
+    out = bytearray()
+    savestate.encode(out, ( 1, 2 ))
+    savestate.encode(out, bytearray(b'ab'))
+    savestate.encode(out, memoryview(b'cd'))
+
+    data = memoryview(bytes(out))
+
+    v, o = savestate.decode(data, 0)
+    assert v == [ 1, 2 ]
+
+    v, o = savestate.decode(data, o)
+    assert v == b'ab'
+
+    v, o = savestate.decode(data, o)
+    assert v == b'cd' and o == len(data)
+
+    try:
+        savestate.encode(bytearray(), object())
+        assert False
+
+    except TypeError:
+        pass
+
+def test_file():
+    fd, name = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        savestate.save(name, STATES, 'lzma')
+
+        assert savestate.load(name) == STATES
+
+    finally:
+        os.unlink(name)
+
+def expect_value_error(data: bytes) -> None:
+    try:
+        savestate.loads(data)
+        assert False
+
+    except ValueError:
+        pass
+
+def test_corrupt():
+    expect_value_error(b'')
+    expect_value_error(b'NOTASNAP' + bytes(8))
+    expect_value_error(savestate.HEADER.pack(savestate.MAGIC, savestate.VERSION + 1, 0))
+    expect_value_error(savestate.HEADER.pack(savestate.MAGIC, savestate.VERSION, 9))
+
+    for compression in savestate.COMPRESSION:
+        data = savestate.dumps(STATES, compression)
+
+        # truncated, damaged payload
+        expect_value_error(data[:-1])
+        expect_value_error(data[:savestate.HEADER.size + 3])
+        expect_value_error(data[:savestate.HEADER.size] + b'\xff' * 64)
+
+    # data after the states (zlib itself ignores what follows its stream)
+    expect_value_error(savestate.dumps(STATES, 'none') + b'\x00')
+
+    # a state that is not a dict
+    expect_value_error(savestate.dumps([ 1, 2, 3 ], 'none'))
+
+def test_restore_order():
+    order = [ ]
+
+    class device:
+        def __init__(self, name: str):
+            self.name = name
+
+        def get_state(self) -> dict:
+            return { 'name': self.name }
+
+        def set_state(self, state: dict) -> None:
+            order.append(state['name'])
+
+    objects = { 'scheduler': device('scheduler'), 'screen': device('screen'), 'none': None, 'cpu': device('cpu') }
+
+    states = savestate.capture(objects)
+    assert 'none' not in states
+
+    savestate.restore(objects, savestate.loads(savestate.dumps(states)))
+    assert order == [ 'scheduler', 'screen', 'cpu' ]
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_encode_types()
+    test_file()
+    test_corrupt()
+    test_restore_order()
+
+    print('All fine')
@@ -0,0 +1,110 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from scheduler import scheduler
+
+def test_order():
+    s = scheduler()
+    fired = [ ]
+
+    s.add(30, lambda when: fired.append(('c', when)))
+    s.add(10, lambda when: fired.append(('a', when)))
+    s.add_at(20, lambda when: fired.append(('b', when)))
+
+    assert s.next_event == 10
+
+    s.now = 25
+    s.run_due()
+
+    assert fired == [ ('a', 10), ('b', 20) ]
+    assert s.next_event == 30
+
+    s.now = 30
+    s.run_due()
+
+    assert fired[-1] == ('c', 30)
+    assert s.next_event == scheduler.NEVER
+
+def test_same_time():
+    # events that are due at the same time run in the order they were added
+    s = scheduler()
+    fired = [ ]
+
+    for name in 'abcde':
+        s.add(5, lambda when, name=name: fired.append(name))
+
+    s.now = 5
+    s.run_due()
+
+    assert fired == list('abcde')
+
+def test_cancel():
+    s = scheduler()
+    fired = [ ]
+
+    first = s.add(10, lambda when: fired.append('first'))
+    s.add(20, lambda when: fired.append('second'))
+    third = s.add(30, lambda when: fired.append('third'))
+
+    s.cancel(first)
+    assert s.next_event == 20
+
+    s.cancel(third)
+    assert s.next_event == 20
+
+    s.now = 100
+    s.run_due()
+
+    assert fired == [ 'second' ]
+    assert s.next_event == scheduler.NEVER
+
+def test_cancel_last():
+    s = scheduler()
+
+    s.cancel(s.add(10, lambda when: None))
+
+    assert s.next_event == scheduler.NEVER
+    assert not s.events
+
+def test_periodic():
+    # a callback that re-adds itself relative to when it was due does not drift
+    s = scheduler()
+    fired = [ ]
+
+    def tick(when: int) -> None:
+        fired.append(when)
+        s.add_at(when + 100, tick)
+
+    s.add(100, tick)
+
+    for now in (150, 260, 999):
+        s.now = now
+        s.run_due()
+
+    assert fired == [ 100, 200, 300, 400, 500, 600, 700, 800, 900 ]
+    assert s.next_event == 1000
+
+def test_state():
+    s = scheduler()
+    s.add(10, lambda when: None)
+    s.now = 1234
+
+    t = scheduler()
+    t.add(5, lambda when: None)
+    t.set_state(s.get_state())
+
+    assert t.now == 1234
+    assert t.next_event == scheduler.NEVER
+    assert not t.events
+
+if __name__ == '__main__':
+    test_order()
+    test_same_time()
+    test_cancel()
+    test_cancel_last()
+    test_periodic()
+    test_state()
+
+    print('All fine')
@@ -0,0 +1,73 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# prints a trace file as written by msx.py -t
+
+import sys
+from optparse import OptionParser
+from blockcache import LEN2, LEN3, ED_LEN4, IXY_DISP
+from tracer import read_trace
+
+def instruction_length(opcode: bytes) -> int:
+    op = opcode[0]
+
+    if op == 0xcb:
+        return 2
+
+    if op == 0xed:
+        return 4 if opcode[1] in ED_LEN4 else 2
+
+    if op == 0xdd or op == 0xfd:
+        op2 = opcode[1]
+
+        if op2 == 0xcb:
+            return 4
+
+        if op2 == 0x36:  # LD (IX+d),n
+            return 4
+
+        if op2 in IXY_DISP or op2 in LEN2:
+            return 3
+
+        if op2 in LEN3:
+            return 4
+
+        return 2
+
+    if op in LEN3:
+        return 3
+
+    if op in LEN2:
+        return 2
+
+    return 1
+
+parser = OptionParser(usage='%prog [options] trace-file')
+parser.add_option('-p', '--pc', dest='pc', help='only show instructions at this address (hex)')
+parser.add_option('-s', '--start', dest='start', help='skip everything before this T-state')
+parser.add_option('-n', '--count', dest='count', help='stop after this many instructions')
+(options, args) = parser.parse_args()
+
+if len(args) != 1:
+    parser.print_help()
+    sys.exit(1)
+
+pc_filter = int(options.pc, 16) if options.pc else None
+start = int(options.start) if options.start else 0
+count = int(options.count) if options.count else None
+
+n = 0
+
+for t, pc, opcode, af, bc, de, hl, ix, iy, sp, i, im_iff, slots, subslots in read_trace(args[0]):
+    if t < start or (pc_filter is not None and pc != pc_filter):
+        continue
+
+    code = ' '.join([ '%02x' % b for b in opcode[0:instruction_length(opcode)] ])
+
+    print('%12d %04x %-11s | AF %04x BC %04x DE %04x HL %04x IX %04x IY %04x SP %04x | I %02x IM %d IFF %d | slots %02x/%02x' % (t, pc, code, af, bc, de, hl, ix, iy, sp, i, im_iff >> 1, im_iff & 1, slots, subslots))
+
+    n += 1
+    if count is not None and n >= count:
+        break
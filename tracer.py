@@ -0,0 +1,71 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import struct
+from typing import Callable
+
+# Instruction trace: one fixed size binary record per executed instruction
+# is put in a buffer which is written to the trace file when full (and at
+# close). Use trace-dump.py to print a trace file.
+#
+# Tracing is enabled by z80.enable_trace() which swaps the main dispatch
+# table for one that records before executing; without it no trace code
+# runs at all.
+
+MAGIC = b'PYMSXTR1'
+
+# T-state, PC, 4 opcode bytes, AF BC DE HL IX IY SP, I, IM/IFF1, slot
+# layout (port 0xa8), sub-slot register (0xffff)
+RECORD = struct.Struct('<QH4s7HBBBB')
+
+class tracer:
+    def __init__(self, file_name: str, peek: Callable[[int], int], get_layout: Callable[[], int], n_records: int = 65536):
+        self.fh = open(file_name, 'wb')
+        self.fh.write(MAGIC)
+
+        # side effect free memory read for the opcode bytes and the
+        # slot/sub-slot layout (as 0xSSPP)
+        self.peek = peek
+        self.get_layout = get_layout
+
+        self.buffer = bytearray(RECORD.size * n_records)
+        self.offset: int = 0
+
+    def record(self, cpu, pc: int) -> None:
+        peek = self.peek
+
+        opcode = bytes((peek(pc), peek((pc + 1) & 0xffff), peek((pc + 2) & 0xffff), peek((pc + 3) & 0xffff)))
+
+        layout = self.get_layout()
+
+        RECORD.pack_into(self.buffer, self.offset, cpu.scheduler.now, pc, opcode,
+                (cpu.a << 8) | cpu.f, (cpu.b << 8) | cpu.c, (cpu.d << 8) | cpu.e, (cpu.h << 8) | cpu.l,
+                cpu.ix, cpu.iy, cpu.sp, cpu.i, (cpu.im << 1) | cpu.iff1, layout & 0xff, layout >> 8)
+
+        self.offset += RECORD.size
+
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self) -> None:
+        self.fh.write(self.buffer[0:self.offset])
+        self.fh.flush()
+
+        self.offset = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.fh.close()
+
+def read_trace(file_name: str):
+    with open(file_name, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a pymsx trace file' % file_name)
+
+        while True:
+            data = fh.read(RECORD.size * 4096)
+            if not data:
+                break
+
+            for i in range(0, len(data) - RECORD.size + 1, RECORD.size):
+                yield RECORD.unpack_from(data, i)
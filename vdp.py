@@ -6,24 +6,51 @@
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import sys
+import numpy  # type: ignore
 import threading
-import time
 from typing import List
 import traceback
-import renderer
+from z80 import FREQ_CLOCK, FREQ_VDP_REFRESH
 
 class vdp(threading.Thread):
-    def __init__(self, wrescale, hrescale, scanline):
+    # layout of the block shared between the emulator and display process
+    SHM_RAM = 0
+    SHM_REGISTERS = SHM_RAM + 131072
+    SHM_STATUS = SHM_REGISTERS + 64
+    SHM_PALETTE = SHM_STATUS + 16
+    SHM_KEYBOARD = SHM_PALETTE + 16 * 4
+    SHM_DIRTY = SHM_KEYBOARD + 16
+    SHM_SIZE = SHM_DIRTY + 512 + 1
 
-        self.ram: List[int] = [ 0 ] * 131072
+    # VRAM changes are tracked per 256 bytes; the last byte of 'dirty' is
+    # set when a register or the palette changed
+    DIRTY_ALL = 512
+
+    # raster timing in CPU T-states
+    CYCLES_PER_LINE = 228
+    CYCLES_PER_FRAME = FREQ_CLOCK // FREQ_VDP_REFRESH
+    CYCLES_HBLANK = 57
+
+    def __init__(self, wrescale, hrescale, scanline, display=True):
+
+        self.ram = bytearray(131072)
 
         self.vdp_rw_pointer: int = 0
         self.vdp_addr_state: bool = False
         self.vdp_addr_b1 = None
         self.vdp_read_ahead: int = 0
 
-        self.registers: List[int] = [ 0 ] * 47
-        self.status_register: List[int] = [ 0 ] * 10
+        self.registers = bytearray(64)
+        self.status_register = bytearray(16)
+
+        self.dirty = bytearray(b'\x01' * (512 + 1))
+        self.frames_since_full: int = 0
+
+        # keyboard matrix as seen from the emulator process when the
+        # display (and thus the keyboard) is in an other process
+        self.kb = None
+        self.keyboard_row: int = 0
+        self.shared_views: List[memoryview] = [ ]
 
         self.stop_flag: bool = False
 
@@ -40,6 +67,13 @@ class vdp(threading.Thread):
 
             self.sc8_rgb_map[i] = [ self.rgb_to_i(r, g, b), r, g, b ]
 
+        self.sc8_lut = numpy.array([ m[0] for m in self.sc8_rgb_map ], dtype=numpy.uint32)
+
+        # tile mode pattern/color atlases, see get_tiles()
+        self.atlas = dict()
+        self.bit_shifts = numpy.arange(7, -1, -1, dtype=numpy.uint8)
+        self.block_offsets = (numpy.arange(0, 32 * 24) >> 8) * 256
+
         self.sourcex: int = 0
         self.sourcey: int = 0
         self.destinationx: int = 0
@@ -53,15 +87,95 @@ class vdp(threading.Thread):
         self.pixeloffset: int = 0
         self.highspeed: bool = False
 
-        self.prev_hsync_int = 0
-        self.prev_vsync_int = 0
+        # set by the owner when emulated time is available; the vertical-
+        # and horizontal retrace bits are derived from it
+        self.scheduler = None
+        self.frame_start: int = 0
 
         self.cv = threading.Condition()
 
-        self.renderer = renderer.Renderer(wrescale, hrescale, scanline)
+        self.renderer = None
+
+        if display:
+            # pygame is only needed when there's something to show
+            import renderer
+
+            self.renderer = renderer.Renderer(wrescale, hrescale, scanline)
 
         super(vdp, self).__init__()
 
+    def use_shared_memory(self, buf: memoryview) -> None:
+        # VRAM, registers, palette and keyboard matrix from now on live in
+        # 'buf' (a multiprocessing.shared_memory buffer of SHM_SIZE bytes)
+        self.ram = buf[vdp.SHM_RAM:vdp.SHM_REGISTERS]
+        self.registers = buf[vdp.SHM_REGISTERS:vdp.SHM_STATUS]
+        self.status_register = buf[vdp.SHM_STATUS:vdp.SHM_PALETTE]
+
+        palette = buf[vdp.SHM_PALETTE:vdp.SHM_KEYBOARD].cast('I')
+        for i in range(0, 16):
+            palette[i] = self.rgb[i]
+        self.rgb = palette
+
+        self.kb = buf[vdp.SHM_KEYBOARD:vdp.SHM_DIRTY]
+        for i in range(0, 16):
+            self.kb[i] = 0xff
+
+        self.dirty = buf[vdp.SHM_DIRTY:vdp.SHM_SIZE]
+        self.dirty[vdp.DIRTY_ALL] = 1
+
+        self.shared_views = [ self.ram, self.registers, self.status_register, self.rgb, self.kb, self.dirty ]
+
+    def release_shared_memory(self) -> None:
+        for v in self.shared_views:
+            v.release()
+
+        self.shared_views = [ ]
+
+    # command engine
+    COMMAND_STATE = ('sourcex', 'sourcey', 'destinationx', 'destinationy', 'numberx', 'numbery', 'vdp_cmd', 'start_destinationx', 'start_destinationy', 'pixelsleft', 'pixeloffset', 'highspeed')
+
+    def get_state(self) -> dict:
+        state = { name: getattr(self, name) for name in vdp.COMMAND_STATE }
+
+        state['ram'] = bytes(self.ram)
+        state['registers'] = bytes(self.registers)
+        state['status_register'] = bytes(self.status_register)
+        state['palette'] = list(self.rgb)
+
+        state['vdp_rw_pointer'] = self.vdp_rw_pointer
+        state['vdp_addr_state'] = self.vdp_addr_state
+        state['vdp_addr_b1'] = self.vdp_addr_b1
+        state['vdp_read_ahead'] = self.vdp_read_ahead
+        state['pal_sel'] = self.pal_sel
+        state['pal_byte_0'] = self.pal_byte_0
+        state['keyboard_row'] = self.keyboard_row
+        state['frame_start'] = self.frame_start
+
+        return state
+
+    def set_state(self, state: dict) -> None:
+        for name in vdp.COMMAND_STATE:
+            setattr(self, name, state[name])
+
+        # in place: these may live in memory shared with the display process
+        self.ram[:] = state['ram']
+        self.registers[:] = state['registers']
+        self.status_register[:] = state['status_register']
+
+        for i, rgb in enumerate(state['palette']):
+            self.rgb[i] = rgb
+
+        self.vdp_rw_pointer = state['vdp_rw_pointer']
+        self.vdp_addr_state = state['vdp_addr_state']
+        self.vdp_addr_b1 = state['vdp_addr_b1']
+        self.vdp_read_ahead = state['vdp_read_ahead']
+        self.pal_sel = state['pal_sel']
+        self.pal_byte_0 = state['pal_byte_0']
+        self.keyboard_row = state['keyboard_row']
+        self.frame_start = state['frame_start']
+
+        self.dirty[:] = b'\x01' * len(self.dirty)
+
     def resize_window(self, w: int, h: int):
         self.arr = self.renderer.scrn_resize(w, h)
         
@@ -71,6 +185,37 @@ class vdp(threading.Thread):
     def interrupt(self) -> None:
         self.status_register[0] |= 128
 
+        if self.scheduler:
+            self.frame_start = self.scheduler.now
+
+        self.frame_done()
+
+    def frame_done(self) -> None:
+        # a frame is finished, let the display thread draw it
+        with self.cv:
+            self.cv.notify()
+
+    def IE0(self) -> bool:
+        return (self.registers[1] & 32) == 32
+
+    def host_keys(self) -> int:
+        # emulator hotkeys, see Renderer.kb_init(); a bit is set when pressed
+        if self.kb is not None:
+            return self.kb[15] ^ 0xff
+
+        if self.renderer:
+            return self.renderer.kb_read_row(15) ^ 0xff
+
+        return 0
+
+    def stop(self) -> None:
+        self.stop_flag = True
+
+        with self.cv:
+            self.cv.notify()
+
+        self.join()
+
     def video_mode(self) -> int:
         m1 = (self.registers[1] >> 4) & 1
         m2 = (self.registers[1] >> 3) & 1
@@ -82,6 +227,7 @@ class vdp(threading.Thread):
 
     def set_register(self, a: int, v: int) -> None:
         self.registers[a] = v
+        self.dirty[vdp.DIRTY_ALL] = 1
 
         if a == 0x10:  # palette index
             self.pal_sel = False
@@ -207,6 +353,7 @@ class vdp(threading.Thread):
                 offset = (y * 256) + x
 
             self.ram[offset] = v
+            self.dirty[offset >> 8] = 1
 
             if vm == 6:
                 np = 2
@@ -230,6 +377,7 @@ class vdp(threading.Thread):
         if a == 0x98:
             if vm in (4, 16, 0):  # MSX 1 modi
                 self.ram[self.vdp_rw_pointer] = v
+                self.dirty[self.vdp_rw_pointer >> 8] = 1
                 self.vdp_rw_pointer += 1
                 self.vdp_rw_pointer &= 0x3fff
 
@@ -237,12 +385,12 @@ class vdp(threading.Thread):
                 vram_addr_high = (self.registers[0x0e] & 7) << 14
                 vram_addr = vram_addr_high + self.vdp_rw_pointer
                 self.ram[vram_addr] = v
+                self.dirty[vram_addr >> 8] = 1
 
                 self.vdp_rw_pointer += 1
 
                 if self.vdp_rw_pointer >= 16384:
-                    self.registers[0x0e] += 1
-                    self.registers[0x0e] &= 7
+                    self.registers[0x0e] = (self.registers[0x0e] + 1) & 7
 
                     self.vdp_rw_pointer = 0
 
@@ -271,8 +419,7 @@ class vdp(threading.Thread):
                         self.vdp_rw_pointer += 1
 
                         if self.vdp_rw_pointer >= 16384:
-                            self.registers[0x0e] += 1
-                            self.registers[0x0e] &= 7
+                            self.registers[0x0e] = (self.registers[0x0e] + 1) & 7
 
                             self.vdp_rw_pointer = 0
 
@@ -285,14 +432,14 @@ class vdp(threading.Thread):
             else:
                 entry = self.registers[0x10] & 15
 
-                self.registers[0x10] += 1
-                self.registers[0x10] &= 15
+                self.registers[0x10] = (self.registers[0x10] + 1) & 15
 
                 r = int(((self.pal_byte_0 >> 4) & 7) * 255 / 7)
                 g = int((v & 7) * 255 / 7)
                 b = int((self.pal_byte_0 & 7) * 255 / 7)
 
                 self.rgb[entry] = self.rgb_to_i(r, g, b)
+                self.dirty[vdp.DIRTY_ALL] = 1
                 print('set RGB %d to %d,%d,%d' % (entry, r, g, b))
 
             self.pal_sel = not self.pal_sel
@@ -304,18 +451,70 @@ class vdp(threading.Thread):
                 self.set_register(register_index, v)
 
             if (self.registers[0x11] & 128) == 0:
-                self.registers[0x11] += 1
-                self.registers[0x11] &= 63
+                self.registers[0x11] = (self.registers[0x11] + 1) & 63
 
             if register_index == 0x2c:
                 self.put_vdp_2c(v)
 
         elif a == 0xaa:  # PPI register C
-            self.renderer.kb_set_row(v & 15)
+            if self.renderer:
+                self.renderer.kb_set_row(v & 15)
+
+            else:
+                self.keyboard_row = v & 15
 
         else:
             print('vdp::write_io: Unexpected port %02x' % a)
 
+    def vram_runs(self, n: int):
+        # advance the VRAM pointer as n accesses via port 0x98 would, yields
+        # (address, length) of the consecutive VRAM areas that were passed
+        msx1 = self.video_mode() in (4, 16, 0)
+
+        while n > 0:
+            c = min(n, 0x4000 - self.vdp_rw_pointer)
+
+            yield ((0 if msx1 else (self.registers[0x0e] & 7) << 14) + self.vdp_rw_pointer, c)
+
+            self.vdp_rw_pointer += c
+            n -= c
+
+            if self.vdp_rw_pointer >= 0x4000:
+                self.vdp_rw_pointer = 0
+
+                if not msx1:
+                    self.registers[0x0e] = (self.registers[0x0e] + 1) & 7
+
+    def write_io_block(self, a: int, data) -> None:
+        # OTIR to port 0x98
+        o = 0
+
+        for addr, c in self.vram_runs(len(data)):
+            self.ram[addr:addr + c] = data[o:o + c]
+
+            first, last = addr >> 8, (addr + c - 1) >> 8
+            self.dirty[first:last + 1] = b'\x01' * (last - first + 1)
+
+            o += c
+
+        self.vdp_addr_state = False
+        self.vdp_read_ahead = data[-1]
+
+    def read_io_block(self, a: int, n: int) -> bytes:
+        # INIR from port 0x98: the first byte comes from the read-ahead
+        # latch, the last byte read ends up in it
+        data = bytearray()
+
+        for addr, c in self.vram_runs(n):
+            data += self.ram[addr:addr + c]
+
+        data.insert(0, self.vdp_read_ahead)
+        self.vdp_read_ahead = data.pop()
+
+        self.vdp_addr_state = False
+
+        return bytes(data)
+
     def read_io(self, a: int) -> int:
         vm = self.video_mode()
 
@@ -338,13 +537,30 @@ class vdp(threading.Thread):
                 if self.vdp_rw_pointer >= 0x4000:
                     self.vdp_rw_pointer &= 0x3fff
 
-                    self.registers[0x0e] += 1
-                    self.registers[0x0e] &= 7
+                    self.registers[0x0e] = (self.registers[0x0e] + 1) & 7
 
             self.vdp_addr_state = False
 
         elif a == 0x99:
             reg = self.registers[15]
+
+            if reg == 2 and self.scheduler:
+                # retrace bits from the raster position; the interrupt is
+                # raised at the start of the vertical retrace, the visible
+                # lines come after it
+                t = (self.scheduler.now - self.frame_start) % vdp.CYCLES_PER_FRAME
+                visible = 212 if self.registers[9] & 128 else 192
+
+                sr = self.status_register[2] & 0x9f
+
+                if t < vdp.CYCLES_PER_FRAME - visible * vdp.CYCLES_PER_LINE:
+                    sr |= 0x40
+
+                if t % vdp.CYCLES_PER_LINE >= vdp.CYCLES_PER_LINE - vdp.CYCLES_HBLANK:
+                    sr |= 0x20
+
+                self.status_register[2] = sr
+
             rc = self.status_register[reg]
 
             if reg == 0:
@@ -352,22 +568,22 @@ class vdp(threading.Thread):
 
             elif reg == 2:
                 self.status_register[reg] = (self.status_register[reg] & 0x7e) | ((~(self.status_register[reg] & 0x81)) & 0x81)
-                self.status_register[reg] &= ~0x60
 
-                now = time.time()
+            self.vdp_addr_state = False
 
-                if now - self.prev_vsync_int >= 1 / 50: # FIXME 50Hz configurable?
-                    self.status_register[reg] |= 0x40
-                    self.prev_vsync_int = now
+        elif a == 0xa9:
+            if self.renderer:
+                rc = self.renderer.kb_read()
 
-                if now - self.prev_hsync_int >= 1 / (228 * 50): # hsync
-                    self.status_register[reg] |= 0x20
-                    self.prev_hsync_int = now
+            elif self.keyboard_row == 15:
+                # emulator keys (see host_keys()), not for the MSX
+                rc = 0xff
 
-            self.vdp_addr_state = False
+            else:
+                rc = self.kb[self.keyboard_row]
 
-        elif a == 0xa9:
-            rc = self.renderer.kb_read() 
+        elif a == 0xaa:
+            rc = 0  # FIXME
 
         else:
             print('vdp::read_io: Unexpected port %02x' % a)
@@ -497,6 +713,8 @@ class vdp(threading.Thread):
                 self.ram[offset] &= mask[bit]
                 self.ram[offset] |= (color & 15) << shift[bit]
 
+            self.dirty[offset >> 8] = 1
+
         elif vm == 1:  # screen 6
             if x >= 512 or y >= 212:
                 return
@@ -509,6 +727,8 @@ class vdp(threading.Thread):
             self.ram[offset] &= mask
             self.ram[offset] |= (color & 3) << shift
 
+            self.dirty[offset >> 8] = 1
+
         elif vm == 5:  # screen 7
             if x >= 512 or y >= 212:
                 return
@@ -526,6 +746,8 @@ class vdp(threading.Thread):
                 self.ram[offset] &= mask
                 self.ram[offset] |= (color & 15) << shift
 
+            self.dirty[offset >> 8] = 1
+
         elif vm == 7:  # screen 8
             if x >= 256 or y >= 212:
                 return
@@ -534,6 +756,8 @@ class vdp(threading.Thread):
 
             self.ram[offset] = color
 
+            self.dirty[offset >> 8] = 1
+
     def fill_rect(self, video_mode: int, destinationx: int, destinationy: int, numberx: int, numbery: int, color: int):
         for y in range(destinationy, destinationy + numbery):
             for x in range(destinationx, destinationx + numberx):
@@ -593,187 +817,205 @@ class vdp(threading.Thread):
 
         self.status_register[2] &= ~1
 
-    def draw_screen_0(self, vm):
-        cols = 40 if vm == 16 else 80
-
-        bg_map = (self.registers[2] & 0x7c) << 10 if cols == 80 else (self.registers[2] & 15) << 10
-        bg_tiles = (self.registers[4] & 7) << 11
-
-        bg = self.rgb[self.registers[7] & 15]
-        fg = self.rgb[self.registers[7] >> 4]
+    def get_tiles(self, key: str, patterns, colors):
+        # 'patterns' and 'colors' are [tile, row] arrays from VRAM, 'colors'
+        # holding foreground << 4 | background per row. The result is a
+        # [tile, y, x] array of palette indices which is kept between
+        # frames; only tiles whose pattern or colors changed are redone.
+        entry = self.atlas.get(key)
 
-        cache = [ None ] * 256
+        if entry is None or entry[0].shape != patterns.shape:
+            redo = numpy.arange(0, patterns.shape[0])
+            tiles = numpy.empty((patterns.shape[0], 8, 8), dtype=numpy.uint8)
 
-        for map_index in range(0, cols * 24):
-            cur_char_nr = self.ram[bg_map + map_index]
+        else:
+            old_patterns, old_colors, tiles = entry
 
-            scr_x = (map_index % cols) * 8
-            scr_y = (map_index // cols) * 8
+            redo = numpy.flatnonzero(numpy.any(old_patterns != patterns, axis=1) | numpy.any(old_colors != colors, axis=1))
 
-            if cache[cur_char_nr] == None:
-                cache[cur_char_nr] = [ 0 ] * 64
+        if len(redo):
+            p = patterns[redo]
+            c = colors[redo]
 
-                cur_tiles = bg_tiles + cur_char_nr * 8
+            bits = (p[:, :, None] >> self.bit_shifts) & 1
+            tiles[redo] = numpy.where(bits, c[:, :, None] >> 4, c[:, :, None] & 15)
 
-                for y in range(0, 8):
-                    current_tile = self.ram[cur_tiles]
-                    cur_tiles += 1
+        self.atlas[key] = (patterns.copy(), colors.copy(), tiles)
 
-                    for x in range(0, 8):
-                        cache[cur_char_nr][y * 8 + x] = fg if (current_tile & 128) == 128 else bg
-                        current_tile <<= 1
+        return tiles
 
-            for y in range(0, 8):
-                for x in range(0, 8):
-                    self.arr[scr_x + x, scr_y + y] = cache[cur_char_nr][y * 8 + x]
+    def tables_dirty(self, dirty, tables) -> bool:
+        # whether any of the VRAM 'tables' ((offset, length) pairs)
+        # changed; always when 'dirty' is None (see get_dirty)
+        if dirty is None:
+            return True
 
-        self.renderer.scrn_draw(self.arr)
+        return any([ dirty[offset >> 8:(offset + n + 255) >> 8].any() for offset, n in tables ])
 
-    def draw_screen_1(self):
-        bg_map    = (self.registers[2] &  15) << 10
-        bg_colors = (self.registers[3] & 128) <<  6
-        bg_tiles  = (self.registers[4] &   4) << 11
+    def draw_tiles(self, tiles, names, cols: int, sprites: bool) -> None:
+        frame = tiles[names].reshape(24, cols, 8, 8).transpose(0, 2, 1, 3).reshape(192, cols * 8)
 
-        cols = 32
+        self.draw_bitmap(self.palette()[frame], sprites=sprites)
 
-        cache = [ None ] * 256
+    def draw_screen_0(self, vm, dirty=None):
+        cols = 40 if vm == 16 else 80
 
+        bg_map = (self.registers[2] & 0x7c) << 10 if cols == 80 else (self.registers[2] & 15) << 10
+        bg_tiles = (self.registers[4] & 7) << 11
 
-        for map_index in range(0, 32 * 24):
-            cur_char_nr = self.ram[bg_map + map_index]
+        if not self.tables_dirty(dirty, ((bg_map, cols * 24), (bg_tiles, 256 * 8))):
+            return
 
-            current_color = self.ram[bg_colors + cur_char_nr // 8]
-            fg = self.rgb[current_color >> 4]
-            bg = self.rgb[current_color & 15]
+        patterns = self.vram(bg_tiles, 256 * 8).reshape(256, 8)
+        colors = numpy.full((256, 8), self.registers[7], dtype=numpy.uint8)
 
-            scr_x = (map_index % cols) * 8
-            scr_y = (map_index // cols) * 8
+        tiles = self.get_tiles('screen 0', patterns, colors)
 
-            if cache[cur_char_nr] == None:
-                cache[cur_char_nr] = [ 0 ] * 64
+        self.draw_tiles(tiles, self.vram(bg_map, cols * 24), cols, False)
 
-                cur_tiles = bg_tiles + cur_char_nr * 8
+    def draw_screen_1(self, dirty=None):
+        bg_map    = (self.registers[2] &  15) << 10
+        bg_colors = (self.registers[3] & 128) <<  6
+        bg_tiles  = (self.registers[4] &   4) << 11
 
-                for y in range(0, 8):
-                    current_tile = self.ram[cur_tiles]
-                    cur_tiles += 1
+        if not self.tables_dirty(dirty, ((bg_map, 32 * 24), (bg_colors, 32), (bg_tiles, 256 * 8))):
+            return
 
-                    for x in range(0, 8):
-                        cache[cur_char_nr][y * 8 + x] = fg if (current_tile & 128) == 128 else bg
-                        current_tile <<= 1
+        patterns = self.vram(bg_tiles, 256 * 8).reshape(256, 8)
+        # one color byte per 8 characters
+        colors = numpy.repeat(self.vram(bg_colors, 32), 8)[:, None].repeat(8, axis=1)
 
-            for y in range(0, 8):
-                for x in range(0, 8):
-                    self.arr[scr_x + x, scr_y + y] = cache[cur_char_nr][y * 8 + x]
+        tiles = self.get_tiles('screen 1', patterns, colors)
 
-        self.renderer.scrn_draw(self.arr)
+        self.draw_tiles(tiles, self.vram(bg_map, 32 * 24), 32, False)
 
-    def draw_screen_2(self):
+    def draw_screen_2(self, dirty=None):
         bg_map    = (self.registers[2] &  15) << 10
         bg_colors = (self.registers[3] & 128) <<  6
         bg_tiles  = (self.registers[4] &   4) << 11
 
-        pb = None
-        cache = None
-
-        tiles_offset = colors_offset = 0
+        if not self.tables_dirty(dirty, ((bg_map, 32 * 24), (bg_colors, 3 * 256 * 8), (bg_tiles, 3 * 256 * 8))):
+            return
 
-        for map_index in range(0, 32 * 24):
-            block_nr = (map_index >> 8) & 3
+        # 3 blocks of 256 patterns and colors, one for each third of the screen
+        patterns = self.vram(bg_tiles, 3 * 256 * 8).reshape(768, 8)
+        colors = self.vram(bg_colors, 3 * 256 * 8).reshape(768, 8)
 
-            if block_nr != pb:
-                cache = [ None ] * 256
-                pb = block_nr
+        tiles = self.get_tiles('screen 2', patterns, colors)
 
-                tiles_offset = bg_tiles  + (block_nr * 256 * 8)
-                colors_offset = bg_colors + (block_nr * 256 * 8)
+        names = self.vram(bg_map, 32 * 24) + self.block_offsets
 
-            cur_char_nr = self.ram[bg_map + map_index]
+        self.draw_tiles(tiles, names, 32, True)
 
-            scr_x = (map_index & 31) * 8
-            scr_y = ((map_index >> 5) & 31) * 8
+    def vram(self, offset: int, n: int):
+        return numpy.frombuffer(self.ram, dtype=numpy.uint8, count=n, offset=offset)
 
-            if cache[cur_char_nr] == None:
-                cache[cur_char_nr] = [ 0 ] * 64
+    def palette(self):
+        return numpy.array(self.rgb, dtype=numpy.uint32)
 
-                cur_tiles   = tiles_offset + cur_char_nr * 8
-                cur_colors  = colors_offset + cur_char_nr * 8
+    def draw_bitmap(self, pixels, lines=None, sprites: bool = True) -> None:
+        # 'pixels' is [y, x], self.arr is [x, y]; 'lines' are the screen
+        # lines in 'pixels' when only part of the screen is redrawn
+        if lines is None:
+            self.arr[0:pixels.shape[1], 0:pixels.shape[0]] = pixels.T
 
-                for y in range(0, 8):
-                    current_tile = self.ram[cur_tiles]
-                    cur_tiles += 1
+        else:
+            self.arr[0:pixels.shape[1], lines] = pixels.T
 
-                    current_color = self.ram[cur_colors]
-                    cur_colors += 1
+        if sprites:
+            self.draw_sprites()
 
-                    fg = self.rgb[current_color >> 4]
-                    bg = self.rgb[current_color & 15]
+        self.renderer.scrn_draw(self.arr)
 
-                    for x in range(0, 8):
-                        cache[cur_char_nr][y * 8 + x] = fg if (current_tile & 128) == 128 else bg
-                        current_tile <<= 1
+    def bitmap_lines(self, dirty, name_table: int, bytes_per_line: int, rows):
+        # which screen lines show VRAM rows that changed ('rows' maps
+        # screen line to VRAM row); all when 'dirty' is None
+        if dirty is None:
+            return numpy.arange(0, len(rows))
 
-            for y in range(0, 8):
-                for x in range(0, 8):
-                    self.arr[scr_x + x, scr_y + y] = cache[cur_char_nr][y * 8 + x]
+        blocks = (name_table + rows * bytes_per_line) >> 8
 
-        self.draw_sprites()
-        self.renderer.scrn_draw(self.arr)
+        return numpy.flatnonzero(dirty[blocks])
 
-    def draw_screen_6(self):
+    def draw_screen_6(self, dirty=None):
         name_table = (self.registers[2] & 0x60) << 9
         ny = 212 if (self.registers[9] & 128) == 128 else 192
         yo = self.registers[0x17]
 
-        for y in range(0, ny):
-            yp = ((y + yo) % 212) * 128
+        rows = (numpy.arange(0, ny) + yo) % 212
+        lines = self.bitmap_lines(dirty, name_table, 128, rows)
 
-            for xp in range(0, 128):
-                x = xp * 4
-                p = name_table + yp + xp
-                byte = self.ram[p]
+        data = self.vram(name_table, 212 * 128).reshape(212, 128)[rows[lines]]
 
-                self.arr[x + 0, y] = self.rgb[byte >> 6]
-                self.arr[x + 1, y] = self.rgb[(byte >> 4) & 3]
-                self.arr[x + 2, y] = self.rgb[(byte >> 2) & 3]
-                self.arr[x + 3, y] = self.rgb[byte & 3]
+        pixels = numpy.empty((len(lines), 512), dtype=numpy.uint8)
+        pixels[:, 0::4] = data >> 6
+        pixels[:, 1::4] = (data >> 4) & 3
+        pixels[:, 2::4] = (data >> 2) & 3
+        pixels[:, 3::4] = data & 3
 
-        self.draw_sprites()
-        self.renderer.scrn_draw(self.arr)
+        self.draw_bitmap(self.palette()[pixels], lines)
 
-    def draw_screen_5(self):
+    def draw_screen_5(self, dirty=None):
         name_table = 0
 
-        for y in range(0, 212):
-            offset = name_table + y * 128
+        lines = self.bitmap_lines(dirty, name_table, 128, numpy.arange(0, 212))
 
-            for x in range(0, 256, 2):
-                byte = self.ram[offset]
-                offset += 1
+        data = self.vram(name_table, 212 * 128).reshape(212, 128)[lines]
 
-                p1 = self.rgb[byte >> 4]
-                p2 = self.rgb[byte & 15]
+        pixels = numpy.empty((len(lines), 256), dtype=numpy.uint8)
+        pixels[:, 0::2] = data >> 4
+        pixels[:, 1::2] = data & 15
 
-                self.arr[x, y] = p1
-                self.arr[x + 1, y] = p2
+        self.draw_bitmap(self.palette()[pixels], lines)
 
-        self.draw_sprites()
-        self.renderer.scrn_draw(self.arr)
+    def draw_screen_7(self, dirty=None):
+        name_table = (self.registers[2] & 0x20) << 11
+
+        lines = self.bitmap_lines(dirty, name_table, 256, numpy.arange(0, 212))
+
+        data = self.vram(name_table, 212 * 256).reshape(212, 256)[lines]
 
-    def draw_screen_8(self):
+        pixels = numpy.empty((len(lines), 512), dtype=numpy.uint8)
+        pixels[:, 0::2] = data >> 4
+        pixels[:, 1::2] = data & 15
+
+        self.draw_bitmap(self.palette()[pixels], lines)
+
+    def draw_screen_8(self, dirty=None):
         name_table = 0
 
-        for y in range(0, 212):
-            offset = name_table + y * 256
+        lines = self.bitmap_lines(dirty, name_table, 256, numpy.arange(0, 212))
 
-            for x in range(0, 256):
-                byte = self.ram[offset]
-                offset += 1
+        data = self.vram(name_table, 212 * 256).reshape(212, 256)[lines]
 
-                self.arr[x, y] = self.sc8_rgb_map[byte][0]
+        self.draw_bitmap(self.sc8_lut[data], lines)
 
-        self.draw_sprites()
-        self.renderer.scrn_draw(self.arr)
+    def get_dirty(self, force: bool):
+        # returns None when everything must be redrawn, else an array with
+        # the changed 256 byte VRAM blocks; the flags are reset.
+        # A write between reading and resetting the flags could be missed,
+        # hence the full redraw every second.
+        dirty = numpy.frombuffer(self.dirty, dtype=numpy.uint8).copy()
+        self.dirty[0:len(self.dirty)] = bytes(len(self.dirty))
+
+        self.frames_since_full += 1
+
+        if force or dirty[vdp.DIRTY_ALL] or self.frames_since_full >= 50:
+            self.frames_since_full = 0
+            return None
+
+        dirty = dirty[0:512]
+
+        # sprites are always drawn completely, a change in their tables
+        # means the old ones must be wiped too
+        attr = (self.registers[5] & 127) << 7
+        patt = self.registers[6] << 11
+
+        if dirty[attr >> 8] or dirty[(patt >> 8) & 511:((patt + 2048) >> 8) & 511].any():
+            self.frames_since_full = 0
+            return None
+
+        return dirty
 
     def run(self):
         try:
@@ -783,7 +1025,16 @@ class vdp(threading.Thread):
 
             while not self.stop_flag:
                 self.renderer.kb_poll()
-                time.sleep(0.02)
+
+                if self.kb is not None:
+                    for row in range(0, 16):
+                        self.kb[row] = self.renderer.kb_read_row(row)
+
+                with self.cv:
+                    self.cv.wait(0.1)
+
+                if self.stop_flag:
+                    break
 
                 #msg = self.debug_msg[0:79]
 
@@ -796,41 +1047,52 @@ class vdp(threading.Thread):
                     print('new video mode:', vm)
                 pvm = vm
 
+                dirty = self.get_dirty(resize_trigger)
+
+                if dirty is not None and not dirty.any():
+                    continue  # nothing changed
+
                 if vm == 4:  # 'screen 2' (256 x 192)
                     if resize_trigger:
                         self.resize_window(256, 192)
 
-                    self.draw_screen_2()
+                    self.draw_screen_2(dirty)
 
                 elif vm == 16 or vm == 18:  # 40/80 x 24
                     if resize_trigger:
                         self.resize_window(320 if vm == 16 else 640, 192)
 
-                    self.draw_screen_0(vm)
+                    self.draw_screen_0(vm, dirty)
 
                 elif vm == 0:  # 'screen 1' (32 x 24)
                     if resize_trigger:
                         self.resize_window(256, 192)
 
-                    self.draw_screen_1()
+                    self.draw_screen_1(dirty)
 
                 elif vm == 6:  # 'screen 5' (256 x 212 x 16)
                     if resize_trigger:
                         self.resize_window(256, 212)
 
-                    self.draw_screen_5()
+                    self.draw_screen_5(dirty)
 
                 elif vm == 1:  # 'screen 6' (512 x 212 x 4)
                     if resize_trigger:
                         self.resize_window(512, 212)
 
-                    self.draw_screen_6()
+                    self.draw_screen_6(dirty)
+
+                elif vm == 5:  # 'screen 7' (512 x 212 x 16)
+                    if resize_trigger:
+                        self.resize_window(512, 212)
+
+                    self.draw_screen_7(dirty)
 
                 elif vm == 7:  # 'screen 8' (256 x 212 x 256)
                     if resize_trigger:
                         self.resize_window(256, 212)
 
-                    self.draw_screen_8()
+                    self.draw_screen_8(dirty)
 
                 else:
                     #msg = 'Unsupported resolution'
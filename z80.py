@@ -2,7 +2,8 @@
 # released under AGPL v3.0
 
 from typing import Tuple, Callable, List
-import time
+from scheduler import scheduler
+from blockcache import LEN2, LEN3, PAIRS, PURE, READ_OPERAND, READ_POINTER
 
 FREQ_CLOCK = 3579545  # [Hz]
 FREQ_VDP_REFRESH = 50  # [Hz]
@@ -11,7 +12,7 @@ FREQ_VDP_REFRESH = 50  # [Hz]
 # FREQ_VDP_REFRESH = 60  # [Hz]
 
 class z80:
-    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen) -> None:
+    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen, sched=None) -> None:
         self.read_mem = read_mem
         self.write_mem = write_mem
         self.read_io = read_io
@@ -19,15 +20,80 @@ class z80:
         self.debug_out = debug
         self.screen = screen
 
+        self.scheduler = sched if sched else scheduler()
+        self.vblank_event = None
+
         self.init_main()
         self.init_xy()
         self.init_xy_bit()
         self.init_bits()
         self.init_parity()
+        self.init_flags()
         self.init_ext()
 
+        self.blocks = None
+
+        # see instrument()
+        self.plain_jumps = None
+        self.tracer = None
+        self.profiler = None
+
+        # see enable_bulk_access()
+        self.get_span = None
+        self.read_io_block = None
+        self.write_io_block = None
+
         self.reset()
 
+    def enable_block_cache(self) -> None:
+        from blockcache import blockcache
+
+        self.blocks = blockcache(self)
+        self.write_mem = self.blocks.write_mem
+
+    def enable_bulk_access(self, get_span, read_io_block, write_io_block) -> None:
+        # lets LDIR/LDDR/CPIR/CPDR/INIR/OTIR process many iterations at once:
+        # get_span(a, write) returns the plain memory 'a' is in (see
+        # bus.get_span), read_io_block(port, n) returns n bytes read from a
+        # port, write_io_block(port, data) writes them
+        self.get_span = get_span
+        self.read_io_block = read_io_block
+        self.write_io_block = write_io_block
+
+        if self.blocks:
+            self.blocks.remap()
+
+    def instrument(self, wrap) -> None:
+        # swap the main dispatch table for one with wrap(handler) for every
+        # opcode (tracing, profiling); prefixed instructions are seen as a
+        # whole via their first byte
+        if self.plain_jumps is None:
+            self.plain_jumps = self.main_jumps
+
+        self.main_jumps = [ wrap(handler) for handler in self.main_jumps ]
+
+    def uninstrument(self) -> None:
+        if self.plain_jumps is not None:
+            self.main_jumps = self.plain_jumps
+            self.plain_jumps = None
+
+    def enable_trace(self, t) -> None:
+        self.tracer = t
+        self.instrument(self.traced)
+
+    def traced(self, handler):
+        t = self.tracer
+
+        def record(instr: int) -> int:
+            t.record(self, (self.pc - 1) & 0xffff)
+            return handler(instr)
+
+        return record
+
+    def enable_profile(self, p) -> None:
+        self.profiler = p
+        self.instrument(p.wrap)
+
     def debug(self, x : str) -> None:
         # self.debug_out('%s\t%s' % (x, self.reg_str()))
         self.debug_out(x)
@@ -61,9 +127,44 @@ class z80:
         self.iff2: int = 0
         self.memptr: int = 0xffff
 
-        self.interrupt_cycles: int = 0
         self.int: bool = False
 
+        self.idle_state = None
+        self.idle_since: int = 0
+        self.pure_loops = dict()
+
+        if self.vblank_event:
+            self.scheduler.cancel(self.vblank_event)
+
+        self.vblank_event = self.scheduler.add(FREQ_CLOCK // FREQ_VDP_REFRESH, self.vblank)
+
+    REGISTERS = ('a', 'b', 'c', 'd', 'e', 'f', 'h', 'l', 'a_', 'b_', 'c_', 'd_', 'e_', 'f_', 'h_', 'l_', 'ix', 'iy', 'pc', 'sp', 'im', 'i', 'r', 'iff1', 'iff2', 'memptr')
+
+    def get_state(self) -> dict:
+        state = { name: getattr(self, name) for name in z80.REGISTERS }
+
+        state['interrupts'] = self.interrupts
+        state['int'] = self.int
+        state['vblank'] = self.vblank_event[0]
+
+        return state
+
+    def set_state(self, state: dict) -> None:
+        # the scheduler is restored first, it has no events left
+        for name in z80.REGISTERS:
+            setattr(self, name, state[name])
+
+        self.interrupts = state['interrupts']
+        self.int = state['int']
+
+        self.vblank_event = self.scheduler.add_at(state['vblank'], self.vblank)
+
+        self.idle_state = None
+        self.pure_loops.clear()
+
+        if self.blocks:
+            self.blocks.flush()
+
     def interrupt(self) -> None:
         if self.interrupts:
             self.int = True
@@ -95,36 +196,21 @@ class z80:
         return self.m16(high, low)
 
     def flags_add_sub_cp(self, is_sub : bool, carry : bool, value : int) -> int:
-        org_value = value
-        value += 1 if carry and self.get_flag_c() else 0
+        c = self.f & 1 if carry else 0
 
         if is_sub:
-            self.set_flag_n(True)
+            result = self.a - value - c
+            lookup = ((self.a & 0x88) >> 3) | ((value & 0x88) >> 2) | ((result & 0x88) >> 1)
 
-            result = self.a - value
+            self.f = ((result >> 8) & 1) | 0x02 | self.halfcarry_sub[lookup & 7] | self.overflow_sub[lookup >> 4] | self.sz53[result & 0xff]
 
         else:
-            self.set_flag_n(False)
-
-            result = self.a + value
-
-        self.set_flag_h(((self.a & 0x10) ^ (org_value & 0x10) ^ (result & 0x10)) == 0x10)
-
-        self.set_flag_c((result & 0x100) != 0)
-
-        before_sign = self.a & 0x80
-        value_sign = org_value & 0x80
-        after_sign = result & 0x80
-        self.set_flag_pv(after_sign != before_sign and ((before_sign != value_sign and is_sub) or (before_sign == value_sign and not is_sub)))
-
-        result &= 0xff
-
-        self.set_flag_z(result == 0)
-        self.set_flag_s(after_sign == 0x80)
+            result = self.a + value + c
+            lookup = ((self.a & 0x88) >> 3) | ((value & 0x88) >> 2) | ((result & 0x88) >> 1)
 
-        self.set_flag_53(result)
+            self.f = ((result >> 8) & 1) | self.halfcarry_add[lookup & 7] | self.overflow_add[lookup >> 4] | self.sz53[result & 0xff]
 
-        return result
+        return result & 0xff
 
     def flags_add_sub_cp16(self, is_sub : bool, carry : bool, org_val : int, value : int) -> int:
         org_value = value
@@ -158,115 +244,114 @@ class z80:
 
     def _jr_wrapper(self, instr: int) -> int:
         if instr == 0x18:
-            return self._jr(True, '')
+            return self._jr(True)
 
         elif instr == 0xc3:
-            return self._jp(True, None)
+            return self._jp(True)
 
         elif instr == 0x20:
-            return self._jr(not self.get_flag_z(), 'NZ')
+            return self._jr(not self.get_flag_z())
 
         elif instr == 0x28:
-            return self._jr(self.get_flag_z(), 'Z')
+            return self._jr(self.get_flag_z())
 
         elif instr == 0x30:
-            return self._jr(not self.get_flag_c(), 'NC')
+            return self._jr(not self.get_flag_c())
 
         elif instr == 0x38:
-            return self._jr(self.get_flag_c(), 'C')
+            return self._jr(self.get_flag_c())
 
         else:
             assert False
 
     def _ret_wrap(self, instr: int) -> int:
         if instr == 0xc0:
-            return self._ret(not self.get_flag_z(), 'NZ')
+            return self._ret(not self.get_flag_z())
 
         elif instr == 0xc8:
-            return self._ret(self.get_flag_z(), 'Z')
+            return self._ret(self.get_flag_z())
 
         elif instr == 0xd0:
-            return self._ret(not self.get_flag_c(), 'NC')
+            return self._ret(not self.get_flag_c())
 
         elif instr == 0xd8:
-            return self._ret(self.get_flag_c(), 'C')
+            return self._ret(self.get_flag_c())
 
         elif instr == 0xe0:
-            return self._ret(not self.get_flag_pv(), 'PO')
+            return self._ret(not self.get_flag_pv())
 
         elif instr == 0xe8:
-            return self._ret(self.get_flag_pv(), 'PE')
+            return self._ret(self.get_flag_pv())
 
         elif instr == 0xf0:
-            return self._ret(not self.get_flag_s(), 'P')
+            return self._ret(not self.get_flag_s())
 
         elif instr == 0xf8:
-            return self._ret(self.get_flag_s(), 'M')
+            return self._ret(self.get_flag_s())
 
         else:
             assert False
 
     def _jp_wrap(self, instr: int) -> int:
         if instr == 0xc2:
-            return self._jp(not self.get_flag_z(), 'NZ')
+            return self._jp(not self.get_flag_z())
 
         elif instr == 0xc3:
-            return self._jp(True, '')
+            return self._jp(True)
 
         elif instr == 0xca:  # JP Z,**
-            return self._jp(self.get_flag_z(), 'Z')
+            return self._jp(self.get_flag_z())
 
         elif instr == 0xd2:
-            return self._jp(not self.get_flag_c(), 'NC')
+            return self._jp(not self.get_flag_c())
 
         elif instr == 0xda:  # JP c,**
-            return self._jp(self.get_flag_c(), 'C')
+            return self._jp(self.get_flag_c())
 
         elif instr == 0xe2:
-            return self._jp(not self.get_flag_pv(), 'PO')
+            return self._jp(not self.get_flag_pv())
 
         elif instr == 0xea:  # JP pe,**
-            return self._jp(self.get_flag_pv(), 'PE')
+            return self._jp(self.get_flag_pv())
 
         elif instr == 0xf2:
-            return self._jp(not self.get_flag_s(), 'P')
+            return self._jp(not self.get_flag_s())
 
         elif instr == 0xfa:  # JP M,**
-            return self._jp(self.get_flag_s(), 'M')
+            return self._jp(self.get_flag_s())
 
         else:
             assert False
 
     def _call_wrap(self, instr: int) -> int:
         if instr == 0xc4:
-            return self._call_flag(not self.get_flag_z(), 'NZ')
+            return self._call_flag(not self.get_flag_z())
 
         elif instr == 0xcc:  # CALL Z,**
-            return self._call_flag(self.get_flag_z(), 'Z')
+            return self._call_flag(self.get_flag_z())
 
         elif instr == 0xd4:
-            return self._call_flag(not self.get_flag_c(), 'NC')
+            return self._call_flag(not self.get_flag_c())
 
         elif instr == 0xdc:  # CALL C,**
-            return self._call_flag(self.get_flag_c(), 'C')
+            return self._call_flag(self.get_flag_c())
 
         elif instr == 0xe4:
-            return self._call_flag(not self.get_flag_pv(), 'PO')
+            return self._call_flag(not self.get_flag_pv())
 
         elif instr == 0xec:  # CALL PE,**
-            return self._call_flag(self.get_flag_pv(), 'PE')
+            return self._call_flag(self.get_flag_pv())
 
         elif instr == 0xf4:
-            return self._call_flag(not self.get_flag_s(), 'P')
+            return self._call_flag(not self.get_flag_s())
 
         elif instr == 0xfc:  # CALL M,**
-            return self._call_flag(self.get_flag_s(), 'M')
+            return self._call_flag(self.get_flag_s())
 
         else:
             assert False
 
     def _nop(self, instr: int) -> int:
-        self.debug('%04x NOP' % (self.pc - 1))
         return 4
 
     def _slow_nop(self, instr: int, which: int) -> int:
@@ -461,12 +546,179 @@ class z80:
         self.main_jumps[0xef] = self._rst
         self.main_jumps[0xff] = self._rst
 
-    def step(self):
-        if self.interrupt_cycles >= FREQ_CLOCK / FREQ_VDP_REFRESH:
-            if self.screen.IE0():
-                self.interrupt()
-                self.interrupt_cycles = 0
-            self.screen.interrupt()
+    def vblank(self, when: int) -> None:
+        if self.screen.IE0():
+            self.interrupt()
+
+        self.screen.interrupt()
+
+        # code may have been changed or switched out in the mean time
+        self.pure_loops.clear()
+
+        self.vblank_event = self.scheduler.add_at(when + FREQ_CLOCK // FREQ_VDP_REFRESH, self.vblank)
+
+    def is_pure_loop(self, head: int, branch: int):
+        # only short, straight runs of instructions that don't write to
+        # memory and don't do I/O, up to the jump back at 'branch'; returns
+        # False or the addresses they read, see reads_plain_memory()
+        n = (branch - head) & 0xffff
+        if n > 64:
+            return False
+
+        # where BC, DE, HL and SP point: (register pair, offset) relative
+        # to their values at 'head', (None, address) or None when unknown
+        pairs = { 'bc': ('bc', 0), 'de': ('de', 0), 'hl': ('hl', 0), 'sp': ('sp', 0) }
+
+        reads: List[tuple] = [ ]
+
+        i = 0
+
+        while i < n:
+            a = (head + i) & 0xffff
+            op = self.read_mem(a)
+
+            if op == 0xcb:
+                op2 = self.read_mem((a + 1) & 0xffff)
+                reg = op2 & 7
+
+                # BIT n,x or something on a register (not on (HL))
+                if reg == 6:
+                    if (op2 & 0xc0) != 0x40:
+                        return False
+
+                    reads.append(pairs['hl'])
+
+                elif reg < 6 and (op2 & 0xc0) != 0x40:
+                    pairs[PAIRS[reg >> 1]] = None
+
+                i += 2
+                continue
+
+            if op not in PURE:
+                return False
+
+            if op in READ_OPERAND:
+                address = self.read_mem_16((a + 1) & 0xffff)
+                reads += [ (None, address), (None, address + 1) ]
+
+            elif op in READ_POINTER:
+                pair = 'bc' if op == 0x0a else ('de' if op == 0x1a else ('sp' if (op & 0xcf) == 0xc1 else 'hl'))
+
+                where = pairs[pair]
+
+                if where is None:
+                    return False
+
+                reads.append(where)
+
+                if pair == 'sp':
+                    reads.append((where[0], where[1] + 1))
+
+            self.loop_pairs(op, a, pairs)
+
+            i += 3 if op in LEN3 else (2 if op in LEN2 else 1)
+
+        return reads if i == n else False
+
+    def loop_pairs(self, op: int, a: int, pairs: dict) -> None:
+        # what an instruction from PURE at 'a' does to 'pairs' (see
+        # is_pure_loop)
+        def move(pair: str, delta: int) -> None:
+            where = pairs[pair]
+
+            if where is not None:
+                pairs[pair] = (where[0], where[1] + delta)
+
+        if (op & 0xcf) == 0x01:  # LD rr,nn
+            pairs[PAIRS[op >> 4]] = (None, self.read_mem_16((a + 1) & 0xffff))
+
+        elif (op & 0xcf) == 0x03:  # INC rr
+            move(PAIRS[op >> 4], 1)
+
+        elif (op & 0xcf) == 0x0b:  # DEC rr
+            move(PAIRS[op >> 4], -1)
+
+        elif (op & 0xcf) == 0xc1:  # POP
+            move('sp', 2)
+
+            if op != 0xf1:
+                pairs[PAIRS[(op >> 4) - 0x0c]] = None
+
+        elif op == 0xeb:  # EX DE,HL
+            pairs['de'], pairs['hl'] = pairs['hl'], pairs['de']
+
+        elif op == 0xd9:  # EXX
+            pairs['bc'] = pairs['de'] = pairs['hl'] = None
+
+        elif op == 0xf9:  # LD SP,HL
+            pairs['sp'] = pairs['hl']
+
+        elif (op & 0xcf) == 0x09 or op == 0x2a:  # ADD HL,rr / LD HL,(nn)
+            pairs['hl'] = None
+
+        elif (op >= 0x40 and op < 0x70) or (op < 0x40 and (op & 7) in (4, 5, 6)):
+            # LD r,x / INC r / DEC r / LD r,n
+            reg = (op >> 3) & 7
+
+            if reg < 6:
+                pairs[PAIRS[reg >> 1]] = None
+
+    def reads_plain_memory(self, reads: List[tuple]) -> bool:
+        # a loop that polls a memory mapped device (e.g. a disk controller
+        # status register) is not idle
+        if not reads:
+            return True
+
+        get_span = self.get_span
+
+        if not get_span:
+            return False
+
+        values = { 'bc': self.m16(self.b, self.c), 'de': self.m16(self.d, self.e), 'hl': self.m16(self.h, self.l), 'sp': self.sp, None: 0 }
+
+        for pair, offset in reads:
+            if get_span((values[pair] + offset) & 0xffff, False) is None:
+                return False
+
+        return True
+
+    def idle_skip(self, branch: int) -> int:
+        # Called for taken jumps back to self.pc from 'branch'. When such a
+        # loop can't change memory and the registers are the same as the
+        # previous time around, it will go around the same way until the
+        # next event; skip there in whole iterations.
+        key = self.pc | (branch << 16)
+
+        reads = self.pure_loops.get(key)
+        if reads is None:
+            reads = self.pure_loops[key] = self.is_pure_loop(self.pc, branch)
+
+        if reads is False:
+            return 0
+
+        sched = self.scheduler
+
+        state = (key, self.a, self.f, self.b, self.c, self.d, self.e, self.h, self.l, self.a_, self.f_, self.b_, self.c_, self.d_, self.e_, self.h_, self.l_, self.ix, self.iy, self.sp, self.memptr)
+
+        if state != self.idle_state:
+            self.idle_state = state
+            self.idle_since = sched.now
+            return 0
+
+        period = sched.now - self.idle_since
+
+        self.idle_state = None
+
+        if period <= 0 or sched.next_event == scheduler.NEVER or not self.reads_plain_memory(reads):
+            return 0
+
+        return (sched.next_event - sched.now) // period * period
+
+    def check_interrupt(self) -> None:
+        sched = self.scheduler
+
+        if sched.now >= sched.next_event:
+            sched.run_due()
 
         if self.int:
             self.int = False
@@ -474,6 +726,53 @@ class z80:
             self.push(self.pc)
             self.pc = 0x38
 
+    def run(self, cycles: int) -> int:
+        # execute instructions until 'cycles' T-states have been consumed;
+        # scheduled events (vblank etc) and interrupts are only looked at
+        # when one is due or when a device raised self.int (e.g. the MIDI
+        # thread)
+        main_jumps = self.main_jumps
+        read_mem = self.read_mem
+        sched = self.scheduler
+
+        now = start = sched.now
+        end = start + cycles
+
+        if self.blocks and self.plain_jumps is None:
+            blocks = self.blocks
+
+            while now < end:
+                if now >= sched.next_event or self.int:
+                    self.check_interrupt()
+
+                # blockcache.lookup(), inlined
+                block = blocks.blocks.get(self.pc)
+
+                if block is None:
+                    block = blocks.translate(self.pc)
+
+                blocks.current = block
+
+                now += block()
+                sched.now = now
+
+        else:
+            while now < end:
+                if now >= sched.next_event or self.int:
+                    self.check_interrupt()
+
+                pc = self.pc
+                instr = read_mem(pc)
+                self.pc = (pc + 1) & 0xffff
+
+                now += main_jumps[instr](instr)
+                sched.now = now
+
+        return now - start
+
+    def step(self):
+        self.check_interrupt()
+
         # self.debug('AF %04x BC %04x DE %04x HL %04x IX %04x IY %04x SP %04x slot %02x' % (self.m16(self.a, self.f), self.m16(self.b, self.c), self.m16(self.d, self.e), self.m16(self.h, self.l), self.ix, self.iy, self.sp, self.read_io(0xa8)))
 
         instr = self.read_pc_inc()
@@ -481,7 +780,7 @@ class z80:
         try:
             took = self.main_jumps[instr](instr)
             assert took is not None
-            self.interrupt_cycles += took
+            self.scheduler.now += took
 
         except TypeError as te:
             self.debug('TypeError main(%02X): %s' % (instr, te))
@@ -540,9 +839,7 @@ class z80:
             self.bits_jumps[i] = self._set
 
     def _main_mirror(self, instr: int, is_ix : bool) -> int:
-        self.interrupt_cycles += 4
-
-        return self.main_jumps[instr](instr)
+        return self.main_jumps[instr](instr) + 4
 
     def init_xy(self) -> None:
         self.ixy_jumps: List[Callable[[int, bool], int]] = [ None ] * 256
@@ -827,6 +1124,74 @@ class z80:
     def parity(self, v: int) -> bool:
         return self.parity_lookup[v]
 
+    def init_flags(self) -> None:
+        # S, Z, 5 and 3 of a result, optionally with the parity in P/V
+        self.sz53: List[int] = [ 0 ] * 256
+        self.sz53p: List[int] = [ 0 ] * 256
+
+        for v in range(0, 256):
+            self.sz53[v] = (v & 0xa8) | (0x40 if v == 0 else 0)
+            self.sz53p[v] = self.sz53[v] | (0x04 if self.parity_lookup[v] else 0)
+
+        # indexed by bit 3 (half carry) or bit 7 (overflow) of
+        # a, operand and result: see flags_add_sub_cp
+        self.halfcarry_add: List[int] = [ 0, 0x10, 0x10, 0x10, 0, 0, 0, 0x10 ]
+        self.halfcarry_sub: List[int] = [ 0, 0, 0x10, 0, 0x10, 0, 0x10, 0x10 ]
+        self.overflow_add: List[int] = [ 0, 0, 0, 0x04, 0x04, 0, 0, 0 ]
+        self.overflow_sub: List[int] = [ 0, 0x04, 0, 0, 0, 0, 0x04, 0 ]
+
+        # flags (except carry) after INC/DEC, indexed by the value before
+        self.inc_lookup: List[int] = [ 0 ] * 256
+        self.dec_lookup: List[int] = [ 0 ] * 256
+
+        for v in range(0, 256):
+            after = (v + 1) & 0xff
+            self.inc_lookup[v] = self.sz53[after] | (0x10 if (after & 0x0f) == 0 else 0) | (0x04 if v == 0x7f else 0)
+
+            after = (v - 1) & 0xff
+            self.dec_lookup[v] = self.sz53[after] | 0x02 | (0x10 if (after & 0x0f) == 0x0f else 0) | (0x04 if v == 0x80 else 0)
+
+        # (a << 8) | f after DAA, indexed by a | c << 8 | h << 9 | n << 10
+        self.daa_lookup: List[int] = [ 0 ] * 2048
+
+        for i in range(0, 2048):
+            a = i & 0xff
+            c = (i >> 8) & 1
+            h = (i >> 9) & 1
+            n = (i >> 10) & 1
+
+            # from https://stackoverflow.com/questions/8119577/z80-daa-instruction/8119836
+            t = 0
+
+            if h or (a & 0x0f) > 9:
+                t += 1
+
+            if c or a > 0x99:
+                t += 2
+                c = 1
+
+            if n and not h:
+                h = 0
+
+            elif n and h:
+                h = (a & 0x0f) < 6
+
+            else:
+                h = (a & 0x0f) >= 0x0a
+
+            if t == 1:
+                a += 0xfa if n else 0x06
+
+            elif t == 2:
+                a += 0xa0 if n else 0x60
+
+            elif t == 3:
+                a += 0x9a if n else 0x66
+
+            a &= 0xff
+
+            self.daa_lookup[i] = (a << 8) | self.sz53p[a] | (0x10 if h else 0) | (0x02 if n else 0) | c
+
     def read_mem_16(self, a: int) -> int:
         low = self.read_mem(a)
         high = self.read_mem((a + 1) & 0xffff)
@@ -922,7 +1287,7 @@ class z80:
         out += 'c' if self.get_flag_c() else ''
 
         out += ' | AF: %02x%02x, BC: %02x%02x, DE: %02x%02x, HL: %02x%02x, PC: %04x, SP: %04x, IX: %04x, IY: %04x, memptr: %04x' % (self.a, self.f, self.b, self.c, self.d, self.e, self.h, self.l, self.pc, self.sp, self.ix, self.iy, self.memptr)
-        out += ' | AF_: %02x%02x, BC_: %02x%02x, DE_: %02x%02x, HL_: %02x%02x | %d | %04x }' % (self.a_, self.f_, self.b_, self.c_, self.d_, self.e_, self.h_, self.l_, self.interrupt_cycles, self.read_mem_16(self.sp))
+        out += ' | AF_: %02x%02x, BC_: %02x%02x, DE_: %02x%02x, HL_: %02x%02x | %d | %04x }' % (self.a_, self.f_, self.b_, self.c_, self.d_, self.e_, self.h_, self.l_, self.scheduler.now, self.read_mem_16(self.sp))
 
         return out
 
@@ -932,20 +1297,11 @@ class z80:
 
         (val, name) = self.get_src(src)
         self.a = self.flags_add_sub_cp(False, c, val)
-        self.set_flag_53(self.a)
-
-        self.debug('%04x %s A,%s' % (self.pc - 1, 'ADC' if c else 'ADD', name))
 
         return 4
 
     def or_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p[self.a]
 
     def _or(self, instr: int) -> int:
         src = instr & 7
@@ -954,7 +1310,6 @@ class z80:
 
         self.or_flags()
 
-        self.debug('%04x OR %s' % (self.pc - 1, name))
         return 4
 
     def _or_val(self, instr: int) -> int:
@@ -963,17 +1318,10 @@ class z80:
 
         self.or_flags()
 
-        self.debug('%04x OR #%02X' % (self.pc - 2, v))
         return 7
 
     def and_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(True)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p[self.a] | 0x10
 
     def _and(self, instr: int) -> int:
         src = instr & 7
@@ -982,7 +1330,6 @@ class z80:
 
         self.and_flags()
 
-        self.debug('%04x AND %s' % (self.pc - 1, name))
         return 4
 
     def _and_val(self, instr: int) -> int:
@@ -991,17 +1338,10 @@ class z80:
 
         self.and_flags()
 
-        self.debug('%04x AND #%02X' % (self.pc - 2, v))
         return 7
 
     def xor_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p[self.a]
 
     def _xor(self, instr: int) -> int:
         src = instr & 7
@@ -1011,7 +1351,6 @@ class z80:
 
         self.xor_flags()
 
-        self.debug('%04x XOR %s' % (self.pc - 1, name))
         return 4
 
     def _xor_mem(self, instr: int) -> int:
@@ -1021,12 +1360,10 @@ class z80:
 
         self.xor_flags()
 
-        self.debug('%04x XOR %02X' % (self.pc - 1, val))
         return 7
 
     def _out(self, instr: int) -> int:
         a = self.read_pc_inc()
-        self.debug('%04x OUT (#%02X),A' % (self.pc - 2, a))
         self.out(a, self.a)
         self.memptr = (a + 1) & 0xff
         self.memptr |= self.a << 8
@@ -1051,21 +1388,19 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x SLA %s' % (self.pc - 2, name))
         return 8
     
-    def ixy_boilerplate(self, is_ix: bool) -> Tuple[int, int, int, int, str]:
+    def ixy_boilerplate(self, is_ix: bool) -> Tuple[int, int, int, int]:
         offset = self.compl8(self.read_pc_inc())
         ixy = self.ix if is_ix else self.iy
-        name = 'IX' if is_ix else 'IY'
         a = (ixy + offset) & 0xffff
         self.memptr = a
         val = self.read_mem(a)
 
-        return (a, ixy, val, offset, name)
+        return (a, ixy, val, offset)
 
     def _sla_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         val <<= 1
 
@@ -1083,11 +1418,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x SLA (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
     def _sll(self, instr: int) -> int:
@@ -1110,11 +1442,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x SLL %s' % (self.pc - 1, name))
         return 8
 
     def _sll_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         val <<= 1
         val |= 1  # only difference with sla
@@ -1133,11 +1464,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x SLL (%s+#%02X),%s' % (self.pc - 1, name, offset, dst_name))
         return 23
 
     def _sra(self, instr: int) -> int:
@@ -1161,11 +1489,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x SRA %s' % (self.pc - 1, name))
         return 8
 
     def _sra_ixy(self, instr: int, is_ix: bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         old_7 = val & 128
         self.set_flag_c((val & 1) == 1)
@@ -1185,11 +1512,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x SRA (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
     def _ld_val_low(self, instr: int) -> int:
@@ -1198,20 +1522,15 @@ class z80:
 
         if which == 0:
             self.c = val
-            name = 'C'
         elif which == 1:
             self.e = val
-            name = 'E'
         elif which == 2:
             self.l = val
-            name = 'L'
         elif which == 3:
             self.a = val
-            name = 'A'
         else:
             assert False
 
-        self.debug('%04x LD %s,#%02X' % (self.pc - 2, name, val))
         return 7
 
     def _ld_val_high(self, instr: int) -> int:
@@ -1222,21 +1541,16 @@ class z80:
         cycles = 7
         if which == 0:
             self.b = val
-            name = 'B'
         elif which == 1:
             self.d = val
-            name = 'D'
         elif which == 2:
             self.h = val
-            name = 'H'
         elif which == 3:
             self.write_mem(self.m16(self.h, self.l), val)
-            name = '(HL)'
             cycles = 10
         else:
             assert False
 
-        self.debug('%04x LD %s,#%02X' % (self.pc - 2, name, val))
         return cycles
 
     def _ld(self, instr: int) -> int:
@@ -1246,26 +1560,18 @@ class z80:
 
         cycles = 4 if dst != 6 else 7
 
-        if dst == 6:
-            self.debug('%04x LD (HL),%s' % (self.pc - 1, src_name))
-
-        tgt_name = self.set_dst(dst, val)
-
-        if dst != 6:
-            self.debug('%04x LD %s,%s' % (self.pc - 1, tgt_name, src_name))
+        self.set_dst(dst, val)
 
         return cycles
 
     def _ld_pair(self, instr: int) -> int:
         which = instr >> 4
         val = self.read_pc_inc_16()
-        name = self.set_pair(which, val)
-
-        self.debug('%04x LD %s,#%04X' % (self.pc - 3, name, val))
+        self.set_pair(which, val)
 
         return 10
 
-    def _jp(self, flag : bool, flag_name) -> int:
+    def _jp(self, flag : bool) -> int:
         org_pc = self.pc
 
         a = self.read_pc_inc_16()
@@ -1275,17 +1581,13 @@ class z80:
 
         self.memptr = a
 
-        if flag_name:
-            self.debug('%04x JP %s,#%04X' % (org_pc - 1, flag_name, a))
-
-        else:
-            self.debug('%04x JP #%04X' % (org_pc - 1, a))
+        if flag and a < org_pc:
+            return 10 + self.idle_skip(org_pc - 1)
 
         return 10
 
     def _call(self, instr: int) -> int:
         a = self.read_pc_inc_16()
-        self.debug('%04x CALL #%04X' % (self.pc - 3, a))
         self.push(self.pc)
         self.pc = a
         self.memptr = self.pc
@@ -1296,14 +1598,12 @@ class z80:
 
         if which == 3:
             v = self.m16(self.a, self.f)
-            name = 'AF'
 
         else:
             (v, name) = self.get_pair(which)
 
         self.push(v)
 
-        self.debug('%04x PUSH %s' % (self.pc - 1, name))
         return 11
 
     def _pop(self, instr: int) -> int:
@@ -1311,16 +1611,14 @@ class z80:
         v = self.pop()
 
         if which == 3:
-            name = 'AF'
             (self.a, self.f) = self.u16(v)
 
         else:
-            name = self.set_pair(which, v)
+            self.set_pair(which, v)
 
-        self.debug('%04x POP %s' % (self.pc - 1, name))
         return 10
 
-    def _jr(self, flag : bool, flag_name) -> int:
+    def _jr(self, flag : bool) -> int:
         org_pc = self.pc
         offset = self.read_pc_inc()
 
@@ -1328,21 +1626,15 @@ class z80:
             self.pc += self.compl8(offset)
             self.pc &= 0xffff
             self.memptr = self.pc
-            if flag_name != '':
-                self.debug('%04x JR %s,#%04X' % (org_pc - 1, flag_name, self.pc))
-            else:
-                self.debug('%04x JR #%04X' % (org_pc - 1, self.pc))
-            return 12
 
-        if flag_name != '':
-            self.debug('%04x JR %s,#%04X' % (org_pc - 1, flag_name, self.pc + self.compl8(offset)))
-        else:
-            self.debug('%04x JR #%04X' % (org_pc - 1, self.pc + self.compl8(offset)))
+            if offset >= 0x80:
+                return 12 + self.idle_skip(org_pc - 1)
+
+            return 12
 
         return 7
 
     def _djnz(self, instr: int) -> int:
-        org_pc = self.pc
         offset = self.read_pc_inc()
 
         self.b -= 1
@@ -1352,13 +1644,10 @@ class z80:
             self.pc += self.compl8(offset)
             self.pc &= 0xffff
             self.memptr = self.pc
-            self.debug('%04x DJNZ #%04X' % (org_pc - 1, self.pc))
 
             cycles = 13
 
         else:
-            self.debug('%04x DJNZ #%04X' % (org_pc - 1, self.pc + self.compl8(offset)))
-
             cycles = 8
 
         return cycles
@@ -1370,7 +1659,6 @@ class z80:
         self.set_flag_h(True)
         self.set_flag_53(self.a)
 
-        self.debug('%04x CPL' % (self.pc - 1))
         return 4
 
     def _cp(self, instr: int) -> int:
@@ -1380,8 +1668,6 @@ class z80:
         self.flags_add_sub_cp(True, False, val)
         self.set_flag_53(val)
 
-        self.debug('%04x CP %s' % (self.pc - 1, name))
-
         return 7 if src == 6 else 4
 
     def _sub(self, instr: int) -> int:
@@ -1392,7 +1678,6 @@ class z80:
 
         self.a = self.flags_add_sub_cp(True, c == 8, val)
 
-        self.debug('%04x %s%s' % (self.pc - 1, 'SBC A,' if c else 'SUB ', name))
         return 7 if src == 6 else 4
 
     def _sub_val(self, instr: int) -> int:
@@ -1401,7 +1686,6 @@ class z80:
 
         self.a = self.flags_add_sub_cp(True, c, v)
 
-        self.debug('%04x %s #%02X' % (self.pc - 2, 'SBC' if c else 'SUB', v))
         return 7
 
     def _inc_pair(self, instr: int) -> int:
@@ -1413,62 +1697,43 @@ class z80:
        
         self.set_pair(which, v)
 
-        self.debug('%04x INC %s' % (self.pc - 1, name))
         return 6
 
     def inc_flags(self, before: int) -> None:
-        before = self.compl8(before)
-        after = self.compl8((before + 1) & 0xff)
-
-        self.set_flag_z(after == 0)
-        self.set_flag_pv(before >= 0 and after < 0)
-        self.set_flag_s(after < 0)
-        self.set_flag_n(False)
-        self.set_flag_h(not (after & 0x0f))
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | self.inc_lookup[before]
 
     def _inc(self, instr: int) -> int:
         cycles = 4
         if instr == 0x04:
             self.inc_flags(self.b)
             self.b = (self.b + 1) & 0xff
-            name = 'B'
         elif instr == 0x0c:
             self.inc_flags(self.c)
             self.c = (self.c + 1) & 0xff
-            name = 'C'
         elif instr == 0x14:
             self.inc_flags(self.d)
             self.d = (self.d + 1) & 0xff
-            name = 'D'
         elif instr == 0x1c:
             self.inc_flags(self.e)
             self.e = (self.e + 1) & 0xff
-            name = 'E'
         elif instr == 0x24:
             self.inc_flags(self.h)
             self.h = (self.h + 1) & 0xff
-            name = 'H'
         elif instr == 0x2c:
             self.inc_flags(self.l)
             self.l = (self.l + 1) & 0xff
-            name = 'L'
         elif instr == 0x34:
             a = self.m16(self.h, self.l)
             v = self.read_mem(a)
             self.inc_flags(v)
             self.write_mem(a, (v + 1) & 0xff)
-            name = '(HL)'
             cycles = 11
         elif instr == 0x3c:
             self.inc_flags(self.a)
             self.a = (self.a + 1) & 0xff
-            name = 'A'
         else:
             assert False
 
-        self.debug('%04x INC %s' % (self.pc - 1, name))
-
         return cycles
 
     def _add_pair_ixy(self, instr: int, is_ix : bool) -> int:
@@ -1478,7 +1743,6 @@ class z80:
         which = instr >> 4
         if which == 2:
             v = org_val
-            name = 'IX' if is_ix else 'IY'
         else:
             (v, name) = self.get_pair(which)
 
@@ -1486,22 +1750,18 @@ class z80:
 
         if is_ix:
             self.ix = val
-            self.debug('%04x ADD IX,%s' % (self.pc - 1, name))
 
         else:
             self.iy = val
-            self.debug('%04x ADD IY,%s' % (self.pc - 1, name))
 
         return 15
 
     def _add_pair(self, instr: int) -> int:
-        name = self.add_pair(instr >> 4, False)
-        self.debug('%04x ADD HL,%s' % (self.pc - 1, name))
+        self.add_pair(instr >> 4, False)
         return 11
 
     def _adc_pair(self, instr: int) -> int:
-        name = self.add_pair((instr >> 4) - 4, True)
-        self.debug('%04x ADC HL,%s' % (self.pc - 1, name))
+        self.add_pair((instr >> 4) - 4, True)
         return 15
 
     def add_pair(self, which: int, is_adc : bool) -> str:
@@ -1535,21 +1795,10 @@ class z80:
         v -= 1
         v &= 0xffff
         self.set_pair(which, v)
-        self.debug('%04x DEC %s' % (self.pc - 1, name))
         return 6
 
     def dec_flags(self, before: int) -> None:
-        after = before - 1
-
-        self.set_flag_n(True)
-        self.set_flag_h((after & 0x0f) == 0x0f)
-        self.set_flag_z(after == 0x00)
-        self.set_flag_s((after & 0x80) == 0x80)
-
-        before_sign = (before & 0x80) == 0x80
-        after_sign = (after & 0x80) == 0x80
-        self.set_flag_pv(before_sign and not after_sign)
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | self.dec_lookup[before]
 
     def _dec(self, instr: int) -> int:
         cycles = 4
@@ -1557,43 +1806,33 @@ class z80:
         if instr == 0x05:
             self.dec_flags(self.b)
             self.b = (self.b - 1) & 0xff
-            name = 'B'
         elif instr == 0x0d:
             self.dec_flags(self.c)
             self.c = (self.c - 1) & 0xff
-            name = 'C'
         elif instr == 0x15:
             self.dec_flags(self.d)
             self.d = (self.d - 1) & 0xff
-            name = 'D'
         elif instr == 0x1d:
             self.dec_flags(self.e)
             self.e = (self.e - 1) & 0xff
-            name = 'E'
         elif instr == 0x25:
             self.dec_flags(self.h)
             self.h = (self.h - 1) & 0xff
-            name = 'H'
         elif instr == 0x2d:
             self.dec_flags(self.l)
             self.l = (self.l - 1) & 0xff
-            name = 'L'
         elif instr == 0x35:
             a = self.m16(self.h, self.l)
             v = self.read_mem(a)
             self.dec_flags(v)
             self.write_mem(a, (v - 1) & 0xff)
-            name = '(HL)'
             cycles = 11
         elif instr == 0x3d:
             self.dec_flags(self.a)
             self.a = (self.a - 1) & 0xff
-            name = 'A'
         else:
             assert False
 
-        self.debug('%04x DEC %s' % (self.pc - 1, name))
-
         return cycles
 
     def _rst(self, instr: int) -> int:
@@ -1601,7 +1840,6 @@ class z80:
         which = (instr >> 4) - 0x0c
 
         self.push(self.pc)
-        org_pc = self.pc
 
         if un:
             self.pc = 0x08 + (which << 4)
@@ -1610,13 +1848,11 @@ class z80:
 
         self.memptr = self.pc
 
-        self.debug('%04x RST 0x%02X' % (org_pc - 1, self.pc))
         return 11
 
     def _ex_de_hl(self, instr: int) -> int:
         self.d, self.h = self.h, self.d
         self.e, self.l = self.l, self.e
-        self.debug('%04x EX DE,HL' % (self.pc - 1))
         return 4
 
     def _ld_a_imem(self, instr: int) -> int:
@@ -1624,13 +1860,11 @@ class z80:
         if which == 0:
             a = self.m16(self.b, self.c)
             self.a = self.read_mem(a)
-            self.debug('%04x LD A,(BC)' % (self.pc - 1))
             self.memptr = (a + 1) & 0xffff
 
         elif which == 1:
             a = self.m16(self.d, self.e)
             self.a = self.read_mem(a)
-            self.debug('%04x LD A,(DE)' % (self.pc - 1))
             self.memptr = (a + 1) & 0xffff
 
         else:
@@ -1645,12 +1879,10 @@ class z80:
             v = self.read_mem_16(a)
             (self.h, self.l) = self.u16(v)
             self.memptr = (a + 1) & 0xffff
-            self.debug('%04x LD HL,(#%04X)' % (self.pc - 3, a))
             return 16
 
         elif which == 3:
             a = self.read_pc_inc_16()
-            self.debug('%04x LD A,(#%04X)' % (self.pc - 3, a))
             self.a = self.read_mem(a)
             self.memptr = (a + 1) & 0xffff
             return 13
@@ -1665,44 +1897,35 @@ class z80:
         self.e, self.e_ = self.e_, self.e
         self.h, self.h_ = self.h_, self.h
         self.l, self.l_ = self.l_, self.l
-        self.debug('%04x EXX' % (self.pc - 1))
         return 4
 
     def _ex_af(self, instr: int) -> int:
         self.a, self.a_ = self.a_, self.a
         self.f, self.f_ = self.f_, self.f
-        self.debug('%04x EX AF,AF\'' % (self.pc - 1))
         return 4
 
     def _push_ixy(self, instr: int, is_ix : bool) -> int:
         self.push(self.ix if is_ix else self.iy)
-        self.debug('%04x PUSH I%s' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 15
 
     def _pop_ixy(self, instr: int, is_ix : bool) -> int:
         if is_ix:
             self.ix = self.pop()
-            self.debug('%04x POP IX' % (self.pc - 2))
 
         else:
             self.iy = self.pop()
-            self.debug('%04x POP IY' % (self.pc - 2))
 
         return 14
 
     def _jp_ixy(self, instr: int, is_ix : bool) -> int:
-        org_pc = self.pc - 2
         self.pc = self.ix if is_ix else self.iy
 
-        self.debug('%04x JP I%s' % (org_pc, 'X' if is_ix else 'Y'))
-
         return 8
 
     def _ld_mem_from_ixy(self, instr: int, is_ix : bool) -> int:
         a = self.read_pc_inc_16()
         self.write_mem_16(a, self.ix if is_ix else self.iy)
         self.memptr = (a + 1) & 0xffff
-        self.debug('%04x LD (#%04X),I%s' % (self.pc - 3, a, 'X' if is_ix else 'Y'))
         return 20
 
     def _ld_ixy_from_mem(self, instr: int, is_ix : bool) -> int:
@@ -1716,42 +1939,35 @@ class z80:
 
         self.memptr = (a + 1) & 0xffff
 
-        self.debug('%04x LD I%s,(#%04X)' % (self.pc - 4, 'X' if is_ix else 'Y', a))
         return 20
 
     def _add_a_ixy_h(self, instr: int, is_ix: bool) -> int:
         v = (self.ix if is_ix else self.iy) >> 8
         self.a = self.flags_add_sub_cp(False, False, v)
-        self.debug('%04x ADD A,I%sH' % (self.pc - 1, 'X' if is_ix else 'Y'))
         return 8
 
     def _add_a_ixy_l(self, instr: int, is_ix : bool) -> int:
         v = (self.ix if is_ix else self.iy) & 255
         self.a = self.flags_add_sub_cp(False, False, v)
-        self.debug('%04x ADD A,I%sL' % (self.pc - 1, 'X' if is_ix else 'Y'))
         return 8
 
     def _dec_ixy(self, instr: int, is_x : bool) -> int:
         if is_x:
             self.ix -= 1
             self.ix &= 0xffff
-            self.debug('%04x DEC IX' % (self.pc - 1))
 
         else:
             self.iy -= 1
             self.iy &= 0xffff
-            self.debug('%04x DEC IY' % (self.pc - 1))
         
         return 10
 
     def _ld_sp_ixy(self, instr: int, is_x : bool) -> int:
         if is_x:
             self.sp = self.ix
-            self.debug('%04x LD SP,IX' % (self.pc - 1))
 
         else:
             self.sp = self.iy
-            self.debug('%04x LD SP,IY' % (self.pc - 1))
         return 10
 
     def _ld_mem_pair(self, instr: int) -> int:
@@ -1760,15 +1976,13 @@ class z80:
         (v, name) = self.get_pair(which)
         self.write_mem_16(a, v)
         self.memptr = (a + 1) & 0xffff
-        self.debug('%04x LD (#%04X),%s' % (self.pc - 4, a, name))
         return 20
 
     def _ld_pair_mem(self, instr: int) -> int:
         a = self.read_pc_inc_16()
         v = self.read_mem_16(a)
         self.memptr = (a + 1) & 0xffff
-        name = self.set_pair((instr >> 4) - 4, v)
-        self.debug('%04x LD %s,(#%04X)' % (self.pc - 4, name, a))
+        self.set_pair((instr >> 4) - 4, v)
         return 20
 
     def init_ext(self) -> None:
@@ -1843,21 +2057,19 @@ class z80:
         self.ed_jumps[0xa3] = self._outi
         self.ed_jumps[0xa8] = self._ldd_ldi_r
         self.ed_jumps[0xa9] = self._cpi_cpd_r
-        self.ed_jumps[0xb0] = self._ldd_ldi_r
-        self.ed_jumps[0xb1] = self._cpi_cpd_r
-        self.ed_jumps[0xb2] = self._ini_r
+        self.ed_jumps[0xb0] = self._ldir_lddr
+        self.ed_jumps[0xb1] = self._cpir_cpdr
+        self.ed_jumps[0xb2] = self._inir
         self.ed_jumps[0xb3] = self._otir
-        self.ed_jumps[0xb8] = self._ldd_ldi_r
-        self.ed_jumps[0xb9] = self._cpi_cpd_r
+        self.ed_jumps[0xb8] = self._ldir_lddr
+        self.ed_jumps[0xb9] = self._cpir_cpdr
 
     def _reti(self, instr: int) -> int:
-        self.debug('%04x RETI' % (self.pc - 1))
         self.pc = self.pop()
         self.memptr = self.pc
         return 14
 
     def _retn(self, instr: int) -> int:
-        self.debug('%04x RETN' % (self.pc - 1))
         self.pc = self.pop()
         self.memptr = self.pc
         self.iff1 = self.iff2
@@ -1888,40 +2100,33 @@ class z80:
         self.memptr = (a + 1) & 0xffff
         self.set_flag_53(self.a)
 
-        self.debug('%04x %s' % (self.pc - 1, 'RRD' if instr == 0x67 else 'RLD'))
         return 18
 
     def _ld_i_a(self, instr: int) -> int:
         self.i = self.a
-        self.debug('%04x LD I,A' % (self.pc - 1))
         return 9
 
     def _ld_a_i(self, instr: int) -> int:
         self.a = self.i
-        self.debug('%04x LD A,I' % (self.pc - 1))
         return 9
 
     def _ld_r_a(self, instr: int) -> int:
         self.r = self.a
-        self.debug('%04x LD R,A' % (self.pc - 1))
         return 9
 
     def _ld_a_r(self, instr: int) -> int:
         self.a = self.r
-        self.debug('%04x LD A,R' % (self.pc - 1))
         return 9
 
     def _in(self, instr: int) -> int:
         a = self.read_pc_inc()
         old_a = self.a
-        self.debug('%04x IN A,(#%02X)' % (self.pc - 2, a))
         self.a = self.in_(a)
         self.memptr = ((old_a << 8) + a + 1) & 0xffff
         return 11
 
     def _ld_sp_hl(self, instr: int) -> int:
         self.sp = self.m16(self.h, self.l)
-        self.debug('%04x LD SP,HL' % (self.pc - 1))
         return 6
 
     def _add_a_val(self, instr: int) -> int:
@@ -1930,7 +2135,6 @@ class z80:
 
         self.a = self.flags_add_sub_cp(False, use_c, v)
 
-        self.debug('%04x %s A,#%02X' % (self.pc - 2, 'ADC' if use_c else 'ADD', v))
         return 7
 
     def _ld_pair_from_a(self, instr: int) -> int:
@@ -1939,11 +2143,9 @@ class z80:
         if which == 0:  # (BC) = a
             a = self.m16(self.b, self.c)
             self.write_mem(a, self.a)
-            self.debug('%04x LD (BC),A' % (self.pc - 1))
         elif which == 1:
             a = self.m16(self.d, self.e)
             self.write_mem(a, self.a)
-            self.debug('%04x LD (DE),A' % (self.pc - 1))
         else:
             assert False
 
@@ -1959,7 +2161,6 @@ class z80:
             self.write_mem(a, self.l)
             self.write_mem((a + 1) & 0xffff, self.h)
             self.memptr = a + 1
-            self.debug('%04x LD (#%04X),HL' % (self.pc - 3, a))
             return 16
 
         elif which == 3:  # LD (**), A
@@ -1967,7 +2168,6 @@ class z80:
             self.write_mem(a, self.a)
             self.memptr = (a + 1) & 0xff
             self.memptr |= self.a << 8
-            self.debug('%04x LD (#%04X),A' % (self.pc - 3, a))
             return 13
 
         else:
@@ -1989,7 +2189,6 @@ class z80:
         self.a &= 0xff
         self.set_flag_53(self.a)
 
-        self.debug('%04x RLCA' % (self.pc - 1))
         return 4
 
     def _rla(self, instr: int) -> int:
@@ -2010,7 +2209,6 @@ class z80:
         self.a &= 0xff
         self.set_flag_53(self.a)
 
-        self.debug('%04x RLA' % (self.pc - 1))
         return 4
 
     def _rlc(self, instr: int) -> int:
@@ -2039,11 +2237,10 @@ class z80:
         self.set_flag_z(val == 0)
         self.set_flag_53(val)
 
-        self.debug('%04x RLC %s' % (self.pc - 2, name))
         return 15 if src == 6 else 8
 
     def _rlc_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2063,16 +2260,13 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
         self.set_flag_pv(self.parity(val))
         self.set_flag_s((val & 0x80) == 0x80)
         self.set_flag_z(val == 0)
         self.set_flag_53(val)
 
-        self.debug('%04x RLC (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
     def _rrc(self, instr: int) -> int:
@@ -2095,11 +2289,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x RRC %s' % (self.pc - 1, name))
         return 8
 
     def _rrc_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2119,11 +2312,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x RRC (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
     def _cp_mem(self, instr: int) -> int:
@@ -2132,12 +2322,209 @@ class z80:
         self.flags_add_sub_cp(True, False, v)
         self.set_flag_53(v)
 
-        self.debug('%04x CP #%02X' % (self.pc - 2, v))
         return 7
 
-    def _ldd_ldi_r(self, instr: int) -> int:
-        org_pc = self.pc - 2
+    def repeats(self, count: int) -> int:
+        # how many of the 'count' remaining iterations of a repeating block
+        # instruction (21 T-states each) start before the next event
+        sched = self.scheduler
+
+        return max(1, min(count, (sched.next_event - sched.now + 20) // 21))
+
+    def load_mem(self, a: int, n: int) -> bytes:
+        out = bytearray()
+
+        while n > 0:
+            s = self.get_span(a, False) if self.get_span else None
+
+            if s is None:
+                out.append(self.read_mem(a))
+                c = 1
+
+            else:
+                mem, i, first, last = s
+                c = min(n, last - a + 1)
+                out += mem[i:i + c]
+
+            a = (a + c) & 0xffff
+            n -= c
+
+        return out
+
+    def store_mem(self, a: int, data) -> None:
+        n = len(data)
+        o = 0
+
+        while o < n:
+            s = self.get_span(a, True) if self.get_span else None
+
+            if s is None:
+                self.write_mem(a, data[o])
+                c = 1
+
+            else:
+                mem, i, first, last = s
+                c = min(n - o, last - a + 1)
+                mem[i:i + c] = data[o:o + c]
+
+                if self.blocks:
+                    self.blocks.written(a, a + c - 1)
+
+            a = (a + c) & 0xffff
+            o += c
+
+    def copy_mem(self, src: int, dst: int, n: int, step: int) -> int:
+        # LDIR (step 1) or LDDR (step -1) of up to n bytes, stops at the
+        # first byte that is not plain memory; returns the number copied
+        done = 0
+
+        while done < n and self.get_span:
+            s = self.get_span(src, False)
+            d = self.get_span(dst, True)
+
+            if s is None or d is None:
+                break
+
+            s_mem, s_i, s_first, s_last = s
+            d_mem, d_i, d_first, d_last = d
+
+            if step > 0:
+                c = min(n - done, s_last - src + 1, d_last - dst + 1)
+                ahead = d_i - s_i
+
+            else:
+                c = min(n - done, src - s_first + 1, dst - d_first + 1)
+                ahead = s_i - d_i
+
+            if s_mem is not d_mem and getattr(s_mem, 'obj', s_mem) is getattr(d_mem, 'obj', d_mem):
+                break  # aliased, can't tell how
+
+            if s_mem is d_mem and ahead > 0 and ahead < c:
+                # byte by byte the destination repeats what was copied
+                # 'ahead' bytes earlier: copy in chunks of that size
+                c = ahead
+
+            if step > 0:
+                chunk = s_mem[s_i:s_i + c]
+                if len(chunk) != c:
+                    break
+
+                d_mem[d_i:d_i + c] = chunk
+                low = dst
+
+            else:
+                chunk = s_mem[s_i - c + 1:s_i + 1]
+                if len(chunk) != c:
+                    break
+
+                d_mem[d_i - c + 1:d_i + 1] = chunk
+                low = dst - c + 1
+
+            if self.blocks:
+                self.blocks.written(low, low + c - 1)
+
+            src = (src + c * step) & 0xffff
+            dst = (dst + c * step) & 0xffff
+            done += c
+
+        return done
+
+    def scan_mem(self, a: int, n: int, step: int, v: int) -> int:
+        # CPIR (step 1) or CPDR (step -1): the number of bytes (up to n)
+        # before the first one that is 'v' or is not plain memory
+        done = 0
+
+        while done < n and self.get_span:
+            s = self.get_span(a, False)
+
+            if s is None:
+                break
+
+            mem, i, first, last = s
+
+            if step > 0:
+                c = min(n - done, last - a + 1)
+                j = bytes(mem[i:i + c]).find(v)
+
+            else:
+                c = min(n - done, a - first + 1)
+                j = bytes(mem[i - c + 1:i + 1]).rfind(v)
+
+                if j >= 0:
+                    j = c - 1 - j
+
+            if j >= 0:
+                return done + j
+
+            a = (a + c * step) & 0xffff
+            done += c
+
+        return done
+
+    def _ldir_lddr(self, instr: int) -> int:
+        # all but the last iteration as one copy, the last one (flags,
+        # memptr, PC) by the single step implementation
+        bc = self.m16(self.b, self.c)
+        step = 1 if instr == 0xb0 else -1
+
+        n = self.repeats(bc if bc else 65536) - 1
+
+        if n > 0:
+            hl = self.m16(self.h, self.l)
+            de = self.m16(self.d, self.e)
+
+            # stop before an iteration that overwrites the instruction
+            # itself: from then on it is whatever was copied over it
+            for a in ((self.pc - 2) & 0xffff, (self.pc - 1) & 0xffff):
+                n = min(n, ((a - de) * step) & 0xffff)
 
+            n = self.copy_mem(hl, de, n, step)
+
+            if n > 0:
+                (self.b, self.c) = self.u16((bc - n) & 0xffff)
+                (self.d, self.e) = self.u16((de + n * step) & 0xffff)
+                (self.h, self.l) = self.u16((hl + n * step) & 0xffff)
+
+                self.memptr = (self.pc - 1) & 0xffff
+
+        return n * 21 + self._ldd_ldi_r(instr)
+
+    def _cpir_cpdr(self, instr: int) -> int:
+        bc = self.m16(self.b, self.c)
+        step = 1 if instr == 0xb1 else -1
+
+        n = self.repeats(bc if bc else 65536) - 1
+
+        if n > 0:
+            hl = self.m16(self.h, self.l)
+
+            n = self.scan_mem(hl, n, step, self.a)
+
+            if n > 0:
+                (self.b, self.c) = self.u16((bc - n) & 0xffff)
+                (self.h, self.l) = self.u16((hl + n * step) & 0xffff)
+
+                self.memptr = (self.pc - 1) & 0xffff
+
+        return n * 21 + self._cpi_cpd_r(instr)
+
+    def _inir(self, instr: int) -> int:
+        n = self.repeats(self.b if self.b else 256) - 1
+
+        if n > 0 and self.read_io_block:
+            hl = self.m16(self.h, self.l)
+
+            self.store_mem(hl, self.read_io_block(self.c, n))
+
+            (self.h, self.l) = self.u16((hl + n) & 0xffff)
+            self.b = (self.b - n) & 0xff
+
+        else:
+            n = 0
+
+        return n * 21 + self._ini_r(instr)
+
+    def _ldd_ldi_r(self, instr: int) -> int:
         self.set_flag_n(False)
         self.set_flag_pv(False)
         self.set_flag_h(False)
@@ -2157,8 +2544,6 @@ class z80:
             de -= 1
             de &= 0xffff
 
-            name = 'LDDR' if instr == 0xb8 else 'LDD'
-
         elif instr == 0xb0 or instr == 0xa0:  # LDIR / LDI
             hl += 1
             hl &= 0xffff
@@ -2166,8 +2551,6 @@ class z80:
             de += 1
             de &= 0xffff
 
-            name = 'LDIR' if instr == 0xb0 else 'LDI'
-
         else:
             assert False
 
@@ -2192,7 +2575,6 @@ class z80:
         self.f |= 0x20 if (temp & (1 << 1)) else 0
         self.f |= 0x08 if (temp & (1 << 3)) else 0
 
-        self.debug('%04x %s' % (org_pc, name))
         return cycles
 
     def _rl(self, instr: int) -> int:
@@ -2215,12 +2597,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x RL %s' % (self.pc - 1, name))
-
         return 15 if src == 6 else 8
 
     def _rl_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2239,11 +2619,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x RL (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
     def _rr(self, instr: int) -> int:
@@ -2267,12 +2644,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x RR %s' % (self.pc - 2, name))
-
         return 15 if src == 6 else 8
 
     def _rr_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2291,11 +2666,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x RR (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
     def _im(self, instr: int) -> int:
@@ -2308,20 +2680,15 @@ class z80:
         else:
             self.im = (instr >> 4) & 1
 
-        self.debug('%04x IM %d' % (self.pc - 2, self.im))
         return 8
 
     def _ret_always(self, instr: int) -> int:
-        self.debug('%04x RET' % (self.pc - 1))
-
         self.pc = self.pop()
         self.memptr = self.pc
 
         return 10
 
-    def _ret(self, flag : bool, flag_name) -> int:
-        org_pc = self.pc
-
+    def _ret(self, flag : bool) -> int:
         cycles = 5
         if flag:
             self.pc = self.pop()
@@ -2329,12 +2696,9 @@ class z80:
 
             cycles = 11
 
-        self.debug('%04x RET %s' % (org_pc - 1, flag_name))
-
         return cycles
 
-    def _call_flag(self, flag : bool, flag_name) -> int:
-        org_pc = self.pc
+    def _call_flag(self, flag : bool) -> int:
         a = self.read_pc_inc_16()
 
         cycles = 10
@@ -2345,8 +2709,6 @@ class z80:
 
         self.memptr = a
 
-        self.debug('%04x CALL %s,#%04X' % (org_pc - 1, flag_name, a))
-
         return cycles
 
     def _scf(self, instr: int) -> int:
@@ -2356,7 +2718,6 @@ class z80:
 
         self.f |= self.a & 0x28  # special case
 
-        self.debug('%04x SCF' % (self.pc - 1))
         return 4
 
     def _ex_sp_hl(self, instr: int) -> int:
@@ -2367,7 +2728,6 @@ class z80:
         (self.h, self.l) = self.u16(org_sp_deref)
         self.memptr = org_sp_deref
 
-        self.debug('%04x EX (SP),HL' % (self.pc - 1))
         return 19
 
     def _rrca(self, instr: int) -> int:
@@ -2381,7 +2741,6 @@ class z80:
 
         self.set_flag_c(bit0 == 1)
 
-        self.debug('%04x RRCA' % (self.pc - 1))
         return 4
 
     def _rra(self, instr: int) -> int:
@@ -2395,17 +2754,14 @@ class z80:
         self.set_flag_c(bit0 == 1)
         self.set_flag_53(self.a)
 
-        self.debug('%04x RRA' % (self.pc - 1))
         return 4
 
     def _di(self, instr: int) -> int:
         self.interrupts = False
-        self.debug('%04x DI' % (self.pc - 1))
         return 4
 
     def _ei(self, instr: int) -> int:
         self.interrupts = True
-        self.debug('%04x EI' % (self.pc - 1))
         return 4
 
     def _ccf(self, instr: int) -> int:
@@ -2420,7 +2776,6 @@ class z80:
 
         self.set_flag_53(old_f | self.a)
 
-        self.debug('%04x CCF' % (self.pc - 1))
         return 4
 
     def _bit(self, instr: int) -> int:
@@ -2442,8 +2797,6 @@ class z80:
         else:
             self.set_flag_53(val)
 
-        self.debug('%04x BIT %d,%s' % (self.pc - 2, nr, src_name))
-
         return 12 if src == 6 else 8
 
     def _srl(self, instr: int) -> int:
@@ -2465,11 +2818,10 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x SRL %s' % (self.pc - 1, src_name))
         return 12 if src == 6 else 8
 
     def _srl_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2486,11 +2838,8 @@ class z80:
 
         dst = instr & 0x7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x SRL (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
     def _set(self, instr: int) -> int:
@@ -2504,7 +2853,6 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x SET %d,%s' % (self.pc - 2, bit, src_name))
         return 15 if src == 6 else 8
 
     def _res(self, instr: int) -> int:
@@ -2518,7 +2866,6 @@ class z80:
         dst = src
         self.set_dst(dst, val)
 
-        self.debug('%04x RES %d,%s' % (self.pc - 2, bit, src_name))
         return 15 if src == 6 else 8
 
     def _sbc_pair(self, instr: int) -> int:
@@ -2538,7 +2885,6 @@ class z80:
 
         self.memptr = (before + 1) & 0xffff
 
-        self.debug('%04x SBC HL,%s' % (self.pc - 2, name))
         return 15
 
     def _neg(self, instr: int) -> int:
@@ -2547,7 +2893,6 @@ class z80:
         self.a = 0
         self.a = self.flags_add_sub_cp(True, False, org_a)
 
-        self.debug('%04x NEG' % (self.pc - 1))
         return 8
 
     def _ld_ixy(self, instr: int, is_ix : bool) -> int:
@@ -2555,22 +2900,18 @@ class z80:
 
         if is_ix:
             self.ix = v
-            self.debug('%04x LD ix,**' % (self.pc - 4))
 
         else:
             self.iy = v
-            self.debug('%04x LD iy,**' % (self.pc - 4))
             
         return 14
 
     def _inc_ixy(self, instr: int, is_ix : bool) -> int:
         if is_ix:
             self.ix = (self.ix + 1) & 0xffff
-            self.debug('%04x INC IX' % (self.pc - 2))
         
         else:
             self.iy = (self.iy + 1) & 0xffff
-            self.debug('%04x INC IX' % (self.pc - 2))
 
         return 10
 
@@ -2579,16 +2920,12 @@ class z80:
 
         if which == 0:
             v = self.b
-            name = 'B'
         elif which == 1:
             v = self.d
-            name = 'D'
         elif which == 2:
             v = self.h
-            name = 'H'
         elif which == 3:
             v = 0
-            name = '0'
         else:
             assert False
 
@@ -2596,7 +2933,6 @@ class z80:
 
         self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
 
-        self.debug('%04x OUT (C),%s' % (self.pc - 1, name))
         return 12
 
     def _out_c_high(self, instr: int) -> int:
@@ -2604,16 +2940,12 @@ class z80:
 
         if which == 0:
             v = self.c
-            name = 'C'
         elif which == 1:
             v = self.e
-            name = 'E'
         elif which == 2:
             v = self.l
-            name = 'L'
         elif which == 3:
             v = self.a
-            name = 'A'
         else:
             assert False
 
@@ -2621,7 +2953,6 @@ class z80:
 
         self.out(self.c, v)
 
-        self.debug('%04x OUT (C),%s' % (self.pc - 1, name))
         return 12
 
     def _in_ed_low(self, instr: int) -> int:
@@ -2630,16 +2961,11 @@ class z80:
 
         if which == 0:
             self.b = v
-            name = 'B'
         elif which == 1:
             self.d = v
-            name = 'D'
         elif which == 2:
             self.h = v
-            name = 'H'
-        elif which == 3:
-            name = ''
-        else:
+        elif which != 3:  # 3: IN F,(C), only the flags
             assert False
 
         self.set_flag_n(False)
@@ -2650,7 +2976,6 @@ class z80:
 
         self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
 
-        self.debug('%04x IN %s,(C)' % (self.pc - 1, name))
         return 12
 
     def _in_ed_high(self, instr: int) -> int:
@@ -2659,16 +2984,12 @@ class z80:
 
         if which == 0:
             self.c = v
-            name = 'C'
         elif which == 1:
             self.e = v
-            name = 'E'
         elif which == 2:
             self.l = v
-            name = 'L'
         elif which == 3:
             self.a = v
-            name = 'A'
         else:
             assert False
 
@@ -2678,7 +2999,6 @@ class z80:
         self.set_flag_z(v == 0)
         self.set_flag_s((v & 0x80) == 0x80)
 
-        self.debug('%04x IN %s,(C)' % (self.pc - 1, name))
         return 12
 
     def _outi(self, instr: int) -> int:
@@ -2698,39 +3018,38 @@ class z80:
         self.set_flag_n(True)
         self.set_flag_z(self.b == 0)
 
-        self.debug('%04x OUTI' % (self.pc - 1))
         return 16
 
     def _ld_ixy_X(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         which = instr & 15
         (val, src_name) = self.get_src(which)
         self.write_mem(a, val)
 
-        self.debug('%04x LD (%s+#%02x),%s' % (self.pc - 3, name, offset, src_name))
         return 19
 
     def _otir(self, instr: int) -> int:
-        a = self.m16(self.h, self.l)
+        n = self.repeats(self.b if self.b else 256) - 1
 
-        while True:
-            mem = self.read_mem(a)
-            self.write_io(self.c, mem)
+        if n > 0 and self.write_io_block:
+            hl = self.m16(self.h, self.l)
 
-            a = self.incp16(a)
-            self.b -= 1
+            self.write_io_block(self.c, self.load_mem(hl, n))
 
-            if self.b == 0:
-                break
+            (self.h, self.l) = self.u16((hl + n) & 0xffff)
+            self.b = (self.b - n) & 0xff
 
-        (self.h, self.l) = self.u16(a)
+        else:
+            n = 0
 
-        self.set_flag_n(True)
-        self.set_flag_z(True)
+        cycles = self._outi(instr)
+
+        if self.b != 0:
+            self.pc = (self.pc - 2) & 0xffff
+            cycles = 21
 
-        self.debug('%04x OTIR' % (self.pc - 1))
-        return 21  # FIXME or 16?
+        return n * 21 + cycles
 
     def _cpi_cpd_r(self, instr: int) -> int:
         hl = self.m16(self.h, self.l)
@@ -2741,13 +3060,9 @@ class z80:
         if instr == 0xb1 or instr == 0xa1:  # CPIR / CPI
             hl = (hl + 1) & 0xffff
 
-            name = 'CPIR' if instr == 0xb1 else 'CPI'
-
         elif instr == 0xb9 or instr == 0xa9:  # CPDR / CPD
             hl = (hl - 1) & 0xffff
 
-            name = 'CPDR' if instr == 0xb1 else 'CPD'
-
         bc = (bc - 1) & 0xffff
 
         result = self.a - mem
@@ -2783,8 +3098,6 @@ class z80:
         elif instr == 0xa9:
             self.memptr -= 1
 
-        self.debug('%04x %s' % (self.pc - 2, name))
-
         return cycles
 
     def _and_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
@@ -2796,103 +3109,67 @@ class z80:
 
         self.and_flags()
 
-        self.debug('%04x AND (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
     def _ld_X_ixy_deref(self, which, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
  
         if which == 0x46:
             self.b = val
-            name = 'B'
  
         elif which == 0x4e:
             self.c = val
-            name = 'C'
  
         elif which == 0x56:
             self.d = val
-            name = 'D'
  
         elif which == 0x5e:
             self.e = val
-            name = 'E'
  
         elif which == 0x66:
             self.h = val
-            name = 'H'
  
         elif which == 0x6e:
             self.l = val
-            name = 'L'
  
         elif which == 0x7e:
             self.a = val
-            name = 'A'
 
         else:
             assert False
 
-        self.debug('%04x LD %s,(IX+#%02x)' % (self.pc - 3, name, offset))
         return 19
 
     def _add_a_deref_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.a = self.flags_add_sub_cp(False, False, val)
 
-        self.debug('%04x ADD A,(%s+#%02x)' % (self.pc - 3, name, offset))
         return 19
 
-    # from https://stackoverflow.com/questions/8119577/z80-daa-instruction/8119836
     def _daa(self, instr: int) -> int:
-        t = 0
+        v = self.daa_lookup[self.a | ((self.f & 1) << 8) | ((self.f & 0x10) << 5) | ((self.f & 2) << 9)]
 
-        if self.get_flag_h() or (self.a & 0x0f) > 9:
-            t += 1
+        self.a = v >> 8
+        self.f = v & 0xff
 
-        if self.get_flag_c() or self.a > 0x99:
-            t += 2
-            self.set_flag_c(True)
-
-        if self.get_flag_n() and not self.get_flag_h():
-            self.set_flag_h(False)
-
-        else:
-            if self.get_flag_n() and self.get_flag_h():
-                self.set_flag_h((self.a & 0x0f) < 6)
-            else:
-                self.set_flag_h((self.a & 0x0f) >= 0x0a)
-
-        if t == 1:
-            self.a += 0xfa if self.get_flag_n() else 0x06
-
-        elif t == 2:
-            self.a += 0xa0 if self.get_flag_n() else 0x60
-
-        elif t == 3:
-            self.a += 0x9a if self.get_flag_n() else 0x66
-
-        self.a &= 0xff
-
-        self.set_flag_s((self.a & 128) == 128)
-        self.set_flag_z(self.a == 0x00)
-        self.set_flag_pv(self.parity(self.a))
-        self.set_flag_53(self.a)
-
-        self.debug('%04x DAA' % (self.pc - 1))
         return 4
 
     def _jp_hl(self, instr: int) -> int:
         self.pc = self.m16(self.h, self.l)
 
-        self.debug('%04x JP (HL)' % (self.pc - 1))
-
         return 4
 
     def _halt(self, instr: int) -> int:
         self.pc = (self.pc - 1) & 0xffff
-        self.debug('%04x HALT' % (self.pc - 1))
+
+        # nothing happens until the next event (interrupt), go there directly
+        # in steps of 4 (the NOPs a halted Z80 executes)
+        sched = self.scheduler
+
+        if sched.next_event != scheduler.NEVER and sched.next_event - sched.now > 4:
+            return (sched.next_event - sched.now + 3) & ~3
+
         return 4
 
     def _inc_ixh(self, instr: int, is_ix : bool) -> int:
@@ -2903,7 +3180,6 @@ class z80:
             self.ix = (self.ix & 0x00ff) | (work << 8)
         else:
             self.iy = (self.iy & 0x00ff) | (work << 8)
-        self.debug('%04x INC %s' % (self.pc - 2, 'IXH' if is_ix else 'IYH'))
         return 8
 
     def _dec_ixh(self, instr: int, is_ix : bool) -> int:
@@ -2914,7 +3190,6 @@ class z80:
             self.ix = (self.ix & 0x00ff) | (work << 8)
         else:
             self.iy = (self.iy & 0x00ff) | (work << 8)
-        self.debug('%04x INC %s' % (self.pc - 2, 'IXH' if is_ix else 'IYH'))
         return 8
 
     def _ld_ixh(self, instr: int, is_ix : bool) -> int:
@@ -2923,7 +3198,6 @@ class z80:
             self.ix = (self.ix & 0x00ff) | (v << 8)
         else:
             self.iy = (self.iy & 0x00ff) | (v << 8)
-        self.debug('%04x LD %s,%02X' % (self.pc - 3, 'IXH' if is_ix else 'IYH', v))
         return 11
 
     def _inc_ixl(self, instr: int, is_ix : bool) -> int:
@@ -2934,7 +3208,6 @@ class z80:
             self.ix = (self.ix & 0xff00) | work
         else:
             self.iy = (self.iy & 0xff00) | work
-        self.debug('%04x INC %s' % (self.pc - 2, 'IXL' if is_ix else 'IYL'))
         return 8
 
     def _dec_ixl(self, instr: int, is_ix : bool) -> int:
@@ -2945,7 +3218,6 @@ class z80:
             self.ix = (self.ix & 0xff00) | work
         else:
             self.iy = (self.iy & 0xff00) | work
-        self.debug('%04x INC %s' % (self.pc - 2, 'IXL' if is_ix else 'IYL'))
         return 8
 
     def _ld_ixl(self, instr: int, is_ix : bool) -> int:
@@ -2954,27 +3226,24 @@ class z80:
             self.ix = (self.ix & 0xff00) | v
         else:
             self.iy = (self.iy & 0xff00) | v
-        self.debug('%04x LD %s,%02X' % (self.pc - 3, 'IXL' if is_ix else 'IYL', v))
         return 11
 
     def _inc_ix_index(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.inc_flags(val)
         val = (val + 1) & 0xff
         self.write_mem(a, val)
 
-        self.debug('%04x INC (%s+#%02X)' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff))
         return 23
 
     def _dec_ix_index(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.dec_flags(val)
         val = (val - 1) & 0xff
         self.write_mem(a, val)
 
-        self.debug('%04x DEC (%s+#%02X)' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff))
         return 23
 
     def _ld_ix_index(self, instr: int, is_ix : bool) -> int:
@@ -2984,13 +3253,10 @@ class z80:
         self.memptr = a
         v = self.read_pc_inc()
         self.write_mem(a, v)
-        self.debug('%04x LD (%s+#%02X), #%02X' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff, v))
         return 19
 
     def _bit_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
-
-        src_name = '(%s+#%02X)' % (name, offset)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
 
         self.set_flag_n(False)
         self.set_flag_h(True)
@@ -3003,56 +3269,46 @@ class z80:
 
         self.set_flag_53(self.memptr >> 8)
 
-        self.debug('%04x BIT %d,%s' % (self.pc - 3, nr, src_name))
-
         return 20
 
     def _lb_b_ixh(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.b = ixy >> 8
-        self.debug('%04x LD B, I%sH' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_b_ixl(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.b = ixy & 0xff
-        self.debug('%04x LD B, I%sL' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_c_ixh(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.c = ixy >> 8
-        self.debug('%04x LD C, I%sH' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_c_ixl(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.c = ixy & 0xff
-        self.debug('%04x LD C, I%sL' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_d_ixh(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.d = ixy >> 8
-        self.debug('%04x LD D, I%sH' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_d_ixl(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.d = ixy & 0xff
-        self.debug('%04x LD D, I%sL' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_e_ixh(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.e = ixy >> 8
-        self.debug('%04x LD E, I%sH' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _lb_e_ixl(self, instr: int, is_ix : bool) -> int:
         ixy = self.ix if is_ix else self.iy
         self.e = ixy & 0xff
-        self.debug('%04x LD E, I%sL' % (self.pc - 2, 'X' if is_ix else 'Y'))
         return 8
 
     def _ld_ixh_src(self, instr: int, is_ix : bool) -> int:
@@ -3060,22 +3316,18 @@ class z80:
 
         if src == 4:
             val = (self.ix if is_ix else self.iy) >> 8
-            name = 'IXH' if is_ix else 'IYH'
         elif src == 5:
             val = (self.ix if is_ix else self.iy) & 0xff
-            name = 'IXL' if is_ix else 'IYL'
         else:
             (val, name) = self.get_src(src)
 
         if is_ix:
             self.ix &= 0x00ff
             self.ix |= val << 8
-            self.debug('%04x LD IXH,%s' % (self.pc - 2, name))
 
         else:
             self.iy &= 0x00ff
             self.iy |= val << 8
-            self.debug('%04x LD IYH,%s' % (self.pc - 2, name))
 
         return 8
 
@@ -3084,22 +3336,18 @@ class z80:
 
         if src == 4:
             val = (self.ix if is_ix else self.iy) >> 8
-            name = 'IXH' if is_ix else 'IYH'
         elif src == 5:
             val = (self.ix if is_ix else self.iy) & 0xff
-            name = 'IXL' if is_ix else 'IYL'
         else:
             (val, name) = self.get_src(src)
 
         if is_ix:
             self.ix &= 0xff00
             self.ix |= val
-            self.debug('%04x LD IHL,%s' % (self.pc - 2, name))
 
         else:
             self.iy &= 0xff00
             self.iy |= val
-            self.debug('%04x LD IHL,%s' % (self.pc - 2, name))
 
         return 8
 
@@ -3108,10 +3356,8 @@ class z80:
 
         if instr & 1:
             self.a = ixy & 255
-            self.debug('%04x LD A,I%sH' % (self.pc - 2, 'X' if is_ix else 'Y'))
         else:
             self.a = ixy >> 8
-            self.debug('%04x LD A,I%sL' % (self.pc - 2, 'X' if is_ix else 'Y'))
 
         return 8
 
@@ -3121,7 +3367,6 @@ class z80:
         v = (ixy & 255) if instr & 1 else (ixy >> 8)
 
         self.a = self.flags_add_sub_cp(False, True, v)
-        self.debug('%04x ACD A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
 
         return 8
 
@@ -3131,23 +3376,20 @@ class z80:
         v = (ixy & 255) if instr & 1 else (ixy >> 8)
 
         self.a = self.flags_add_sub_cp(True, False, v)
-        self.debug('%04x SUB A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
 
         return 8
 
     def _adc_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
  
         self.a = self.flags_add_sub_cp(False, True, val)
-        self.debug('%04x ACD A,(I%s%s+#%02X)' % (self.pc - 3, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H', offset & 0xff))
 
         return 19
 
     def _sub_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
  
         self.a = self.flags_add_sub_cp(True, instr == 0x9e, val)
-        self.debug('%04x %s A,(I%s%s+#%02X)' % (self.pc - 3, 'SBC' if instr == 0x9e else 'SUB', 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H', offset & 0xff))
 
         return 19
 
@@ -3156,7 +3398,6 @@ class z80:
         v = (ixy & 255) if instr & 1 else (ixy >> 8)
 
         self.a = self.flags_add_sub_cp(True, True, v)
-        self.debug('%04x SBC A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
 
         return 8
 
@@ -3167,8 +3408,6 @@ class z80:
         self.a &= v
         self.and_flags()
 
-        self.debug('%04x AND A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
-
         return 8
 
     def _xor_a_ixy_hl(self, instr: int, is_ix : bool) -> int:
@@ -3178,8 +3417,6 @@ class z80:
         self.a ^= v
         self.xor_flags()
 
-        self.debug('%04x XOR A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
-
         return 8
 
     def _or_a_ixy_hl(self, instr: int, is_ix : bool) -> int:
@@ -3189,8 +3426,6 @@ class z80:
         self.a |= v
         self.or_flags()
 
-        self.debug('%04x OR A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
-
         return 8
 
     def _cp_a_ixy_hl(self, instr: int, is_ix : bool) -> int:
@@ -3200,8 +3435,6 @@ class z80:
         self.flags_add_sub_cp(True, False, v)
         self.set_flag_53(v)
 
-        self.debug('%04x CP A,I%s%s' % (self.pc - 2, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H'))
-
         return 8
 
     def _xor_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
@@ -3212,7 +3445,6 @@ class z80:
         self.a ^= self.read_mem(a)
         self.xor_flags()
 
-        self.debug('%04x XOR (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
     def _or_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
@@ -3223,7 +3455,6 @@ class z80:
         self.a |= self.read_mem(a)
         self.or_flags()
 
-        self.debug('%04x OR (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
     def _cp_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
@@ -3235,12 +3466,10 @@ class z80:
         self.flags_add_sub_cp(True, False, v)
         self.set_flag_53(v)
 
-        self.debug('%04x CP (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
-
         return 8
 
     def _res_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
  
         bit = (instr - 0x80) >> 3
         val &= ~(1 << bit)
@@ -3250,15 +3479,12 @@ class z80:
 
         dst = instr & 7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x RES (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
     def _set_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+        a, ixy, val, offset = self.ixy_boilerplate(is_ix)
  
         bit = (instr - 0xc0) >> 3
         val |= 1 << bit
@@ -3268,11 +3494,8 @@ class z80:
 
         dst = instr & 7
         if dst != 6:
-            dst_name = self.set_dst(dst, val)
-        else:
-            dst_name = ''
+            self.set_dst(dst, val)
 
-        self.debug('%04x SET (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
     def _ex_sp_ix(self, instr: int, is_ix : bool) -> int:
@@ -3287,7 +3510,6 @@ class z80:
 
         self.memptr = org_sp_deref
 
-        self.debug('%04x EX (SP),%s' % (self.pc - 2, 'IX' if is_ix else 'IY'))
         return 23
 
     def _ini_r(self, instr: int) -> int:
@@ -3318,6 +3540,4 @@ class z80:
                 self.pc = (self.pc - 2) & 0xffff
                 cycles = 21
 
-        self.debug('%04x %s' % (self.pc - 2, 'INIR' if instr == 0xb2 else 'INI'))
-
         return cycles
@@ -69,7 +69,7 @@ while True:
             if 'Tests complete' in str_:
                 break
 
-        cpu._ret(True, 'bla')
+        cpu._ret(True)
 
         continue
 